@@ -0,0 +1,98 @@
+""" Checks that AVIWriter and AVIReader round-trip packets and keyframe flags
+    across OpenDML RIFF AVIX segments, and times reading them back
+
+    python benchmarks/avi_roundtrip.py --riff_size_limit 50000
+
+    A small riff_size_limit splits even a short encode into many segments.
+    The default codec (mpeg2video) is one whose keyframes AVIReader can't
+    infer from the bitstream, so every flag past the first RIFF has to come
+    from the segments' standard indices (ix00).
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+from compressure.dataproc import AVIReader, AVIWriter, PacketIndex, try_subprocess
+
+
+def make_encode(fpath, codec, gop_size, duration):
+    """ Encodes a test pattern with keyframes every gop_size frames
+    """
+    try_subprocess([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc=size=320x240:rate=24:duration={duration}",
+        "-c:v", codec, "-g", str(gop_size), "-bf", "0",
+        fpath,
+    ])
+    return fpath
+
+
+def count_riffs(fpath):
+    with open(fpath, 'rb') as fid:
+        return fid.read().count(b"RIFF")
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--riff_size_limit",
+        default=50000,
+        type=int,
+        help="bytes per RIFF segment of the rewritten encode"
+    )
+    parser.add_argument(
+        "--codec",
+        default="mpeg2video",
+        help="encoder of the test pattern"
+    )
+    parser.add_argument(
+        "--gop_size",
+        default=12,
+        type=int,
+        help="frames between keyframes"
+    )
+    parser.add_argument(
+        "--duration",
+        default=20,
+        type=float,
+        help="seconds of test pattern"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    dpath = tempfile.mkdtemp(prefix="compressure_bench_")
+    try:
+        fpath_encode = make_encode(str(Path(dpath) / "encode.avi"), args.codec, args.gop_size, args.duration)
+        with AVIReader(fpath_encode) as reader:
+            header = reader.header
+            packets = list(reader.packets())
+
+        fpath_out = str(Path(dpath) / "rewritten.avi")
+        with AVIWriter(fpath_out, header.copy(), riff_size_limit=args.riff_size_limit) as writer:
+            writer.write_all(packets)
+
+        start = time.perf_counter()
+        with AVIReader(fpath_out) as reader:
+            packets_out = list(reader.packets())
+        seconds = time.perf_counter() - start
+        keyframes_index = PacketIndex.build(fpath_out).keyframes.tolist()
+
+        keyframes = [packet.keyframe for packet in packets]
+        n_keyframes = sum(keyframes)
+        print(f"{len(packets)} packets, {n_keyframes} keyframes, {count_riffs(fpath_out)} RIFFs, "
+              f"read back in {seconds:.3f}s")
+        assert 0 < n_keyframes < len(packets), "the test pattern needs keyframes and non-keyframes"
+        assert [packet.data for packet in packets_out] == [packet.data for packet in packets], "packets differ"
+        assert [packet.keyframe for packet in packets_out] == keyframes, "keyframe flags differ"
+        assert keyframes_index == keyframes, "keyframe flags of the packet index differ"
+        print("round trip OK")
+    finally:
+        shutil.rmtree(dpath)
+
+
+if __name__ == "__main__":
+    main()
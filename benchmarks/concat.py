@@ -0,0 +1,95 @@
+""" Benchmarks concat_videos backends on long slice lists
+
+    python benchmarks/concat.py --sizes 1000 10000 100000
+
+    Each list repeats a handful of short slices, stored under a deep directory
+    so paths are about as long as the ones in ~/.cache/compressure.
+"""
+from argparse import ArgumentParser
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+from compressure.dataproc import ConcatDefaults, concat_videos, try_subprocess
+from compressure.exceptions import SubprocessError
+
+
+def make_slices(dpath, n_slices=8, superframe_size=6):
+    """ Encodes a short test pattern and cuts it into superframe-sized slices
+    """
+    dpath = Path(dpath) / "slices" / "transcoded_g=6000_libx264_preset=veryfast_qp=31_bf=0_pix-fmt=yuv420p"
+    dpath = dpath / f"superframe-size={superframe_size}"
+    os.makedirs(dpath, exist_ok=True)
+    fpath_encode = str(dpath.parent / "encode.avi")
+    try_subprocess([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc=size=320x240:rate=24:duration={n_slices * superframe_size / 24 + 1}",
+        "-c:v", "libx264", "-preset", "veryfast", "-bf", "0", "-g", "6000",
+        fpath_encode,
+    ])
+
+    fpaths = []
+    for i in range(n_slices):
+        fpath = str(dpath / f"slice_{i}.avi")
+        try_subprocess([
+            "ffmpeg", "-y", "-v", "error",
+            "-i", fpath_encode,
+            "-c", "copy",
+            "-ss", f"{i * superframe_size / 24:.6f}",
+            "-t", f"{superframe_size / 24:.6f}",
+            "-copyinkf",
+            fpath,
+        ])
+        fpaths.append(fpath)
+    return fpaths
+
+
+def time_concat(videos_list, fpath_out, method):
+    start = time.perf_counter()
+    try:
+        concat_videos(videos_list, fpath_out=fpath_out, method=method)
+    except (OSError, SubprocessError) as e:
+        return None, str(e).splitlines()[0][:80]
+    return time.perf_counter() - start, None
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        default=[1000, 10000, 100000],
+        type=int,
+        nargs="+",
+        help="numbers of slices to concatenate"
+    )
+    parser.add_argument(
+        "--methods",
+        default=list(ConcatDefaults.method_options),
+        nargs="+",
+        help=f"concat methods to compare, any of {ConcatDefaults.method_options}"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    dpath = tempfile.mkdtemp(prefix="compressure_bench_")
+    try:
+        slices = make_slices(dpath)
+        print(f"{'n_slices':>10} {'method':>10} {'seconds':>10} {'slices/s':>10}")
+        for size in args.sizes:
+            videos_list = [slices[i % len(slices)] for i in range(size)]
+            for method in args.methods:
+                seconds, error = time_concat(videos_list, str(Path(dpath) / f"output_{method}.avi"), method)
+                if error is None:
+                    print(f"{size:>10} {method:>10} {seconds:>10.2f} {size / seconds:>10.0f}")
+                else:
+                    print(f"{size:>10} {method:>10} {'failed':>10}  {error}")
+    finally:
+        shutil.rmtree(dpath)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+""" Checks that VideoSlicer.slice_video writes every slice it lists, without a
+    packet index or completion bitmap (as VideoCompressureValve slices), and
+    times each engine
+
+    python benchmarks/slice_video.py --n_frames 60 --superframe_size 6
+
+    An encode of N frames has N - superframe_size + 1 slices, the last of
+    which starts superframe_size frames before the end.
+"""
+from argparse import ArgumentParser
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+from compressure.dataproc import try_subprocess
+from compressure.slicing import VideoSlicer, VideoSlicerDefaults
+
+
+def make_encode(fpath, n_frames):
+    """ Encodes n_frames of test pattern
+    """
+    try_subprocess([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", "testsrc=size=320x240:rate=24",
+        "-frames:v", str(n_frames),
+        "-c:v", "mpeg4", "-g", "6",
+        fpath,
+    ])
+    return fpath
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--n_frames",
+        default=60,
+        type=int,
+        help="frames in the test encode"
+    )
+    parser.add_argument(
+        "--superframe_size",
+        default=6,
+        type=int,
+        help="frames per slice"
+    )
+    parser.add_argument(
+        "--engines",
+        default=list(VideoSlicerDefaults.engine_options),
+        nargs="+",
+        help=f"slicing engines to check, any of {VideoSlicerDefaults.engine_options}"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    dpath = tempfile.mkdtemp(prefix="compressure_bench_")
+    try:
+        fpath_encode = make_encode(str(Path(dpath) / "encode.avi"), args.n_frames)
+        n_slices = args.n_frames - args.superframe_size + 1
+        for engine in args.engines:
+            workdir = str(Path(dpath) / engine)
+            slicer = VideoSlicer(fpath_encode, superframe_size=args.superframe_size, workdir=workdir)
+            start = time.perf_counter()
+            slicer.slice_video(engine=engine)
+            seconds = time.perf_counter() - start
+
+            missing = [fpath for fpath in slicer.slices if not os.path.exists(fpath)]
+            print(f"{engine:>8}: {len(slicer.slices)} slices in {seconds:.2f}s, {len(missing)} missing")
+            assert len(slicer.slices) == n_slices, f"expected {n_slices} slices, got {len(slicer.slices)}"
+            assert len(missing) == 0, f"listed but never written: {missing[:5]}"
+        print("slices OK")
+    finally:
+        shutil.rmtree(dpath)
+
+
+if __name__ == "__main__":
+    main()
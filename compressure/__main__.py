@@ -0,0 +1,11 @@
+""" `python -m compressure cache gc|status ...` manages the cache (see
+    cache.py), anything else runs compressure as main.py would
+"""
+import sys
+
+if len(sys.argv) > 1 and sys.argv[1] == "cache":
+    from compressure.cache import main as cache_main
+    cache_main(sys.argv[2:])
+else:
+    from compressure.main import main
+    main()
@@ -0,0 +1,293 @@
+from argparse import ArgumentParser
+import logging
+import os
+import re
+import time
+from typing import Optional, Sequence
+
+from compressure.persistence import CompressurePersistence, size_on_disk
+
+
+class CacheDefaults(object):
+    # Bytes that encodes and slices may take up in the cache, None for no limit
+    budget = None
+    # Entries used more recently than this many seconds ago are never
+    # evicted, since another process may be using them right now
+    grace_period = 600.0
+    size_units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_size(size: str) -> int:
+    """ Parses a size like 500M, 20G or 1.5T (powers of 1024) into bytes
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([KMGT]?)(?:i?B)?\s*", str(size), flags=re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"can't parse size {size}, expected something like 500M, 20G or 1.5T")
+
+    unit = match.group(2).upper()
+    return int(float(match.group(1)) * CacheDefaults.size_units.get(unit, 1))
+
+
+def format_size(size: int) -> str:
+    for unit, n_bytes in reversed(CacheDefaults.size_units.items()):
+        if size >= n_bytes:
+            return f"{size / n_bytes:.1f}{unit}"
+    return f"{size}B"
+
+
+class CacheManager(object):
+    """ Keeps the encodes and slices in the cache within a byte budget by
+        evicting what was used least recently. Slice sets go first, since
+        they're cheaper to rebuild than encodes, and an encode goes along with
+        its slice sets. Everything is removed through persistence, so the
+        manifest never lists files that are gone
+    """
+    def __init__(self, persistence: CompressurePersistence,
+                 budget: Optional[int] = CacheDefaults.budget,
+                 grace_period: float = CacheDefaults.grace_period,
+                 verbosity: int = 0):
+        """ Parameters:
+                - persistence: cache to manage
+                - budget: bytes encodes and slices may take up, None for no limit
+                - grace_period: seconds since last use before an entry can be
+                  evicted
+                - verbosity: print log messages too
+        """
+        self.persistence = persistence
+        self.budget = budget
+        self.grace_period = grace_period
+        self.verbosity = verbosity
+
+    def _log_print(self, msg, log_op):
+        if self.verbosity > 0:
+            print(msg)
+
+        log_op(msg)
+
+    def entries(self) -> list:
+        """ Every encode and slice set in the cache (see
+            CompressureManifest.usage), least recently used first, with their
+            sizes measured again. Entries used before usage was tracked count
+            as last used when their files were last modified. Nothing is
+            written to the manifest, see record_sizes
+        """
+        entries = self.persistence.manifest.usage()
+        for entry in entries:
+            if entry['superframe_size'] is None:
+                encode = self.persistence.get_encode(None, entry['encode'], source_name=entry['source'])
+                size = size_on_disk(entry['fpath'], encode.get('index'))
+            else:
+                size = size_on_disk(entry['fpath'])
+            entry['size'] = size
+
+            if entry['last_access'] is None:
+                entry['last_access'] = os.path.getmtime(entry['fpath']) if os.path.exists(entry['fpath']) else 0.0
+
+        return sorted(entries, key=lambda entry: entry['last_access'])
+
+    def record_sizes(self, entries: list):
+        """ Saves the sizes entries measured to the manifest, where they've
+            changed
+        """
+        recorded = {self._key(entry): entry['size'] for entry in self.persistence.manifest.usage()}
+        for entry in entries:
+            if recorded.get(self._key(entry)) != entry['size']:
+                self.persistence.manifest.record_usage(
+                    entry['source'], entry['encode'], entry['superframe_size'], size=entry['size']
+                )
+
+    def prune(self, dry_run: bool = False) -> list:
+        """ Removes entries whose files are gone (deleted outside of
+            compressure) from the manifest
+            Returns:
+                - the entries removed
+        """
+        pruned = [entry for entry in self.persistence.manifest.usage() if not os.path.exists(entry['fpath'])]
+        # Slice sets first, since removing an encode removes its slice sets
+        pruned.sort(key=lambda entry: entry['superframe_size'] is None)
+        if not dry_run:
+            for entry in pruned:
+                self._remove(entry)
+
+        for entry in pruned:
+            self._log_print(f"Pruned missing {self._describe(entry)}", logging.info)
+        return pruned
+
+    def gc(self, budget: Optional[int] = None, dry_run: bool = False) -> dict:
+        """ Prunes missing entries, then evicts least recently used slice sets,
+            then encodes, until the cache is within budget
+            Parameters:
+                - budget: overrides self.budget. With neither, only prunes
+                - dry_run: report what would be removed, without changing anything
+            Returns:
+                - stats: sizes before and after, budget, and the entries
+                  pruned and evicted
+        """
+        budget = self.budget if budget is None else budget
+        pruned = self.prune(dry_run=dry_run)
+        pruned_keys = {self._key(entry) for entry in pruned}
+        entries = [entry for entry in self.entries() if self._key(entry) not in pruned_keys]
+        if not dry_run:
+            self.record_sizes(entries)
+
+        size = sum(entry['size'] for entry in entries)
+        stats = {
+            'size_before': size,
+            'size_after': size,
+            'budget': budget,
+            'pruned': pruned,
+            'evicted': [],
+        }
+        if budget is None or size <= budget:
+            return stats
+
+        time_now = time.time()
+        slice_sets = {}
+        for entry in entries:
+            if entry['superframe_size'] is not None:
+                slice_sets.setdefault((entry['source'], entry['encode']), []).append(entry)
+
+        def evictable(entry):
+            return time_now - entry['last_access'] >= self.grace_period
+
+        evicted = set()
+        candidates = [entry for entry in entries if entry['superframe_size'] is not None]
+        candidates += [entry for entry in entries if entry['superframe_size'] is None]
+        for entry in candidates:
+            if size <= budget:
+                break
+            if not evictable(entry) or self._key(entry) in evicted:
+                continue
+
+            # An encode goes with its slice sets, so it stays if any of them
+            # is still in use
+            removed = [entry]
+            if entry['superframe_size'] is None:
+                encode_slice_sets = slice_sets.get((entry['source'], entry['encode']), [])
+                if not all(evictable(slice_set) for slice_set in encode_slice_sets):
+                    continue
+                removed += [slice_set for slice_set in encode_slice_sets if self._key(slice_set) not in evicted]
+
+            if not dry_run:
+                self._remove(entry)
+            for removed_entry in removed:
+                evicted.add(self._key(removed_entry))
+                size -= removed_entry['size']
+            stats['evicted'].append(entry)
+            self._log_print(
+                f"{'Would evict' if dry_run else 'Evicted'} {self._describe(entry)}, "
+                f"{format_size(sum(removed_entry['size'] for removed_entry in removed))}",
+                logging.info
+            )
+
+        stats['size_after'] = size
+        if size > budget:
+            self._log_print(
+                f"Cache is {format_size(size)}, over its {format_size(budget)} budget, but everything left "
+                f"was used in the last {self.grace_period:.0f}s",
+                logging.warning
+            )
+        return stats
+
+    def enforce(self) -> Optional[dict]:
+        """ Runs gc if there's a budget to keep to
+        """
+        if self.budget is None:
+            return None
+        return self.gc()
+
+    def _remove(self, entry: dict):
+        # Entries carry manifest names, which aren't paths
+        if entry['superframe_size'] is None:
+            self.persistence.remove_encode(None, entry['encode'], source_name=entry['source'])
+        else:
+            self.persistence.remove_slices(
+                None, entry['encode'], entry['superframe_size'], source_name=entry['source']
+            )
+
+    @staticmethod
+    def _key(entry: dict) -> tuple:
+        return (entry['source'], entry['encode'], entry['superframe_size'])
+
+    @staticmethod
+    def _describe(entry: dict) -> str:
+        if entry['superframe_size'] is None:
+            return f"encode {entry['encode']} of {entry['source']}"
+        return f"slices of {entry['encode']} with superframe-size {entry['superframe_size']}"
+
+
+def print_status(manager: CacheManager):
+    entries = manager.entries()
+    time_now = time.time()
+    for entry in entries:
+        superframe_size = "" if entry['superframe_size'] is None else entry['superframe_size']
+        hours = (time_now - entry['last_access']) / 3600
+        print(f"{format_size(entry['size']):>8}  {hours:8.1f}h ago  "
+              f"{entry['source']}  {entry['encode']}  {superframe_size}")
+
+    size = sum(entry['size'] for entry in entries)
+    budget = "no" if manager.budget is None else format_size(manager.budget)
+    print(f"{len(entries)} entries, {format_size(size)} total, {budget} budget")
+
+
+def parse_args(argv: Optional[Sequence[str]] = None):
+    parser = ArgumentParser(
+        prog="compressure cache",
+        description="Inspect or garbage-collect the compressure cache",
+    )
+    parser.add_argument(
+        "command",
+        choices=("gc", "status"),
+        help="gc evicts least recently used entries until the cache fits the budget, "
+             "status lists entries, least recently used first",
+    )
+    parser.add_argument(
+        "--budget",
+        default=CacheDefaults.budget,
+        type=parse_size,
+        help="most space encodes and slices may take up, e.g. 20G. Without it, gc only "
+             "removes manifest entries whose files are gone",
+    )
+    parser.add_argument(
+        "--grace_period",
+        default=CacheDefaults.grace_period,
+        type=float,
+        help="seconds since last use before an entry can be evicted",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="report what gc would remove, without removing it",
+    )
+    parser.add_argument(
+        "--fpath_manifest",
+        default=CompressurePersistence.defaults.fpath_manifest,
+        help="location of manifest database",
+    )
+    parser.add_argument(
+        "--dpath_workdir",
+        default=CompressurePersistence.defaults.workdir,
+        help="location of cached encodes and slices",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    args = parse_args(argv)
+    persistence = CompressurePersistence(
+        fpath_manifest=args.fpath_manifest,
+        workdir=args.dpath_workdir,
+    )
+    manager = CacheManager(persistence, budget=args.budget, grace_period=args.grace_period, verbosity=1)
+
+    if args.command == "status":
+        print_status(manager)
+        return
+
+    stats = manager.gc(dry_run=args.dry_run)
+    print(f"{len(stats['pruned'])} pruned, {len(stats['evicted'])} evicted, "
+          f"{format_size(stats['size_before'])} -> {format_size(stats['size_after'])}")
+
+
+if __name__ == "__main__":
+    main()
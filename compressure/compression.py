@@ -1,13 +1,24 @@
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from copy import deepcopy
+import hashlib
+import json
 import logging
+import math
 import os
 from pathlib import Path
 from pprint import pformat
-from typing import Optional, Union
-
-from compressure.dataproc import try_subprocess
-from compressure.exceptions import EncoderSelectionError
+from queue import Queue
+import shutil
+import subprocess
+import tempfile
+from typing import Callable, Iterator, List, Optional, Sequence, Union
+
+from compressure.dataproc import AVIReader, AVIWriter, run_ffmpeg, VideoMetadata
+from compressure.exceptions import CancelledError, EncoderSelectionError, SubprocessError
+from compressure.processes import ManagedProcess, stage, using
+from compressure.file_interface import ContentHashDefaults, content_hash
 from compressure.persistence import VideoCompressionPersistence, VideoCompressionPersistenceDefaults
 
 MaybePathLike = Union[os.PathLike, str]
@@ -31,8 +42,32 @@ class VideoCompressionDefaults(object):
             "bitrate": "10M",
         },
     }
+    # -sc_threshold that keeps each encoder from adding keyframes at scene
+    # cuts, so they only come every gop_size frames. ffmpeg's own encoders
+    # (mpeg4) only stop at an absurdly high threshold, libx264 at 0
+    scenecut_disabled = {
+        "mpeg4": "1000000000",
+        "libx264": "0",
+    }
     fps = (24000, 1001)
     pix_fmt = "yuv420p"
+    # Segmented encodes (see SingleVideoCompression.transcode_segments) cut
+    # the source into segments of whole GOPs, at least this many frames long,
+    # so each encoder has enough to get going
+    segment_min_frames = 240
+    # Segments per concurrent encoder, so one slow segment doesn't hold up
+    # the rest at the end
+    segments_per_worker = 2
+    # Drafts are proxies for trying out settings quickly: downscaled by
+    # draft_scale and, for libx264, encoded with draft_preset
+    draft_scale = 0.25
+    draft_preset = "ultrafast"
+    # Seconds to wait for ffmpeg to exit when reading a transcode stream (see
+    # SingleVideoCompression.transcode_stream) fails, before killing it
+    stream_exit_timeout = 1.0
+    # Seconds a single ffmpeg encode may run, None for no limit. Stages can
+    # be given a timeout of their own (see processes.stage)
+    transcode_timeout = None
 
     @classmethod
     def fallback(cls, encoder, specified_options):
@@ -92,6 +127,9 @@ class SingleVideoCompression(object):
         encoder_config: Optional[dict] = None,
         workdir: MaybePathLike = VideoCompressionDefaults.workdir,
         pix_fmt: Optional[str] = None,
+        threads: Optional[int] = None,
+        segmented: bool = False,
+        scale: Optional[float] = None,
         **kwargs: dict,
     ):
 
@@ -101,6 +139,12 @@ class SingleVideoCompression(object):
         self.encoder = VideoCompressionDefaults.encoder if encoder is None else encoder
         self.gop_size = VideoCompressionDefaults.gop_size if gop_size is None else gop_size
         self.pix_fmt = VideoCompressionDefaults.pix_fmt if pix_fmt is None else pix_fmt
+        # Encoder threads, or None for ffmpeg's choice. Doesn't change what's
+        # encoded, so it isn't part of config_hash
+        self.threads = threads
+        # Encode GOP-aligned segments of the source at once, see
+        # transcode_segments. Also leaves what's encoded unchanged
+        self.segmented = segmented
 
         self.encoder_config_dict = VideoCompressionDefaults.fallback(
             self.encoder,
@@ -108,7 +152,9 @@ class SingleVideoCompression(object):
         )
 
         self.crop_square = False
-        self.fpath_out = self.generate_human_readable_fpath()
+        # Factor to resize the video by, None to keep its size
+        self.scale = None if scale is None else float(scale)
+        self.fpath_out = self.generate_content_addressed_fpath()
         self._transcode_command_list = self.generate_ffmpeg_command()
 
     @property
@@ -137,6 +183,9 @@ class SingleVideoCompression(object):
         if self.crop_square:
             human_readable_name += "_cropped-square"
 
+        if self.scale is not None:
+            human_readable_name += f"_scale={self.scale}"
+
         human_readable_name += f"_pix-fmt={self.pix_fmt}"
         human_readable_name += ".avi"
 
@@ -148,6 +197,45 @@ class SingleVideoCompression(object):
 
         return fpath_out
 
+    @property
+    def source_hash(self) -> str:
+        """ Hash of the source's contents, see file_interface.content_hash
+        """
+        return content_hash(self.fpath_in)
+
+    @property
+    def config_hash(self) -> str:
+        """ Hash of everything that shapes the encode besides its source.
+            Values are compared as strings, so a setting from the command line
+            matches the same default
+        """
+        config = {
+            'encoder': self.encoder,
+            'gop_size': str(self.gop_size),
+            'encoder_config': {key: str(val) for key, val in self.encoder_config_dict.items()},
+            'pix_fmt': str(self.pix_fmt),
+            'crop_square': self.crop_square,
+        }
+        # Only there when set, so unscaled encodes keep the names they had
+        # before scaling existed
+        if self.scale is not None:
+            config['scale'] = str(self.scale)
+        # Encodes from before GOPs were fixed may have keyframes at scene cuts
+        config['fixed_gop'] = True
+        payload = json.dumps(config, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(payload.encode(), digest_size=ContentHashDefaults.digest_size).hexdigest()
+
+    def generate_content_addressed_name(self):
+        """ Names the encode for what goes into it rather than what the source
+            is called, so the same source (renamed, moved or on another
+            machine) with the same settings always finds the same encode, and
+            two different sources with the same name never share one
+        """
+        return f"{self.source_hash}_{self.encoder}_{self.config_hash}.avi"
+
+    def generate_content_addressed_fpath(self):
+        return str(Path(self.workdir) / self.generate_content_addressed_name())
+
     def generate_ffmpeg_encoding_params(self, override_dict={}):
         # Ingest specified args, falling back onto defaults if necessary
         configs = VideoCompressionDefaults.fallback(self.encoder, override_dict)
@@ -167,40 +255,247 @@ class SingleVideoCompression(object):
             ])
         return ffmpeg_args
 
-    def generate_ffmpeg_command(self):
+    def generate_ffmpeg_command(
+        self,
+        fpath_out: Optional[str] = None,
+        start: Optional[str] = None,
+        n_frames: Optional[int] = None,
+        threads: Optional[int] = None,
+    ):
+        """ Parameters:
+                - fpath_out: output, self.fpath_out if None
+                - start: seconds into the source to start at, if given
+                - n_frames: most frames to encode, if given
+                - threads: encoder threads, self.threads if None
+        """
+        fpath_out = self.fpath_out if fpath_out is None else fpath_out
+        threads = self.threads if threads is None else threads
+
         # Start construction of FFmpeg command
-        command = [
-            "ffmpeg", "-y",
-            "-v", "error",
+        command = ["ffmpeg", "-y", "-v", "error"]
+        if start is not None:
+            command.extend(["-ss", start])
+
+        command.extend([
             "-i", str(self.fpath_in),
             "-g", str(self.gop_size),
+            "-keyint_min", str(self.gop_size),
+        ])
+        # A keyframe every gop_size frames and nowhere else. Keyframes at
+        # scene cuts would land wherever they happen to in each segment, so
+        # segmented encodes wouldn't match unsegmented ones
+        if self.encoder in VideoCompressionDefaults.scenecut_disabled:
+            command.extend(["-sc_threshold", VideoCompressionDefaults.scenecut_disabled[self.encoder]])
+
+        command.extend([
             "-strict", "-2",
             "-an",
             "-c:v",
-        ]
+        ])
 
         # Generate and populate encoding params
         encoder_params = self.generate_ffmpeg_encoding_params()
         command.extend(encoder_params)
 
+        # ffmpeg only takes one filter option per stream, so filters are chained
+        filters = []
         if self.crop_square:
-            command.extend([
-                "-filter:v",
-                '"crop=ih:ih"'
-            ])
+            filters.append("crop=ih:ih")
+
+        if self.scale is not None:
+            # Even dimensions, which chroma subsampled pix_fmts need
+            filters.append(f"scale=trunc(iw*{self.scale}/2)*2:trunc(ih*{self.scale}/2)*2")
+
+        if len(filters) > 0:
+            command.extend(["-filter:v", ",".join(filters)])
 
         if self.pix_fmt is not None:
             command.extend(['-pix_fmt', self.pix_fmt])
 
-        command.append(self.fpath_out)
+        if threads is not None:
+            command.extend(['-threads', str(threads)])
+
+        if n_frames is not None:
+            command.extend(['-frames:v', str(n_frames)])
+
+        command.append(fpath_out)
 
         return command
 
     def transcode_video(self):
+        """ Transcodes the video, which only appears at fpath_out once it's
+            complete, so a file there can always be trusted as the encode
+        """
         logging.info(f"Running command: `{self.transcode_command}`")
-        process = try_subprocess(self._transcode_command_list)
+        fpath_out = Path(self.fpath_out)
+        fpath_partial = str(fpath_out.with_name(f".{fpath_out.stem}.{os.getpid()}.partial{fpath_out.suffix}"))
+        try:
+            if self.segmented:
+                process = self.transcode_segments(fpath_partial)
+            else:
+                process = run_ffmpeg(
+                    self.generate_ffmpeg_command(fpath_out=fpath_partial),
+                    n_frames=self.n_frames_source,
+                    desc=f"{self.encoder} {Path(self.fpath_in).name}",
+                    timeout=VideoCompressionDefaults.transcode_timeout,
+                )
+        except BaseException:
+            if os.path.exists(fpath_partial):
+                os.remove(fpath_partial)
+            raise
+        os.replace(fpath_partial, self.fpath_out)
         return self.fpath_out, process
 
+    @property
+    def n_frames_source(self) -> int:
+        """ Number of frames in the source, as near as its duration tells
+        """
+        metadata = VideoMetadata(self.fpath_in)
+        return int(metadata.duration * metadata.framerate)
+
+    def plan_segments(self, n_workers: int) -> List[tuple]:
+        """ Cuts the source into segments of whole GOPs, about
+            segments_per_worker for each of n_workers, so every segment starts
+            on a keyframe an unsegmented encode would also have (keyframes
+            come every gop_size frames and nowhere else, see
+            generate_ffmpeg_command)
+            Returns:
+                - (first frame, number of frames) of each segment. The last
+                  runs to the end of the source, however long it turns out
+                  to be, so its number of frames is None
+        """
+        n_frames = self.n_frames_source
+        gop_size = int(self.gop_size)
+
+        n_frames_segment = max(
+            VideoCompressionDefaults.segment_min_frames,
+            n_frames / (n_workers * VideoCompressionDefaults.segments_per_worker)
+        )
+        n_frames_segment = gop_size * math.ceil(n_frames_segment / gop_size)
+        # Rounded down, so the last segment can't start past the end even if
+        # the duration is a little off
+        n_segments = max(1, n_frames // n_frames_segment)
+
+        segments = [(i * n_frames_segment, n_frames_segment) for i in range(n_segments)]
+        segments[-1] = (segments[-1][0], None)
+        return segments
+
+    def transcode_segments(self, fpath_out: str) -> List[subprocess.CompletedProcess]:
+        """ Transcodes GOP-aligned segments of the source as separate ffmpeg
+            processes, sharing self.threads (or every core) between them (see
+            EncodeScheduler), and stitches their packets into fpath_out.
+            Every segment starts on one of the encode's keyframes, and those
+            come every gop_size frames regardless of scene cuts, so the
+            stitched encode has the same frames and keyframes as one made
+            in a single pass. Segments are found by frame rate, so a source
+            with a variable frame rate is transcoded in a single pass
+            Returns:
+                - the finished ffmpeg process of each segment
+        """
+        metadata = VideoMetadata(self.fpath_in)
+        scheduler = EncodeScheduler(self.threads, min_threads=1)
+        segments = self.plan_segments(scheduler.n_cores)
+        if metadata.variable_framerate:
+            logging.warning(f"{self.fpath_in} has a variable frame rate, so its segments can't be found by "
+                            f"frame rate. Transcoding it in a single pass")
+        if len(segments) == 1 or metadata.variable_framerate:
+            return [run_ffmpeg(
+                self.generate_ffmpeg_command(fpath_out=fpath_out),
+                n_frames=self.n_frames_source,
+                desc=f"{self.encoder} {Path(self.fpath_in).name}",
+                timeout=VideoCompressionDefaults.transcode_timeout,
+            )]
+
+        framerate_fractional = metadata.framerate_fractional
+
+        fpath_out = Path(fpath_out)
+        dpath_segments = fpath_out.with_name(f".{fpath_out.stem}.segments")
+        os.makedirs(dpath_segments, exist_ok=True)
+        fpaths_segment = [str(dpath_segments / f"{i:05d}.avi") for i in range(len(segments))]
+
+        def transcode_segment(i, threads):
+            start_frame, n_frames = segments[i]
+            start = None
+            if start_frame > 0:
+                # Rounded down to the microsecond, so ffmpeg's frame-accurate
+                # seek never skips the segment's first frame, yet lands well
+                # within it so its timestamps start at zero
+                start_us = start_frame * framerate_fractional[1] * 1000000 // framerate_fractional[0]
+                start = f"{start_us // 1000000}.{start_us % 1000000:06d}"
+            return run_ffmpeg(
+                self.generate_ffmpeg_command(
+                    fpath_out=fpaths_segment[i],
+                    start=start,
+                    n_frames=n_frames,
+                    threads=threads,
+                ),
+                n_frames=self.n_frames_source - start_frame if n_frames is None else n_frames,
+                desc=f"{self.encoder} {Path(self.fpath_in).name} segment {i}",
+                timeout=VideoCompressionDefaults.transcode_timeout,
+                fpaths_output=[fpaths_segment[i]],
+            )
+
+        logging.info(f"Transcoding {self.fpath_in} in {len(segments)} segments: {segments}")
+        try:
+            processes = scheduler.map(transcode_segment, list(range(len(segments))))
+
+            with AVIReader(fpaths_segment[0]) as reader:
+                header = reader.header
+            with AVIWriter(str(fpath_out), header) as writer:
+                for fpath_segment in fpaths_segment:
+                    with AVIReader(fpath_segment) as reader:
+                        writer.write_all(reader.packets())
+        finally:
+            shutil.rmtree(dpath_segments, ignore_errors=True)
+
+        return processes
+
+    @contextmanager
+    def transcode_stream(self) -> Iterator[AVIReader]:
+        """ Transcodes the video into a pipe rather than a file, for encodes
+            that are only needed once. Yields a reader of ffmpeg's AVI output
+            as it's encoded. Whatever isn't read is drained on the way out, so
+            a failed encode is raised rather than mistaken for a short one
+        """
+        command = self.generate_ffmpeg_command(fpath_out="pipe:1")
+        command[-1:-1] = ["-f", "avi"]
+        logging.info(f"Running command: `{' '.join(command)}`")
+
+        with tempfile.TemporaryFile() as stderr, ManagedProcess(
+            command,
+            timeout=VideoCompressionDefaults.transcode_timeout,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        ) as managed:
+            process = managed.popen
+
+            def error():
+                stderr.seek(0)
+                return SubprocessError(subprocess.CompletedProcess(
+                    command, process.returncode, stderr=stderr.read().decode(errors="replace")
+                ))
+
+            try:
+                with AVIReader(process.stdout) as reader:
+                    yield reader
+                while process.stdout.read(1 << 20):
+                    pass
+                process.wait()
+            except BaseException as e:
+                # A broken stream is most likely ffmpeg failing, and then its
+                # error is the one worth raising. If ffmpeg is still running,
+                # it's killed on the way out
+                try:
+                    process.wait(timeout=VideoCompressionDefaults.stream_exit_timeout)
+                except subprocess.TimeoutExpired:
+                    raise e
+                if process.returncode != 0:
+                    raise error() from e
+                raise
+
+            if process.returncode != 0:
+                raise error()
+
     @property
     def transcode_command(self):
         return ' '.join([str(x) for x in self._transcode_command_list])
@@ -217,6 +512,80 @@ class SingleVideoCompression(object):
         return s
 
 
+class EncodeSchedulerDefaults(object):
+    # Cores all running encodes share
+    n_cores = os.cpu_count() or 1
+    # Fewest threads an encode is given, which bounds how many run at once.
+    # Encoders scale well to a few threads, so a couple of encodes with a few
+    # threads each beats many single-threaded ones
+    min_threads = 2
+
+
+class EncodeScheduler(object):
+    """ Runs several encodes at once within a budget of cores. The budget is
+        split into slots, one per concurrent encode, and each encode is told to
+        use its slot's share of threads, so the cores are kept busy without
+        encoders fighting over them. A pair of sources takes about as long as
+        the longer of the two
+    """
+    def __init__(self, n_cores: Optional[int] = None,
+                 min_threads: int = EncodeSchedulerDefaults.min_threads):
+        """ Parameters:
+                - n_cores: cores to share, all of them if None
+                - min_threads: fewest threads an encode is given
+        """
+        self.n_cores = max(1, EncodeSchedulerDefaults.n_cores if n_cores is None else n_cores)
+        self.min_threads = max(1, min_threads)
+
+    def slots(self, n_jobs: int) -> List[int]:
+        """ Threads of each concurrent encode, for n_jobs encodes. Cores that
+            don't divide evenly go to the first slots
+        """
+        n_slots = max(1, min(n_jobs, self.n_cores // self.min_threads))
+        threads, remainder = divmod(self.n_cores, n_slots)
+        return [threads + (i < remainder) for i in range(n_slots)]
+
+    def map(self, function: Callable, jobs: Sequence) -> list:
+        """ Runs function(job, threads) for every job, as many at once as
+            there are slots
+            Returns:
+                - results, in the order of jobs. The first failure is raised,
+                  once every job has finished
+        """
+        slots = Queue()
+        for threads in self.slots(len(jobs)):
+            slots.put(threads)
+
+        logging.info(f"Encoding {len(jobs)} videos with {self.slots(len(jobs))} threads at once")
+        with stage("encodes") as token:
+            def run(job):
+                threads = slots.get()
+                try:
+                    with using(token):
+                        return function(job, threads)
+                except BaseException as e:
+                    # The other jobs are stopped rather than finished, which
+                    # frees their slots
+                    token.cancel(f"{e.__class__.__name__} in another encode")
+                    raise
+                finally:
+                    slots.put(threads)
+
+            try:
+                with ThreadPoolExecutor(max_workers=slots.qsize()) as executor:
+                    futures = [executor.submit(run, job) for job in jobs]
+            except BaseException as e:
+                token.cancel(f"{e.__class__.__name__} while encoding")
+                raise
+
+        # The failure that cancelled the rest is the one worth raising
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        causes = [error for error in errors if not isinstance(error, CancelledError)]
+        if len(errors) > 0:
+            raise (causes + errors)[0]
+        return [future.result() for future in futures]
+
+
 def parse_args():
     parser = ArgumentParser()
     parser.add_argument(
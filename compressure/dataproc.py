@@ -1,24 +1,234 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from copy import deepcopy
+from itertools import chain
+import json
 import logging
 import os
 from pathlib import Path
+import re
+import select
+import shutil
+import socket
+import sqlite3
+import stat
+import struct
 import subprocess
-from typing import Sequence
+import sys
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, Optional, Sequence, Union
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from tqdm import tqdm
 
 from compressure.exceptions import InferredAttributeFromFileError, SubprocessError
+from compressure.persistence import VideoPersistenceDefaults
+from compressure.processes import current_token, ManagedProcess, ManagedProcessDefaults, using
 
 
 logging.basicConfig(filename='.dataproc.log', level=logging.DEBUG)
 
 
 def try_subprocess(
-    command: Sequence[str]
+    command: Sequence[str],
+    timeout: Optional[float] = None,
+    fpaths_output: Sequence[str] = (),
 ) -> subprocess.CompletedProcess:
-    process = subprocess.run(command, capture_output=True, encoding='utf-8')
+    """ Runs command as a managed process (see ManagedProcess), capturing its
+        output, and raises SubprocessError if it fails
+        Parameters:
+            - command: command to run
+            - timeout: seconds it may run, None for no limit
+            - fpaths_output: files it writes, removed unless it succeeds
+    """
+    with ManagedProcess(command, timeout=timeout, fpaths_output=fpaths_output,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8') as managed:
+        stdout, stderr = managed.popen.communicate()
+    process = subprocess.CompletedProcess(managed.popen.args, managed.popen.returncode, stdout, stderr)
     if process.returncode != 0:
         raise SubprocessError(process)
     return process
 
 
+class FFmpegProgressDefaults(object):
+    # Seconds without a progress report before a job is logged as stalled.
+    # ffmpeg reports about twice a second while it's working
+    stall_timeout = 60.0
+    # Fields of ffmpeg's progress reports that are kept, and their types
+    fields = {
+        'frame': int,
+        'fps': float,
+        'bitrate': str,
+        'total_size': int,
+        'out_time_us': int,
+        'dup_frames': int,
+        'drop_frames': int,
+    }
+
+
+# Called with every progress report of every run_ffmpeg call
+_progress_listeners = []
+
+
+def add_progress_listener(listener: Callable[[dict], None]):
+    """ Has listener called with every progress report (see run_ffmpeg), from
+        whichever thread is running ffmpeg
+    """
+    _progress_listeners.append(listener)
+
+
+def remove_progress_listener(listener: Callable[[dict], None]):
+    if listener in _progress_listeners:
+        _progress_listeners.remove(listener)
+
+
+def _notify_progress(report: dict):
+    for listener in list(_progress_listeners):
+        try:
+            listener(report)
+        except Exception:
+            logging.exception(f"ffmpeg progress listener {listener} failed")
+
+
+def _progress_report(block: dict, process: subprocess.Popen, desc: str,
+                     n_frames: Optional[int], elapsed: float) -> dict:
+    """ Parses one block of ffmpeg's -progress output into a report
+    """
+    report = {'pid': process.pid, 'desc': desc}
+    for key, field_type in FFmpegProgressDefaults.fields.items():
+        try:
+            report[key] = field_type(block[key])
+        except (KeyError, ValueError):
+            report[key] = None
+
+    try:
+        report['speed'] = float(block.get('speed', '').rstrip('x'))
+    except ValueError:
+        report['speed'] = None
+
+    report['n_frames'] = n_frames
+    report['elapsed'] = elapsed
+    report['eta'] = None
+    if n_frames is not None and report['frame'] is not None and report['fps']:
+        report['eta'] = max(n_frames - report['frame'], 0) / report['fps']
+    report['done'] = block.get('progress') == 'end'
+    return report
+
+
+def run_ffmpeg(
+    command: Sequence[str],
+    n_frames: Optional[int] = None,
+    desc: Optional[str] = None,
+    progress_bar: bool = True,
+    timeout: Optional[float] = None,
+    fpaths_output: Sequence[str] = (),
+) -> subprocess.CompletedProcess:
+    """ Runs an ffmpeg command like try_subprocess, but follows it while it
+        runs through ffmpeg's -progress reports, on a pipe of their own. Each
+        report (frame, fps, bitrate, speed, ETA, see _progress_report) updates
+        a progress bar, is logged as JSON and goes to every listener (see
+        add_progress_listener). A job that stops reporting is logged as
+        stalled. stderr goes to a temporary file rather than memory, and is
+        only read if ffmpeg fails
+        Parameters:
+            - command: ffmpeg command, starting with the binary
+            - n_frames: frames the job will output, if known, for its ETA
+            - desc: what the job is, its output's name by default
+            - progress_bar: show a progress bar
+            - timeout: seconds it may run, None for no limit
+            - fpaths_output: files it writes, removed unless it succeeds
+    """
+    desc = Path(str(command[-1])).name if desc is None else desc
+    read_fd, write_fd = os.pipe()
+    command = [command[0], "-nostats", "-progress", f"pipe:{write_fd}"] + list(command[1:])
+
+    with tempfile.TemporaryFile() as stderr:
+        progress = tqdm(total=n_frames, desc=desc, unit="frame", leave=False, disable=not progress_bar)
+        time_start = time_report = time.perf_counter()
+        report = None
+        pid = None
+        try:
+            with ManagedProcess(
+                command,
+                timeout=timeout,
+                fpaths_output=fpaths_output,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=stderr,
+                pass_fds=(write_fd,),
+            ) as managed:
+                pid = managed.popen.pid
+                # ffmpeg holds the only write end now, so the pipe ends when
+                # ffmpeg does, however that happens
+                os.close(write_fd)
+                write_fd = None
+
+                block = {}
+                pending = b""
+                while True:
+                    ready, _, _ = select.select([read_fd], [], [], FFmpegProgressDefaults.stall_timeout)
+                    if not ready:
+                        logging.warning(json.dumps({
+                            'event': "ffmpeg_stalled",
+                            'pid': pid,
+                            'desc': desc,
+                            'seconds_since_report': time.perf_counter() - time_report,
+                            'frame': None if report is None else report['frame'],
+                        }))
+                        continue
+
+                    data = os.read(read_fd, 1 << 16)
+                    if len(data) == 0:
+                        break
+
+                    *lines, pending = (pending + data).split(b"\n")
+                    for line in lines:
+                        key, _, value = line.decode(errors="replace").strip().partition("=")
+                        block[key] = value.strip()
+                        if key != "progress":
+                            continue
+
+                        time_report = time.perf_counter()
+                        report = _progress_report(block, managed.popen, desc, n_frames, time_report - time_start)
+                        block = {}
+                        if report['frame'] is not None:
+                            progress.update(report['frame'] - progress.n)
+                        progress.set_postfix(fps=report['fps'], speed=report['speed'])
+                        logging.debug(json.dumps({'event': "ffmpeg_progress", **report}))
+                        _notify_progress(report)
+                managed.popen.wait()
+        finally:
+            if write_fd is not None:
+                os.close(write_fd)
+            os.close(read_fd)
+            progress.close()
+            if pid is not None and (report is None or not report['done']):
+                # Listeners still count the job as running otherwise
+                _notify_progress({**(report or {'pid': pid, 'desc': desc}), 'done': True})
+
+        stderr.seek(0)
+        completed = subprocess.CompletedProcess(
+            command, managed.popen.returncode, stdout="", stderr=stderr.read().decode(errors="replace")
+        )
+
+    logging.info(json.dumps({
+        'event': "ffmpeg_done",
+        'pid': pid,
+        'desc': desc,
+        'returncode': completed.returncode,
+        'seconds': time.perf_counter() - time_start,
+        'frame': None if report is None else report['frame'],
+        'speed': None if report is None else report['speed'],
+    }))
+    if completed.returncode != 0:
+        raise SubprocessError(completed)
+    return completed
+
+
 def reverse_video(fpath_in, fpath_out=None):
     """ Reverses video defined by fpath_in and writes to fpath_out if
         specified. If fpath_out isn't specified, it will be identical to
@@ -38,11 +248,70 @@ def reverse_video(fpath_in, fpath_out=None):
         "-vf", "reverse",
         fpath_out
     ]
-    try_subprocess(command)
+    run_ffmpeg(command, fpaths_output=[str(fpath_out)])
     return fpath_out
 
 
-def concat_videos(videos_list, fpath_out="output.avi"):
+class ConcatDefaults(object):
+    # "native" copies packets from AVI slices into the output in-process (see
+    # AVIWriter). "demuxer" streams the slice list to ffmpeg's concat demuxer
+    # through a list file, so argv size doesn't depend on the number of slices.
+    # "protocol" joins every path into a single concat: argument, which hits
+    # the kernel's per-argument limit (128 KiB on Linux) after a few thousand
+    # slices. Native falls back to the demuxer for anything that isn't AVI
+    method = "native"
+    method_options = ("native", "demuxer", "protocol")
+
+
+def concat_videos(videos_list, fpath_out="output.avi", method=None):
+    """ Concatenates videos without re-encoding
+        Parameters:
+            - videos_list: paths of videos to concatenate, in order
+            - fpath_out: output path, container inferred from extension
+            - method: one of ConcatDefaults.method_options
+    """
+    method = ConcatDefaults.method if method is None else method
+    all_avi = all(Path(fpath).suffix.lower() == ".avi" for fpath in videos_list)
+    if is_stream_destination(fpath_out):
+        # Only the native muxer can write as it reads
+        if not all_avi:
+            raise ValueError(f"streaming to {fpath_out} needs AVI slices")
+        method = "native"
+
+    if method == "native":
+        if all_avi:
+            return concat_avi_videos(videos_list, fpath_out)
+        method = "demuxer"
+
+    if method == "demuxer":
+        return _concat_videos_demuxer(videos_list, fpath_out)
+    elif method == "protocol":
+        return _concat_videos_protocol(videos_list, fpath_out)
+    raise ValueError(f"method must be one of {ConcatDefaults.method_options}, not {method}")
+
+
+def concat_avi_videos(videos: Iterable[str], fpath_out: str) -> str:
+    """ Copies the packets of each AVI video into fpath_out, in order, with
+        the native muxer (see write_packets). videos is consumed lazily, one
+        video at a time, so it can be a generator that yields each video as
+        soon as it's been written
+    """
+    videos = iter(videos)
+    fpath_first = next(videos)
+
+    def packets():
+        for fpath in chain([fpath_first], videos):
+            with AVIReader(fpath) as reader:
+                yield from reader.packets()
+
+    with AVIReader(fpath_first) as reader:
+        header = reader.header
+
+    write_packets(packets(), header, fpath_out)
+    return fpath_out
+
+
+def _concat_videos_protocol(videos_list, fpath_out):
     input_videos = f"concat:{'|'.join(videos_list)}"
     command = [
         "ffmpeg", "-y",
@@ -52,7 +321,52 @@ def concat_videos(videos_list, fpath_out="output.avi"):
         "-c:v", "copy",
         fpath_out
     ]
-    try_subprocess(command)
+    run_ffmpeg(command, fpaths_output=[fpath_out])
+    return fpath_out
+
+
+def write_concat_list(videos_list, fid):
+    """ Writes paths in the concat demuxer's list format, one per line
+    """
+    for fpath in videos_list:
+        fpath = str(Path(fpath).expanduser().absolute()).replace("'", "'\\''")
+        fid.write(f"file '{fpath}'\n")
+
+
+def _concat_videos_demuxer(videos_list, fpath_out):
+    with tempfile.NamedTemporaryFile('w', suffix=".txt", prefix="concat_", delete=False) as fid:
+        write_concat_list(videos_list, fid)
+        fpath_list = fid.name
+
+    command = [
+        "ffmpeg", "-y",
+        "-v", "error",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", fpath_list,
+        "-c:a", "copy",
+        "-c:v", "copy",
+        fpath_out
+    ]
+    try:
+        run_ffmpeg(command, fpaths_output=[fpath_out])
+    finally:
+        os.remove(fpath_list)
+    return fpath_out
+
+
+def remux_video(fpath_in, fpath_out):
+    """ Copies all streams of fpath_in into the container implied by fpath_out
+    """
+    command = [
+        "ffmpeg", "-y",
+        "-v", "error",
+        "-i", str(fpath_in),
+        "-c", "copy",
+        "-copyinkf",
+        str(fpath_out)
+    ]
+    run_ffmpeg(command, fpaths_output=[str(fpath_out)])
     return fpath_out
 
 
@@ -100,8 +414,8 @@ def change_speed(fpath_in, fps_new, codec, fpath_out=None):
         fpath_out
     ]
     try:
-        try_subprocess(intermediate_command)
-        try_subprocess(final_command)
+        run_ffmpeg(intermediate_command, fpaths_output=[fpath_intermediate])
+        run_ffmpeg(final_command, fpaths_output=[fpath_out])
     except SubprocessError:
         raise
     else:
@@ -110,34 +424,185 @@ def change_speed(fpath_in, fps_new, codec, fpath_out=None):
     return fpath_out
 
 
+class VideoMetadataDefaults(object):
+    # Fields of the first video stream, all fetched by one ffprobe call
+    stream_entries = ("codec_name", "pix_fmt", "r_frame_rate", "avg_frame_rate", "width", "height", "duration")
+    # Probes are kept here, by path, size and modification time
+    fpath_cache = VideoPersistenceDefaults.workdir / "metadata.db"
+    # Seconds to wait for another process writing to the cache
+    lock_timeout = 60.0
+    # Most ffprobe processes probe_many runs at once. Probing mostly waits on
+    # the process and on disk, so this needn't follow the number of cores
+    n_probe_workers = 8
+
+
+def probe_video(fpath: str) -> dict:
+    """ Probes the first video stream of a file with a single ffprobe call
+        Returns:
+            - the stream's fields (see VideoMetadataDefaults.stream_entries),
+              plus format_duration, the container's duration, for streams
+              that don't have their own
+    """
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", f"stream={','.join(VideoMetadataDefaults.stream_entries)}:format=duration",
+        "-of", "json",
+        str(fpath)
+    ]
+    payload = json.loads(try_subprocess(command, timeout=ManagedProcessDefaults.probe_timeout).stdout)
+    if len(payload.get('streams', [])) == 0:
+        raise ValueError(f"{fpath} has no video stream")
+
+    probe = {key: payload['streams'][0].get(key) for key in VideoMetadataDefaults.stream_entries}
+    probe['format_duration'] = payload.get('format', {}).get('duration')
+    return probe
+
+
+class MetadataCache(object):
+    """ ffprobe results kept on disk, by a file's path, size and modification
+        time, so files are only probed again once they change. The pix_fmt
+        table of each ffmpeg binary is kept the same way (see PixelFormatter).
+        If the cache can't be opened, every lookup misses and nothing is kept
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS probes (
+            fpath TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            probe TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS pix_fmts (
+            fpath_ffmpeg TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            version TEXT,
+            lookup TEXT NOT NULL
+        );
+    """
+    # One per cache file in each process, see shared
+    _shared = {}
+
+    def __init__(self, fpath: Optional[str] = None):
+        self.fpath = str(Path(fpath if fpath is not None else VideoMetadataDefaults.fpath_cache).expanduser())
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(Path(self.fpath).parent, exist_ok=True)
+            self._conn = sqlite3.connect(
+                self.fpath, timeout=VideoMetadataDefaults.lock_timeout, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(self.schema)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"Can't open metadata cache at {self.fpath}, probing without it: {e}")
+            self._conn = None
+
+    @classmethod
+    def shared(cls, fpath: Optional[str] = None) -> "MetadataCache":
+        fpath = str(Path(fpath if fpath is not None else VideoMetadataDefaults.fpath_cache).expanduser())
+        if fpath not in cls._shared:
+            cls._shared[fpath] = cls(fpath)
+        return cls._shared[fpath]
+
+    @staticmethod
+    def _key(fpath_video: str) -> tuple:
+        stat_video = os.stat(fpath_video)
+        return os.path.realpath(fpath_video), stat_video.st_size, stat_video.st_mtime_ns
+
+    def load(self, fpath_video: str) -> Optional[dict]:
+        """ Cached probe of a file, or None if it's never been probed or has
+            changed since
+        """
+        if self._conn is None:
+            return None
+
+        fpath, size, mtime_ns = self._key(fpath_video)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT probe FROM probes WHERE fpath = ? AND size = ? AND mtime_ns = ?",
+                (fpath, size, mtime_ns)
+            ).fetchone()
+        if row is None:
+            return None
+
+        probe = json.loads(row[0])
+        # Probes from before a field was fetched are probed again
+        if any(key not in probe for key in VideoMetadataDefaults.stream_entries):
+            return None
+        return probe
+
+    def store(self, fpath_video: str, probe: dict):
+        if self._conn is None:
+            return
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO probes (fpath, size, mtime_ns, probe) VALUES (?, ?, ?, ?)",
+                self._key(fpath_video) + (json.dumps(probe),)
+            )
+
+    def probe(self, fpath_video: str) -> dict:
+        """ Probe of a file, from the cache if it's there, otherwise from
+            ffprobe (see probe_video) and then kept
+        """
+        probe = self.load(fpath_video)
+        if probe is None:
+            probe = probe_video(fpath_video)
+            self.store(fpath_video, probe)
+        return probe
+
+    def load_pix_fmts(self, fpath_ffmpeg: str) -> Optional[tuple]:
+        """ Cached pix_fmt table of an ffmpeg binary, or None if it's never
+            been read or the binary has changed since
+            Returns:
+                - version: of ffmpeg, when the table was read
+                - lookup: see PixelFormatter.metadata_lookup
+        """
+        if self._conn is None:
+            return None
+
+        fpath, size, mtime_ns = self._key(fpath_ffmpeg)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, lookup FROM pix_fmts WHERE fpath_ffmpeg = ? AND size = ? AND mtime_ns = ?",
+                (fpath, size, mtime_ns)
+            ).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def store_pix_fmts(self, fpath_ffmpeg: str, version: Optional[str], lookup: dict):
+        if self._conn is None:
+            return
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pix_fmts (fpath_ffmpeg, size, mtime_ns, version, lookup) "
+                "VALUES (?, ?, ?, ?, ?)",
+                self._key(fpath_ffmpeg) + (version, json.dumps(lookup))
+            )
+
+
 class VideoMetadata(object):
-    """ Lazy metadata fetcher for videos
+    """ Lazy metadata fetcher for videos. Everything comes from a single
+        ffprobe call, made the first time anything is asked for, unless the
+        file's been probed before (see MetadataCache)
     """
-    def __init__(self, fpath):
+    def __init__(self, fpath, cache: Optional[MetadataCache] = None):
         self.fpath = fpath
-        self._pix_fmt = None
-        self._framerate_fractional = None
+        self.cache = cache
+        self._probe = None
         self._framerate = self._fps = None
-        self._height = None
-        self._width = None
-        self._duration = None
-        self._codec = None
+
+    @property
+    def probe(self) -> dict:
+        if self._probe is None:
+            cache = MetadataCache.shared() if self.cache is None else self.cache
+            self._probe = cache.probe(str(self.fpath))
+        return self._probe
 
     @property
     def pix_fmt(self):
-        if self._pix_fmt is None:
-            command = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=pix_fmt",
-                "-of", "csv=s=x:p=0",
-                str(self.fpath)
-            ]
-            self._pix_fmt = try_subprocess(command).stdout.strip()
-
-        #pix_fmt = process.stdout.read().decode("utf-8").strip()
-        return self._pix_fmt
+        return self.probe['pix_fmt']
 
     @pix_fmt.setter
     def pix_fmt(self):
@@ -145,25 +610,24 @@ class VideoMetadata(object):
 
     @property
     def framerate_fractional(self):
-        if self._framerate_fractional is None:
-            command = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=r_frame_rate",
-                "-of", "csv=s=x:p=0",
-                str(self.fpath)
-            ]
-
-            process = try_subprocess(command)
-
-            self._framerate_fractional = [int(x) for x in process.stdout.split('/')]
-        return self._framerate_fractional
+        return [int(x) for x in self.probe['r_frame_rate'].split('/')]
 
     @framerate_fractional.setter
     def framerate_fractional(self):
         raise InferredAttributeFromFileError(self.__name__, self.fpath)
 
+    @property
+    def variable_framerate(self) -> bool:
+        """ Whether frames come at a varying rate, as far as ffprobe can tell:
+            their average rate isn't the stream's base rate
+        """
+        avg_frame_rate = self.probe.get('avg_frame_rate')
+        if avg_frame_rate is None or avg_frame_rate.endswith("/0"):
+            return False
+        rate, scale = [int(x) for x in avg_frame_rate.split('/')]
+        rate_base, scale_base = self.framerate_fractional
+        return rate * scale_base != rate_base * scale
+
     @property
     def framerate(self):
         if self._framerate is None:
@@ -185,20 +649,7 @@ class VideoMetadata(object):
 
     @property
     def dimensions(self):
-        if self._height is None or self._width is None:
-            command = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=width,height",
-                "-of", "csv=s=x:p=0",
-                str(self.fpath)
-            ]
-            process = try_subprocess(command)
-
-            self._width, self._height = [int(x) for x in process.stdout.split('x')]
-
-        return self._width, self._height
+        return int(self.probe['width']), int(self.probe['height'])
 
     @dimensions.setter
     def dimensions(self):
@@ -206,10 +657,7 @@ class VideoMetadata(object):
 
     @property
     def height(self):
-        if self._height is None:
-            _, _ = self.dimensions
-
-        return self._height
+        return self.dimensions[1]
 
     @height.setter
     def height(self):
@@ -217,10 +665,7 @@ class VideoMetadata(object):
 
     @property
     def width(self):
-        if self._width is None:
-            _, _ = self.dimensions
-
-        return self._width
+        return self.dimensions[0]
 
     @width.setter
     def width(self):
@@ -228,62 +673,137 @@ class VideoMetadata(object):
 
     @property
     def duration(self):
-        if self._duration is None:
-            command = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=duration",
-                "-of", "csv=s=x:p=0",
-                str(self.fpath)
-            ]
-            self._duration = float(try_subprocess(command).stdout)
-
-        return self._duration
+        # Some containers only know the duration of the whole file
+        duration = self.probe['duration']
+        if duration in (None, "N/A"):
+            duration = self.probe['format_duration']
+        return float(duration)
 
     @property
     def codec(self):
-        if self._codec is None:
-            command = [
-                "ffprobe",
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=codec_name",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                str(self.fpath)
-            ]
-            self._codec = try_subprocess(command).stdout.strip()
-        return self._codec
+        return self.probe['codec_name']
+
+
+def probe_many(
+    fpaths: Iterable[str],
+    n_workers: int = VideoMetadataDefaults.n_probe_workers,
+    cache: Optional[MetadataCache] = None
+) -> Dict[str, VideoMetadata]:
+    """ Probes many videos at once, at most n_workers ffprobe processes at a
+        time. Files already in the cache aren't probed again
+        Parameters:
+            - fpaths: videos to probe. Repeats are only probed once
+            - n_workers: most probes running at once
+            - cache: where probes are kept, the shared MetadataCache if None
+        Returns:
+            - metadata: VideoMetadata of each video by path, in the order
+              given, with its probe already made
+    """
+    # Resolved once here rather than in each thread
+    cache = MetadataCache.shared() if cache is None else cache
+    metadata = {}
+    for fpath in fpaths:
+        fpath = str(Path(fpath).expanduser())
+        if fpath not in metadata:
+            metadata[fpath] = VideoMetadata(fpath, cache=cache)
+
+    # Probes run under the caller's stage, so cancelling it stops them too
+    token = current_token()
+
+    def probe(md):
+        with using(token):
+            return md.probe
+
+    if len(metadata) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(n_workers, len(metadata)))) as executor:
+            # Consumed so the first failure is raised here
+            list(executor.map(probe, metadata.values()))
+
+    return metadata
 
 
 class PixelFormatter(object):
-    def __init__(self):
+    """ Knows the pix_fmts of the ffmpeg on PATH, and which one suits a set of
+        sources. Reading the table means running ffmpeg, so it's only done
+        once per ffmpeg binary: the parsed table is kept for the rest of the
+        process and in the metadata cache, by the binary's real path, size
+        and modification time, so runs after the first don't start ffmpeg
+    """
+    # Tables already read in this process, by ffmpeg binary
+    _tables = {}
+
+    def __init__(self, cache: Optional[MetadataCache] = None):
+        """ Parameters:
+                - cache: where tables are kept, the shared MetadataCache if
+                  None
+        """
+        self.cache = cache
         self._set_pixel_formats()
 
     def _set_pixel_formats(self):
-        """ Runs ffmpeg to get all pix_fmts and creates a lookup for pix_fmt metadata
+        """ Finds the pix_fmt table of the ffmpeg on PATH, running it only if
+            it's never been read before, and creates a lookup for pix_fmt
+            metadata
+        """
+        fpath_ffmpeg = shutil.which("ffmpeg")
+        # Without a binary to key by, there's nothing to cache by either
+        key = None if fpath_ffmpeg is None else MetadataCache._key(fpath_ffmpeg)
+        table = self._tables.get(key)
+        if table is None:
+            cache = MetadataCache.shared() if self.cache is None else self.cache
+            if key is not None:
+                table = cache.load_pix_fmts(fpath_ffmpeg)
+            if table is None:
+                table = self._read_pixel_formats()
+                if key is not None:
+                    cache.store_pix_fmts(fpath_ffmpeg, *table)
+            if key is not None:
+                self._tables[key] = table
+
+        self.version, self.metadata_lookup = table
+        self._set_arrays()
+
+    @staticmethod
+    def _read_pixel_formats() -> tuple:
+        """ Runs ffmpeg to get all pix_fmts
+            Returns:
+                - version: of ffmpeg, from its banner
+                - lookup: pix_fmt metadata by name
         """
         cmd = [
             "ffmpeg",
-            "-loglevel", "panic",
             "-pix_fmts"
         ]
-        lines = try_subprocess(cmd).stdout.strip().split("\n")
+        process = try_subprocess(cmd, timeout=ManagedProcessDefaults.probe_timeout)
+        match = re.search(r"version (\S+)", process.stderr)
+        version = None if match is None else match.group(1)
+
+        lines = process.stdout.strip().split("\n")
         for i, line in enumerate(lines):
             if line == "-----":
                 break
         lines = lines[i + 1:]
         # permissible_in = [line for line in lines if line[0] == "I"]
         # permissible_out = [line for line in lines if line[1] == "O"]
-        self.metadata_lookup = {}
+        metadata_lookup = {}
         for line in lines:
             line_ = line.split()
-            self.metadata_lookup[line_[1]] = {
+            metadata_lookup[line_[1]] = {
                 "flags": line_[0],
                 "nb_components": int(line_[2]),
                 "bits_per_pixel": int(line_[3]),
                 "bit_depths": [int(x) for x in line_[4].split('-')],
             }
+        return version, metadata_lookup
+
+    def _set_arrays(self):
+        """ Columns of the lookup as arrays, sorted by name, for
+            get_common_pix_fmt
+        """
+        self._names = np.array(sorted(self.metadata_lookup))
+        self._bits_per_pixel = np.array([self.metadata_lookup[name]['bits_per_pixel'] for name in self._names])
+        self._bit_depths = np.array([max(self.metadata_lookup[name]['bit_depths']) for name in self._names])
+        self._n_bit_depths = np.array([len(self.metadata_lookup[name]['bit_depths']) for name in self._names])
 
     def get_common_pix_fmt(
         self,
@@ -293,29 +813,25 @@ class PixelFormatter(object):
             options, without attempting to upsample or anything
         """
         channel_fmt = 'yuv'
-        bits_per_pixel = max([fmt['bits_per_pixel'] for fmt in self.metadata_lookup.values()])
-        n_little_endian = 0
-        n_big_endian = 0
-        use_alpha = False
-        bit_depth = bits_per_pixel
-
-        for pix_fmt in pix_fmts:
-            md = self.metadata_lookup[pix_fmt]
+        # Each pix_fmt is only looked up once, however many sources share it
+        names, counts = np.unique(np.asarray(pix_fmts, dtype=str), return_counts=True)
+        if len(names) == 0:
+            raise ValueError("cannot infer common pix_fmt without any pix_fmts")
 
-            # Minimum bits per pixel & bit depth
-            bits_per_pixel = min(bits_per_pixel, md['bits_per_pixel'])
-            bit_depth = min(bit_depth, max(md['bit_depths']))
+        indices = np.minimum(np.searchsorted(self._names, names), len(self._names) - 1)
+        unknown = names[self._names[indices] != names]
+        if len(unknown) > 0:
+            raise KeyError(str(unknown[0]))
 
-            # Count little-endian
-            if pix_fmt.endswith('le'):
-                n_little_endian += 1
+        # Minimum bits per pixel & bit depth
+        bits_per_pixel = int(self._bits_per_pixel[indices].min())
+        bit_depth = int(self._bit_depths[indices].min())
 
-            # Count big-endian
-            if pix_fmt.endswith('be'):
-                n_big_endian += 1
+        # Count little- and big-endian
+        n_little_endian = int(counts[np.char.endswith(names, 'le')].sum())
+        n_big_endian = int(counts[np.char.endswith(names, 'be')].sum())
 
-            if len(md['bit_depths']) > 3:
-                use_alpha = True
+        use_alpha = bool((self._n_bit_depths[indices] > 3).any())
 
         # Start constructing the common pixel_format
         common_pix_fmt = channel_fmt
@@ -341,3 +857,941 @@ class PixelFormatter(object):
             common_pix_fmt += "le" if n_little_endian >= n_big_endian else "be"
 
         return common_pix_fmt
+
+
+# A single video packet (one '##dc' or '##db' chunk) read from an AVI file
+AVIPacket = namedtuple("AVIPacket", ["data", "keyframe"])
+
+
+class AVIDefaults(object):
+    keyframe_flag = 0x10  # AVIIF_KEYFRAME, used in idx1 entries
+    non_keyframe_bit = 0x80000000  # Set in the size of ix00 entries
+    index_of_chunks = 0x01  # AVI_INDEX_OF_CHUNKS, the type of ix00 indices
+    main_header_flags = 0x910  # AVIF_HASINDEX | AVIF_ISINTERLEAVED | AVIF_TRUSTCKTYPE
+    index_flags = 0x30  # AVIF_HASINDEX | AVIF_MUSTUSEINDEX, cleared when no index is written
+    stream_id = b"00"
+    chunk_type = b"dc"
+    # Past this many bytes, packets go into a new OpenDML RIFF AVIX segment
+    riff_size_limit = 1 << 30
+    # Room reserved in the header for OpenDML super index entries (one per RIFF)
+    super_index_entries = 256
+
+
+class AVIHeader(object):
+    """ Headers of a single-video-stream AVI file: the main header (avih),
+        the stream header (strh) and the stream format (strf). The stream
+        format is passed through untouched, since it carries codec-specific
+        extradata we don't need to understand
+    """
+    main_fields = (
+        "microsec_per_frame", "max_bytes_per_sec", "padding_granularity",
+        "flags", "total_frames", "initial_frames", "streams",
+        "suggested_buffer_size", "width", "height",
+    )
+    main_format = "<10I16x"
+    stream_fields = (
+        "fcc_type", "fcc_handler", "flags", "priority", "language",
+        "initial_frames", "scale", "rate", "start", "length",
+        "suggested_buffer_size", "quality", "sample_size",
+        "left", "top", "right", "bottom",
+    )
+    stream_format = "<4s4sIHHIIIIIIiI4h"
+
+    def __init__(self, main: dict, stream: dict, stream_format: bytes):
+        self.main = main
+        self.stream = stream
+        self.format = stream_format
+
+    @classmethod
+    def from_chunks(cls, avih: bytes, strh: bytes, strf: bytes) -> "AVIHeader":
+        main_size = struct.calcsize(cls.main_format)
+        stream_size = struct.calcsize(cls.stream_format)
+        main = dict(zip(
+            cls.main_fields,
+            struct.unpack(cls.main_format, avih[:main_size].ljust(main_size, b"\0"))
+        ))
+        stream = dict(zip(
+            cls.stream_fields,
+            struct.unpack(cls.stream_format, strh[:stream_size].ljust(stream_size, b"\0"))
+        ))
+        return cls(main, stream, strf)
+
+    @property
+    def framerate_fractional(self):
+        return [self.stream['rate'], self.stream['scale']]
+
+    @property
+    def framerate(self):
+        return self.stream['rate'] / self.stream['scale']
+
+    @property
+    def codec_tag(self):
+        return self.stream['fcc_handler'].decode('ascii', errors='replace')
+
+    def pack(self, extra_strl: bytes = b"", extra_hdrl: bytes = b"") -> bytes:
+        """ Packs the header list (LIST hdrl) for writing. Extra chunks go at
+            the end of the stream list and the header list respectively
+        """
+        avih = struct.pack(self.main_format, *[self.main[k] for k in self.main_fields])
+        strh = struct.pack(self.stream_format, *[self.stream[k] for k in self.stream_fields])
+        strl = b"strl" + _pack_chunk(b"strh", strh) + _pack_chunk(b"strf", self.format) + extra_strl
+        hdrl = b"hdrl" + _pack_chunk(b"avih", avih) + _pack_chunk(b"LIST", strl) + extra_hdrl
+        return _pack_chunk(b"LIST", hdrl)
+
+    def copy(self) -> "AVIHeader":
+        return deepcopy(self)
+
+
+def _pack_chunk(fourcc: bytes, data: bytes) -> bytes:
+    """ RIFF chunk: fourcc, little-endian size, data, and a pad byte if odd
+    """
+    padding = b"\0" if len(data) % 2 else b""
+    return fourcc + struct.pack("<I", len(data)) + data + padding
+
+
+class AVIReader(object):
+    """ Minimal demuxer for the single video stream in our AVI encodes.
+        Packets are read front-to-back, so the encode is only read once and
+        the reader also works on non-seekable inputs like pipes. When the
+        input is seekable, keyframe flags are taken from its indices (idx1 and
+        OpenDML ix00) up front.
+    """
+    def __init__(self, source: Union[str, os.PathLike, BinaryIO]):
+        if isinstance(source, (str, os.PathLike)):
+            self.fpath = str(Path(source).expanduser())
+            self._fid = open(self.fpath, 'rb')
+            self._owns_fid = True
+        else:
+            self.fpath = getattr(source, 'name', None)
+            self._fid = source
+            self._owns_fid = False
+
+        # Byte position in the input, tracked by hand so it works on pipes too
+        self.position = 0
+        self.header = None
+        self._keyframes = None
+
+        self._read_riff_header()
+        self._read_until_header()
+
+    def _read(self, n: int) -> bytes:
+        data = self._fid.read(n)
+        self.position += len(data)
+        return data
+
+    def _skip(self, n: int):
+        if n <= 0:
+            return
+        if self._fid.seekable():
+            self._fid.seek(n, os.SEEK_CUR)
+            self.position += n
+        else:
+            while n > 0:
+                skipped = len(self._read(min(n, 1 << 20)))
+                if skipped == 0:
+                    break
+                n -= skipped
+
+    def _read_chunk_header(self):
+        raw = self._read(8)
+        if len(raw) < 8:
+            return None, None
+        return raw[:4], struct.unpack("<I", raw[4:])[0]
+
+    def _read_riff_header(self):
+        fourcc, _ = self._read_chunk_header()
+        form = self._read(4)
+        if fourcc != b"RIFF" or form != b"AVI ":
+            raise ValueError(f"{self.fpath} is not an AVI file")
+
+    def _read_until_header(self):
+        """ Reads chunks up to and including the header list (LIST hdrl)
+        """
+        while self.header is None:
+            fourcc, size = self._read_chunk_header()
+            if fourcc is None:
+                raise ValueError(f"no header list found in {self.fpath}")
+            if fourcc == b"LIST":
+                list_type = self._read(4)
+                if list_type == b"hdrl":
+                    self.header = self._parse_hdrl(self._read(size - 4))
+                    self._pad(size)
+                    continue
+                self._skip(size - 4 + size % 2)
+            else:
+                self._skip(size + size % 2)
+
+        if self._fid.seekable():
+            self._keyframes = self._read_keyframe_flags()
+
+    def _pad(self, size: int):
+        if size % 2:
+            self._read(1)
+
+    def _parse_hdrl(self, hdrl: bytes) -> AVIHeader:
+        avih = strh = strf = None
+        for fourcc, data in self._iter_chunks(hdrl):
+            if fourcc == b"avih":
+                avih = data
+            elif fourcc == b"LIST" and data[:4] == b"strl" and strh is None:
+                for sub_fourcc, sub_data in self._iter_chunks(data[4:]):
+                    if sub_fourcc == b"strh":
+                        strh = sub_data
+                    elif sub_fourcc == b"strf":
+                        strf = sub_data
+
+        if avih is None or strh is None or strf is None or strh[:4] != b"vids":
+            raise ValueError(f"{self.fpath} doesn't start with a video stream")
+
+        return AVIHeader.from_chunks(avih, strh, strf)
+
+    @staticmethod
+    def _iter_chunks(data: bytes):
+        offset = 0
+        while offset + 8 <= len(data):
+            fourcc = data[offset:offset + 4]
+            size = struct.unpack("<I", data[offset + 4:offset + 8])[0]
+            yield fourcc, data[offset + 8:offset + 8 + size]
+            offset += 8 + size + size % 2
+
+    def _read_keyframe_flags(self) -> Optional[list]:
+        """ Reads keyframe flags for the video stream, in packet order, from
+            the indices in the rest of the file: the legacy index (idx1) of the
+            first RIFF, or its standard index (ix00), then the standard index
+            of each OpenDML extension (RIFF AVIX). Flags stop at the first RIFF
+            without an index; past it, keyframes are inferred from the
+            bitstream. Restores the file position afterwards
+        """
+        position = self._fid.tell()
+        position_counter = self.position
+        legacy = None
+        # Flags from the standard indices of each RIFF, None for RIFFs without
+        standard = [None]
+        try:
+            while True:
+                fourcc, size = self._read_chunk_header()
+                if fourcc is None:
+                    break
+
+                if fourcc == b"RIFF":
+                    self._read(4)
+                    standard.append(None)
+                elif fourcc == b"LIST":
+                    list_type = self._read(4)
+                    if list_type not in (b"movi", b"rec "):
+                        self._fid.seek(size - 4 + size % 2, os.SEEK_CUR)
+                elif fourcc == b"idx1" and len(standard) == 1:
+                    entries = self._read(size - size % 16)
+                    legacy = [
+                        bool(entry_flags & AVIDefaults.keyframe_flag)
+                        for ckid, entry_flags, _, _ in struct.iter_unpack("<4sIII", entries)
+                        if ckid[:2] == AVIDefaults.stream_id and ckid[2:] in (b"dc", b"db")
+                    ]
+                    self._fid.seek(size % 16 + size % 2, os.SEEK_CUR)
+                elif fourcc == b"ix" + AVIDefaults.stream_id:
+                    flags = self._parse_standard_index(self._read(size))
+                    if flags is not None:
+                        standard[-1] = (standard[-1] or []) + flags
+                    self._fid.seek(size % 2, os.SEEK_CUR)
+                else:
+                    self._fid.seek(size + size % 2, os.SEEK_CUR)
+        finally:
+            self._fid.seek(position)
+            self.position = position_counter
+
+        flags = []
+        for flags_riff in [standard[0] if legacy is None else legacy] + standard[1:]:
+            if flags_riff is None:
+                break
+            flags.extend(flags_riff)
+        return None if len(flags) == 0 else flags
+
+    @staticmethod
+    def _parse_standard_index(data: bytes) -> Optional[list]:
+        """ Keyframe flags of the entries of a standard index (ix00), whose
+            sizes have their top bit set for non-keyframes
+        """
+        if len(data) < 24:
+            return None
+        longs_per_entry, _, index_type, n_entries = struct.unpack("<HBBI", data[:8])
+        if index_type != AVIDefaults.index_of_chunks or longs_per_entry != 2:
+            return None
+        entries = data[24:24 + 8 * n_entries]
+        entries = entries[:len(entries) - len(entries) % 8]
+        return [
+            not size & AVIDefaults.non_keyframe_bit
+            for _, size in struct.iter_unpack("<II", entries)
+        ]
+
+    def _infer_keyframe(self, data: bytes) -> bool:
+        """ Fallback when there's no index: peek into the bitstream
+        """
+        codec_tag = self.header.codec_tag.upper()
+        if codec_tag in ("H264", "X264", "AVC1"):
+            # IDR NAL unit (type 5) after any Annex B start code
+            start = data.find(b"\0\0\1")
+            while start >= 0 and start + 3 < len(data):
+                if data[start + 3] & 0x1f == 5:
+                    return True
+                start = data.find(b"\0\0\1", start + 3)
+            return False
+        if codec_tag in ("FMP4", "XVID", "DIVX", "DX50", "MP4V"):
+            # I-VOP: coding type bits after the VOP start code are 00
+            start = data.find(b"\0\0\1\xb6")
+            return start >= 0 and start + 4 < len(data) and data[start + 4] >> 6 == 0
+        return False
+
+    def _packet_chunks(self, read_data: bool = True):
+        """ Walks the remaining chunks and yields (offset, size, data, keyframe)
+            for every packet of the video stream, from the main RIFF and any
+            OpenDML (RIFF AVIX) extensions. Payloads are only read when asked
+            for, or when keyframes have to be inferred from the bitstream
+        """
+        index = 0
+        while True:
+            fourcc, size = self._read_chunk_header()
+            if fourcc is None:
+                break
+
+            if fourcc in (b"RIFF", b"LIST"):
+                list_type = self._read(4)
+                # Lists holding packets are descended into rather than trusting
+                # their size, which isn't filled in when written to a pipe
+                if list_type not in (b"movi", b"AVIX", b"rec "):
+                    self._skip(size - 4 + size % 2)
+            elif fourcc[:2] == AVIDefaults.stream_id and fourcc[2:] in (b"dc", b"db"):
+                offset = self.position
+                has_flag = self._keyframes is not None and index < len(self._keyframes)
+                if read_data or not has_flag:
+                    data = self._read(size)
+                    self._pad(size)
+                else:
+                    data = None
+                    self._skip(size + size % 2)
+
+                keyframe = self._keyframes[index] if has_flag else self._infer_keyframe(data)
+                index += 1
+                yield offset, size, data, keyframe
+            else:
+                self._skip(size + size % 2)
+
+    def packets(self) -> Iterator[AVIPacket]:
+        """ Yields every packet of the video stream in decode order
+        """
+        for _, _, data, keyframe in self._packet_chunks():
+            yield AVIPacket(data, keyframe)
+
+    def packet_entries(self) -> Iterator[tuple]:
+        """ Yields (byte offset, size, keyframe) for every packet of the video
+            stream, skipping over payloads where possible
+        """
+        for offset, size, _, keyframe in self._packet_chunks(read_data=False):
+            yield offset, size, keyframe
+
+    def close(self):
+        if self._owns_fid:
+            self._fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AVIWriter(object):
+    """ Streaming muxer for a single video stream, using the headers of the
+        file the packets came from. Packets are written as they're fed in and
+        only their index entries are set aside, spooled to a temporary file, so
+        memory use doesn't grow with the output. Frame counts, chunk sizes and
+        indices are filled in when the writer is closed.
+
+        Outputs that outgrow one RIFF (1 GiB) continue in OpenDML RIFF AVIX
+        segments, each with a standard index (ix00) listed in a super index
+        (indx). The first segment keeps its legacy index (idx1) for older readers
+
+        fpath may also be an open binary file. If it can't seek (stdout, a named
+        pipe, a socket), nothing can be patched afterwards: the headers go out
+        up front with unknown sizes and counts and without the index flags, no
+        index is written and every packet is flushed as it's written, so
+        readers can play it live
+    """
+    def __init__(self, fpath: Union[str, os.PathLike, BinaryIO], header: AVIHeader,
+                 riff_size_limit: int = AVIDefaults.riff_size_limit):
+        if hasattr(fpath, 'write'):
+            self._fid = fpath
+            self._owns_fid = False
+            self.fpath = str(getattr(fpath, 'name', fpath))
+        else:
+            self.fpath = str(Path(fpath).expanduser())
+            self._fid = open(self.fpath, 'wb')
+            self._owns_fid = True
+        self.streaming = not self._fid.seekable()
+
+        self.header = header.copy()
+        self.header.main['flags'] |= AVIDefaults.main_header_flags
+        if self.streaming:
+            self.header.main['flags'] &= ~AVIDefaults.index_flags
+        self.header.main['streams'] = 1
+        self.header.main['initial_frames'] = 0
+        self.header.stream['initial_frames'] = 0
+        self.header.stream['start'] = 0
+        self.riff_size_limit = riff_size_limit
+
+        self._chunk_id = AVIDefaults.stream_id + AVIDefaults.chunk_type
+        self._n_packets = 0
+        self._n_bytes = 0
+        self._max_packet_size = 0
+        self._n_frames_first_riff = None
+        # One (offset of ix00 chunk, its size, frames covered) per RIFF segment
+        self._super_index = []
+        self._time_start = time.perf_counter()
+        self.stats = None
+
+        if self.streaming:
+            self._start_stream()
+        else:
+            self._offset_start = self._fid.tell()
+            self._start_riff()
+
+    def _pack_hdrl(self, super_index: bytes = b"", odml: bytes = b"") -> bytes:
+        """ The super index and OpenDML header list are only known at the end,
+            so they're reserved as JUNK of the same size until then
+        """
+        size_super_index = 24 + 16 * AVIDefaults.super_index_entries
+        super_index = super_index or _pack_chunk(b"JUNK", bytes(size_super_index))
+        odml = odml or _pack_chunk(b"JUNK", bytes(4 + 8 + 248))
+        return self.header.pack(extra_strl=super_index, extra_hdrl=odml)
+
+    def _start_stream(self):
+        """ Zero sizes and frame counts mark them as unknown, which readers
+            handle by reading until the stream ends
+        """
+        self.header.main['total_frames'] = 0
+        self.header.stream['length'] = 0
+        self._fid.write(b"RIFF\0\0\0\0AVI " + self.header.pack() + b"LIST\0\0\0\0movi")
+        self._fid.flush()
+
+    def _start_riff(self):
+        self._offset_riff = self._fid.tell()
+        if self._offset_riff == self._offset_start:
+            self._fid.write(b"RIFF\0\0\0\0AVI ")
+            self._offset_hdrl = self._fid.tell()
+            self._fid.write(self._pack_hdrl())
+        else:
+            self._fid.write(b"RIFF\0\0\0\0AVIX")
+
+        self._offset_movi = self._fid.tell()
+        self._fid.write(b"LIST\0\0\0\0movi")
+        self._n_frames_riff = 0
+        self._spool = tempfile.TemporaryFile()
+
+    def _end_riff(self, final: bool = False):
+        first = self._offset_riff == self._offset_start
+        # A lone RIFF is a plain AVI 1.0 file, so it doesn't need OpenDML indices
+        if not (first and final):
+            self._write_standard_index()
+
+        end_movi = self._fid.tell()
+        self._fid.seek(self._offset_movi + 4)
+        self._fid.write(struct.pack("<I", end_movi - self._offset_movi - 8))
+        self._fid.seek(end_movi)
+
+        if first:
+            self._write_legacy_index()
+            self._n_frames_first_riff = self._n_frames_riff
+
+        end_riff = self._fid.tell()
+        self._fid.seek(self._offset_riff + 4)
+        self._fid.write(struct.pack("<I", end_riff - self._offset_riff - 8))
+        self._fid.seek(end_riff)
+        self._spool.close()
+
+    def _spooled_entries(self):
+        self._spool.seek(0)
+        while True:
+            chunk = self._spool.read(16 * 4096)
+            if not chunk:
+                break
+            yield from struct.iter_unpack("<QII", chunk)
+
+    def _write_legacy_index(self):
+        """ idx1: offsets relative to the 'movi' fourcc of the first RIFF
+        """
+        self._fid.write(b"idx1" + struct.pack("<I", 16 * self._n_frames_riff))
+        for offset, size, flags in self._spooled_entries():
+            self._fid.write(struct.pack("<4sIII", self._chunk_id, flags, offset - self._offset_movi - 8, size))
+
+    def _write_standard_index(self):
+        """ ix00: offsets of packet payloads relative to a base offset, with the
+            top bit of the size set for non-keyframes
+        """
+        if len(self._super_index) >= AVIDefaults.super_index_entries:
+            raise ValueError(f"{self.fpath} would need more than {AVIDefaults.super_index_entries} RIFF segments")
+
+        offset_index = self._fid.tell()
+        size = 24 + 8 * self._n_frames_riff
+        self._fid.write(b"ix" + AVIDefaults.stream_id + struct.pack("<I", size))
+        self._fid.write(struct.pack("<HBBI4sQI", 2, 0, 1, self._n_frames_riff, self._chunk_id, self._offset_movi, 0))
+        for offset, size_packet, flags in self._spooled_entries():
+            if not flags & AVIDefaults.keyframe_flag:
+                size_packet |= AVIDefaults.non_keyframe_bit
+            self._fid.write(struct.pack("<II", offset + 8 - self._offset_movi, size_packet))
+        self._super_index.append((offset_index, size + 8, self._n_frames_riff))
+
+    def __len__(self):
+        return self._n_packets
+
+    def write(self, packet: AVIPacket):
+        if self.streaming:
+            self._fid.write(_pack_chunk(self._chunk_id, packet.data))
+            self._fid.flush()
+            self._count(packet)
+            return
+
+        size_chunk = 8 + len(packet.data) + len(packet.data) % 2
+        size_riff = self._fid.tell() + size_chunk - self._offset_riff
+        if self._n_frames_riff > 0 and size_riff + 16 * (self._n_frames_riff + 1) > self.riff_size_limit:
+            self._end_riff()
+            self._start_riff()
+
+        offset = self._fid.tell()
+        self._fid.write(_pack_chunk(self._chunk_id, packet.data))
+        flags = AVIDefaults.keyframe_flag if packet.keyframe else 0
+        self._spool.write(struct.pack("<QII", offset, len(packet.data), flags))
+        self._n_frames_riff += 1
+        self._count(packet)
+
+    def _count(self, packet: AVIPacket):
+        self._n_packets += 1
+        self._n_bytes += len(packet.data)
+        self._max_packet_size = max(self._max_packet_size, len(packet.data))
+
+    def write_all(self, packets: Iterable[AVIPacket]):
+        for packet in packets:
+            self.write(packet)
+
+    def close(self):
+        if self.stats is not None or self._fid.closed:
+            return
+
+        if self.streaming:
+            self._fid.flush()
+        else:
+            self._close_riff()
+
+        if self._owns_fid:
+            self._fid.close()
+
+        elapsed = max(time.perf_counter() - self._time_start, 1e-9)
+        self.stats = {
+            'packets': self._n_packets,
+            'bytes': self._n_bytes,
+            'seconds': elapsed,
+            'packets_per_second': self._n_packets / elapsed,
+            'megabytes_per_second': self._n_bytes / elapsed / 1e6,
+        }
+        logging.info(f"Wrote {self.fpath}: {self.stats}")
+
+    def _close_riff(self):
+        self._end_riff(final=True)
+        end = self._fid.tell()
+
+        # Now that we know the number of frames, rewrite the headers in place
+        self.header.main['total_frames'] = self._n_frames_first_riff
+        self.header.main['suggested_buffer_size'] = max(
+            self.header.main['suggested_buffer_size'], self._max_packet_size
+        )
+        self.header.stream['length'] = self._n_packets
+        self.header.stream['suggested_buffer_size'] = self._max_packet_size
+
+        if len(self._super_index) > 0:
+            entries = b"".join(struct.pack("<QII", *entry) for entry in self._super_index)
+            entries = entries.ljust(16 * AVIDefaults.super_index_entries, b"\0")
+            super_index = _pack_chunk(
+                b"indx",
+                struct.pack("<HBBI4s3I", 4, 0, 0, len(self._super_index), self._chunk_id, 0, 0, 0) + entries
+            )
+            dmlh = _pack_chunk(b"dmlh", struct.pack("<I", self._n_packets).ljust(248, b"\0"))
+            hdrl = self._pack_hdrl(super_index, _pack_chunk(b"LIST", b"odml" + dmlh))
+        else:
+            hdrl = self._pack_hdrl()
+
+        self._fid.seek(self._offset_hdrl)
+        self._fid.write(hdrl)
+        self._fid.seek(end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PacketIndex(object):
+    """ Array-backed index of an encode's video packets: presentation time
+        (microseconds), byte offset of the payload, payload size and keyframe
+        flag. Built once per encode and stored next to it, so consumers don't
+        need to probe or re-parse the container
+    """
+    dtype = np.dtype([
+        ('pts_us', '<i8'),
+        ('offset', '<i8'),
+        ('size', '<u4'),
+        ('keyframe', '?'),
+    ])
+    suffix = ".index.npz"
+
+    def __init__(self, packets: np.ndarray, framerate_fractional: Sequence[int],
+                 fpath: Optional[str] = None):
+        self.packets = packets
+        self.framerate_fractional = [int(x) for x in framerate_fractional]
+        self.fpath = fpath
+
+    @classmethod
+    def default_fpath(cls, fpath_encode: str) -> str:
+        fpath_encode = Path(fpath_encode).expanduser()
+        return str(fpath_encode.with_name(fpath_encode.stem + cls.suffix))
+
+    @classmethod
+    def build(cls, fpath_encode: str) -> "PacketIndex":
+        """ Reads the encode's chunk headers once and indexes every packet
+        """
+        with AVIReader(fpath_encode) as reader:
+            entries = np.fromiter(
+                ((0, offset, size, keyframe) for offset, size, keyframe in reader.packet_entries()),
+                dtype=cls.dtype,
+            )
+            rate, scale = reader.header.framerate_fractional
+
+        # AVI has no timestamps, packet i is presented at i * scale / rate
+        entries['pts_us'] = np.arange(len(entries), dtype=np.int64) * scale * 1_000_000 // rate
+        return cls(entries, (rate, scale), fpath=cls.default_fpath(fpath_encode))
+
+    @classmethod
+    def load(cls, fpath: str) -> "PacketIndex":
+        fpath = str(Path(fpath).expanduser())
+        with np.load(fpath) as payload:
+            return cls(payload['packets'], payload['framerate'], fpath=fpath)
+
+    def save(self, fpath: Optional[str] = None) -> str:
+        """ Saves the index, writing to a temporary file first so readers never
+            see a partial index
+        """
+        if fpath is not None:
+            self.fpath = str(Path(fpath).expanduser())
+
+        fpath_tmp = f"{self.fpath}.{os.getpid()}.tmp"
+        with open(fpath_tmp, 'wb') as fid:
+            np.savez(fid, packets=self.packets, framerate=np.array(self.framerate_fractional))
+        os.replace(fpath_tmp, self.fpath)
+        return self.fpath
+
+    @property
+    def pts_us(self) -> np.ndarray:
+        return self.packets['pts_us']
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return self.packets['offset']
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return self.packets['size']
+
+    @property
+    def keyframes(self) -> np.ndarray:
+        return self.packets['keyframe']
+
+    @property
+    def framerate(self) -> float:
+        return self.framerate_fractional[0] / self.framerate_fractional[1]
+
+    @property
+    def fps(self) -> float:
+        return self.framerate
+
+    @property
+    def frame_duration_us(self) -> float:
+        return 1_000_000 / self.framerate
+
+    @property
+    def duration_us(self) -> int:
+        return int(len(self) * self.frame_duration_us)
+
+    def read_packets(self, fid: BinaryIO, start: int, stop: int) -> Iterator[AVIPacket]:
+        """ Reads packets [start, stop) from the indexed encode. Packets are
+            contiguous in the file, so the whole range is read at once
+        """
+        if stop <= start:
+            return
+
+        offsets = self.offsets[start:stop]
+        sizes = self.sizes[start:stop]
+        base = int(offsets[0])
+        fid.seek(base)
+        data = fid.read(int(offsets[-1]) + int(sizes[-1]) - base)
+        for offset, size, keyframe in zip(offsets.tolist(), sizes.tolist(), self.keyframes[start:stop].tolist()):
+            yield AVIPacket(data[offset - base:offset - base + size], keyframe)
+
+    def n_slices(self, superframe_size: int) -> int:
+        """ Number of overlapping superframe windows, offset by one frame each
+        """
+        return max(len(self) - superframe_size + 1, 0)
+
+    def __len__(self):
+        return len(self.packets)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({len(self)} packets at {self.fpath})"
+
+
+class VirtualSlice(object):
+    """ Frame range [start, stop) of an encode, standing in for a slice file
+        that was never written
+    """
+    __slots__ = ("fpath", "start", "stop")
+
+    def __init__(self, fpath: str, start: int, stop: int):
+        self.fpath = fpath
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __eq__(self, other):
+        if not isinstance(other, VirtualSlice):
+            return NotImplemented
+        return (self.fpath, self.start, self.stop) == (other.fpath, other.start, other.stop)
+
+    def __hash__(self):
+        return hash((self.fpath, self.start, self.stop))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.fpath}, {self.start}, {self.stop})"
+
+
+def compose_virtual_slices(virtual_slices: Sequence[VirtualSlice], fpath_out="output.avi"):
+    """ Writes the packets of each virtual slice, in order, straight from the
+        encodes into the output. Packet positions come from each encode's
+        PacketIndex. Anything other than an .avi output is remuxed by ffmpeg
+    """
+    indices = {}
+    fids = {}
+
+    def packets():
+        for virtual_slice in virtual_slices:
+            yield from indices[virtual_slice.fpath].read_packets(
+                fids[virtual_slice.fpath],
+                virtual_slice.start,
+                virtual_slice.stop,
+            )
+
+    try:
+        for virtual_slice in virtual_slices:
+            if virtual_slice.fpath not in fids:
+                fpath_index = PacketIndex.default_fpath(virtual_slice.fpath)
+                if os.path.exists(fpath_index):
+                    indices[virtual_slice.fpath] = PacketIndex.load(fpath_index)
+                else:
+                    indices[virtual_slice.fpath] = PacketIndex.build(virtual_slice.fpath)
+                fids[virtual_slice.fpath] = open(virtual_slice.fpath, 'rb')
+
+        with AVIReader(virtual_slices[0].fpath) as reader:
+            header = reader.header
+
+        write_packets(packets(), header, fpath_out)
+    finally:
+        for fid in fids.values():
+            fid.close()
+
+    return fpath_out
+
+
+class StreamDefaults(object):
+    # Destinations that are streamed to instead of written as files. Named
+    # pipes are recognised by checking the path itself
+    stdout_aliases = ("-", "pipe:", "pipe:1")
+    socket_schemes = ("udp", "tcp")
+    # Container UDP streams are remuxed into by ffmpeg. An AVI stream can't
+    # recover from a lost or reordered datagram, MPEG-TS resyncs on its next
+    # 188-byte packet
+    udp_format = "mpegts"
+    # Bytes per datagram unless the URL sets pkt_size: 7 whole MPEG-TS
+    # packets, which fit an ethernet MTU, so a lost datagram takes no partial
+    # packets with it
+    udp_packet_size = 1316
+
+
+class SocketOutput(object):
+    """ Minimal write-only file interface over a TCP socket, so AVIWriter can
+        stream to tcp://host:port. The reader listens (e.g.
+        `ffplay tcp://127.0.0.1:9000?listen`). UDP loses and reorders
+        datagrams, so it's streamed through ffmpeg instead (see stream_packets)
+    """
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        if parsed.scheme != "tcp" or parsed.port is None:
+            raise ValueError(f"expected tcp://host:port, not {url}")
+
+        self.name = url
+        self.address = (parsed.hostname or "127.0.0.1", parsed.port)
+        self._socket = socket.create_connection(self.address)
+
+    @property
+    def closed(self):
+        return self._socket.fileno() < 0
+
+    def seekable(self):
+        return False
+
+    def write(self, data: bytes) -> int:
+        self._socket.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_stream_destination(destination: str) -> bool:
+    """ Whether destination is stdout, a socket URL or a named pipe rather than
+        a regular file
+    """
+    destination = str(destination)
+    if destination in StreamDefaults.stdout_aliases:
+        return True
+    if urlparse(destination).scheme in StreamDefaults.socket_schemes:
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(Path(destination).expanduser()).st_mode)
+    except OSError:
+        return False
+
+
+def open_stream(destination: str) -> BinaryIO:
+    """ Opens a stream destination (see is_stream_destination) for writing.
+        Stdout is opened from its file descriptor, so it's unaffected by
+        anything that has replaced sys.stdout
+    """
+    destination = str(destination)
+    if destination in StreamDefaults.stdout_aliases:
+        return os.fdopen(1, 'wb', closefd=False)
+    if urlparse(destination).scheme in StreamDefaults.socket_schemes:
+        return SocketOutput(destination)
+    return open(Path(destination).expanduser(), 'wb')
+
+
+def stream_packets(packets: Iterable[AVIPacket], header: AVIHeader, destination: str) -> dict:
+    """ Muxes packets into a live AVI stream as they're generated. A reader
+        that goes away ends the stream early rather than failing the export.
+        UDP destinations get StreamDefaults.udp_format instead, remuxed by
+        ffmpeg, which readers can pick back up after losing datagrams
+        Returns:
+            - AVIWriter.stats
+    """
+    parsed = urlparse(str(destination))
+    if parsed.scheme == "udp":
+        if "pkt_size" not in parse_qs(parsed.query):
+            query = "&".join(filter(None, [parsed.query, f"pkt_size={StreamDefaults.udp_packet_size}"]))
+            destination = parsed._replace(query=query).geturl()
+        stats = _stream_packets_ffmpeg(packets, header, destination, StreamDefaults.udp_format)
+    else:
+        with open_stream(destination) as fid:
+            with AVIWriter(fid, header) as writer:
+                try:
+                    writer.write_all(packets)
+                except (BrokenPipeError, ConnectionError) as e:
+                    logging.warning(f"Stream to {destination} closed by reader after {len(writer)} packets: {e}")
+        stats = writer.stats
+
+    _print_mux_stats(stats, file=sys.stderr)
+    return stats
+
+
+def _stream_packets_ffmpeg(packets: Iterable[AVIPacket], header: AVIHeader, destination: str,
+                           output_format: str) -> dict:
+    """ Pipes a live AVI stream into ffmpeg, which remuxes it into
+        output_format and writes it to destination (any URL ffmpeg can write)
+    """
+    command = [
+        "ffmpeg",
+        "-v", "error",
+        "-f", "avi",
+        "-i", "pipe:0",
+        "-c", "copy",
+        "-f", output_format,
+        str(destination),
+    ]
+    with ManagedProcess(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE) as managed:
+        writer = AVIWriter(managed.popen.stdin, header)
+        try:
+            with writer:
+                writer.write_all(packets)
+        except BrokenPipeError:
+            # ffmpeg's exit status says why
+            logging.warning(f"ffmpeg streaming to {destination} exited after {len(writer)} packets")
+        # Closed here so ffmpeg sees the end of the stream. Whatever's still
+        # buffered is lost if ffmpeg has already gone
+        with suppress(BrokenPipeError):
+            managed.popen.stdin.close()
+        stderr = managed.popen.stderr.read().decode(errors="replace")
+
+    if managed.popen.returncode != 0:
+        raise SubprocessError(subprocess.CompletedProcess(command, managed.popen.returncode, None, stderr))
+    return writer.stats
+
+
+def _print_mux_stats(stats: dict, file=None):
+    print(
+        f"[muxing] {stats['packets']} packets, {stats['bytes'] / 1e6:.1f} MB in {stats['seconds']:.2f}s"
+        f" ({stats['packets_per_second']:.0f} packets/s, {stats['megabytes_per_second']:.1f} MB/s)",
+        file=file
+    )
+
+
+def write_packets(packets: Iterable[AVIPacket], header: AVIHeader, fpath_out: str) -> dict:
+    """ Muxes packets into fpath_out as they're generated, and reports
+        throughput. Containers other than AVI are muxed to a temporary AVI
+        first and then remuxed by ffmpeg. Stream destinations (see
+        is_stream_destination) are handed to stream_packets. Muxing stops
+        between packets once the current stage is cancelled
+        Returns:
+            - AVIWriter.stats
+    """
+    token = current_token()
+
+    def checked(packets):
+        for packet in packets:
+            token.raise_if_cancelled()
+            yield packet
+
+    packets = checked(packets)
+    if is_stream_destination(fpath_out):
+        return stream_packets(packets, header, fpath_out)
+
+    fpath_out = str(Path(fpath_out).expanduser())
+    if Path(fpath_out).suffix.lower() == ".avi":
+        fpath_avi = fpath_out
+    else:
+        fpath_avi = str(Path(fpath_out).with_suffix(".mux.avi"))
+
+    with AVIWriter(fpath_avi, header) as writer:
+        writer.write_all(packets)
+
+    _print_mux_stats(writer.stats)
+
+    if fpath_avi != fpath_out:
+        remux_video(fpath_avi, fpath_out)
+        os.remove(fpath_avi)
+
+    return writer.stats
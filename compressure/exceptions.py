@@ -44,7 +44,31 @@ class SubprocessError(Exception):
             \n{process.stderr}", *args, **kwargs)
 
 
+class SubprocessTimeoutError(SubprocessError):
+    def __init__(self, process, timeout, *args, **kwargs):
+        self.timeout = timeout
+        command = " ".join((str(a) for a in process.args))
+        Exception.__init__(self, f"Subprocess `{command}` was killed after running for {timeout}s",
+                           *args, **kwargs)
+
+
+class CancelledError(Exception):
+    def __init__(self, reason, *args, **kwargs):
+        self.reason = reason
+        super().__init__(f"Cancelled: {reason}", *args, **kwargs)
+
+
 class RAMFSDuplicateFileError(Exception):
     def __init__(self, ramfs, fpath, *args, **kwargs):
         super().__init__(f"{ramfs.__class__.__name__} object {ramfs} has already registered file \
             {fpath.name} at {str(fpath)}", *args, **kwargs)
+
+
+class WorkerPoolError(Exception):
+    def __init__(self, function, failures, *args, **kwargs):
+        self.failures = failures
+        details = "\n".join(f"{task}: {error}" for task, error in failures[:10])
+        if len(failures) > 10:
+            details += f"\n... and {len(failures) - 10} more"
+        super().__init__(f"{len(failures)} tasks of {function.__name__} failed:\n{details}",
+                         *args, **kwargs)
@@ -1,3 +1,5 @@
+import hashlib
+import os
 import re
 
 
@@ -27,3 +29,53 @@ def nicely_sorted(strings: list) -> list:
     """
     sort_nicely(strings)
     return strings
+
+
+class ContentHashDefaults(object):
+    # Files bigger than this are hashed from evenly spaced chunks rather than
+    # in full
+    partial_threshold = 256 * 2 ** 20
+    chunk_size = 4 * 2 ** 20
+    n_chunks = 8
+    # Bytes of digest, twice as many hex characters
+    digest_size = 16
+
+
+# Hashes already computed by this process, by (path, size, mtime, partial)
+_content_hashes = {}
+
+
+def content_hash(fpath: str, partial: bool = None) -> str:
+    """ Hex digest of a file's contents, the same whatever the file is called
+        or wherever it's kept. Partial hashes cover the file's size and a few
+        evenly spaced chunks (see ContentHashDefaults), so they read only a
+        fraction of a big video while still telling apart any two that aren't
+        copies. Hashes are remembered until the file changes
+        Parameters:
+            - fpath: file to hash
+            - partial: hash only chunks. By default, only files bigger than
+              the partial threshold are
+    """
+    stat = os.stat(fpath)
+    partial = stat.st_size > ContentHashDefaults.partial_threshold if partial is None else partial
+    key = (os.path.realpath(fpath), stat.st_size, stat.st_mtime_ns, partial)
+    if key in _content_hashes:
+        return _content_hashes[key]
+
+    chunk_size = ContentHashDefaults.chunk_size
+    digest = hashlib.blake2b(digest_size=ContentHashDefaults.digest_size)
+    with open(fpath, 'rb') as fid:
+        if partial:
+            # Partial and full hashes of the same file never match
+            digest.update(f"partial:{stat.st_size}:".encode())
+            n_chunks = ContentHashDefaults.n_chunks
+            span = max(stat.st_size - chunk_size, 0)
+            for i in range(n_chunks):
+                fid.seek(span * i // max(n_chunks - 1, 1))
+                digest.update(fid.read(chunk_size))
+        else:
+            for block in iter(lambda: fid.read(chunk_size), b""):
+                digest.update(block)
+
+    _content_hashes[key] = digest.hexdigest()
+    return _content_hashes[key]
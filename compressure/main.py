@@ -1,20 +1,35 @@
 import os
 from copy import deepcopy
-from collections import deque
+import json
 import logging
 from argparse import ArgumentParser
 from pprint import pformat
 from pathlib import Path
-from typing import Sequence, Union, Optional
+import shutil
+import sys
+import tempfile
+from typing import Iterable, List, Sequence, Union, Optional
 
 import ipdb  # noqa
 import numpy as np
 
+from compressure.cache import CacheDefaults, CacheManager, parse_size
 from compressure.file_interface import nicely_sorted
-from compressure.compression import SingleVideoCompression, VideoCompressionDefaults
-from compressure.persistence import CompressurePersistence
-from compressure.slicing import VideoSlicer
-from compressure.dataproc import concat_videos, reverse_loop, VideoMetadata, PixelFormatter
+from compressure.compression import EncodeScheduler, SingleVideoCompression, VideoCompressionDefaults
+from compressure.persistence import CompressurePersistence, SliceCompletion
+from compressure.processes import cancel_all, stage
+from compressure.slicing import SliceScheduler, transcode_to_slices, VideoSlicer
+from compressure.dataproc import (
+    compose_virtual_slices,
+    concat_avi_videos,
+    concat_videos,
+    reverse_loop,
+    PacketIndex,
+    PixelFormatter,
+    probe_many,
+    StreamDefaults,
+    VirtualSlice,
+)
 from compressure.exceptions import (
     EncoderSelectionError,
     MalformedConfigurationError,
@@ -31,7 +46,10 @@ class CompressureSystem(object):
         self,
         fpath_manifest: MaybePathLike = CompressurePersistence.defaults.fpath_manifest,
         workdir: MaybePathLike = CompressurePersistence.defaults.workdir,
-        verbosity: int = 1
+        verbosity: int = 1,
+        cache_budget: Optional[int] = CacheDefaults.budget,
+        draft_scale: float = VideoCompressionDefaults.draft_scale,
+        draft_preset: str = VideoCompressionDefaults.draft_preset,
     ):
 
         self.persistence = CompressurePersistence(
@@ -39,6 +57,12 @@ class CompressureSystem(object):
             workdir=workdir,
             verbosity=verbosity
         )
+        # Evicts least recently used encodes and slices once the cache grows
+        # past cache_budget bytes, see cache.CacheManager
+        self.cache = CacheManager(self.persistence, budget=cache_budget, verbosity=verbosity)
+        # How drafts are made, see draft_settings
+        self.draft_scale = draft_scale
+        self.draft_preset = draft_preset
 
         self.verbosity = verbosity
 
@@ -54,7 +78,10 @@ class CompressureSystem(object):
         encoder_config: Optional[dict] = None,
         workdir: str = None,
         fps: Optional[Sequence[int]] = None,
-        pix_fmt: Optional[str] = None
+        pix_fmt: Optional[str] = None,
+        threads: Optional[int] = None,
+        segmented: bool = False,
+        draft: bool = False,
     ) -> str:
         """ Encodes video file with specified parameters
             Parameters:
@@ -65,6 +92,13 @@ class CompressureSystem(object):
                 - workdir: location for encoded files
                 - fps: coerced framerate (sped up or slowed down), (-1, -1) for default
                 - pix_fmt: coerced pixel format
+                - threads: encoder threads, ffmpeg's choice if None
+                - segmented: encode GOP-aligned segments of the source at
+                  once, see SingleVideoCompression.transcode_segments
+                - draft: encode a downscaled, quickly encoded proxy instead
+                  (see draft_settings). It's cached like any other encode and
+                  has the same frames, so timelines made from it can be
+                  replayed on the full encode (see TimelineRecipe)
             Returns:
                 - string filepath to encoded video
         """
@@ -72,6 +106,10 @@ class CompressureSystem(object):
         workdir = workdir if workdir is not None else self.persistence.workdir
 
         encoder_config = {} if encoder_config is None else encoder_config
+        scale = None
+        if draft:
+            encoder_config, scale = self.draft_settings(encoder, encoder_config)
+
         compressor = SingleVideoCompression(
             fpath_in=fpath_in,
             workdir=workdir,
@@ -79,7 +117,10 @@ class CompressureSystem(object):
             encoder=encoder,
             encoder_config=encoder_config,
             fps=fps,
-            pix_fmt=pix_fmt
+            pix_fmt=pix_fmt,
+            threads=threads,
+            segmented=segmented,
+            scale=scale,
         )
         try:
             # First see if we've already encoded it
@@ -88,27 +129,177 @@ class CompressureSystem(object):
                 fpath_encode=compressor.fpath_out,
             )
         except KeyError:
+            encode = self._encode(fpath_in, compressor)
+            self.persistence.touch(fpath_in, encode['fpath'])
+            # The cache just grew
+            self.cache.enforce()
+        else:
+            # Encodes from older manifests may not have been indexed yet
+            self.index(fpath_in, encode['fpath'])
+            self.persistence.touch(fpath_in, encode['fpath'])
+
+        # Return filepath for later use
+        return encode['fpath']
+
+    def draft_settings(self, encoder: str, encoder_config: dict) -> tuple:
+        """ Settings for a draft of an encode: encoder_config with the draft
+            preset, for encoders that have presets, and the draft scale
+            Returns:
+                - encoder_config
+                - scale
+        """
+        encoder_config = dict(encoder_config)
+        if 'preset' in VideoCompressionDefaults.encoder_config_options.get(encoder, {}):
+            encoder_config['preset'] = self.draft_preset
+        return encoder_config, self.draft_scale
+
+    def compress_many(
+        self,
+        fpaths_in: Sequence[str],
+        n_cores: Optional[int] = None,
+        **kwargs: dict,
+    ) -> List[str]:
+        """ Encodes several video files with the same parameters, at once,
+            splitting n_cores between the encodes (see
+            compression.EncodeScheduler)
+            Parameters:
+                - fpaths_in: video file paths. Repeats are only encoded once
+                - n_cores: cores to share between encodes, all of them if None
+                - kwargs: passed on to compress
+            Returns:
+                - string filepaths to encoded videos, in the order of fpaths_in
+        """
+        fpaths_unique = list(dict.fromkeys(fpaths_in))
+        scheduler = EncodeScheduler(n_cores)
+        fpaths_encode = scheduler.map(
+            lambda fpath_in, threads: self.compress(fpath_in, threads=threads, **kwargs),
+            fpaths_unique
+        )
+        fpaths_encode = dict(zip(fpaths_unique, fpaths_encode))
+        return [fpaths_encode[fpath_in] for fpath_in in fpaths_in]
+
+    def compress_to_slices(
+        self,
+        fpaths_in: Sequence[str],
+        superframe_size: int,
+        workdir: str,
+        n_cores: Optional[int] = None,
+        draft: bool = False,
+        **kwargs: dict,
+    ) -> List[tuple]:
+        """ Transcodes several video files straight into slices, at once (see
+            compression.EncodeScheduler), without writing their encodes (see
+            slicing.transcode_to_slices). Nothing is cached: this is for
+            one-off renders, and workdir is the caller's to clean up
+            Parameters:
+                - fpaths_in: video file paths
+                - superframe_size: number of frames per slice
+                - workdir: slices of the i-th video go in workdir/i
+                - n_cores: cores to share between encodes, all of them if None
+                - draft: slice drafts instead, see compress
+                - kwargs: passed on to SingleVideoCompression
+            Returns:
+                - (slice directory, packet index) of each video, in the order
+                  of fpaths_in
+        """
+        if draft:
+            encoder = kwargs.get('encoder', VideoCompressionDefaults.encoder)
+            kwargs['encoder_config'], kwargs['scale'] = self.draft_settings(encoder, kwargs.get('encoder_config') or {})
+
+        def transcode(i, threads):
+            compressor = SingleVideoCompression(
+                fpath_in=fpaths_in[i],
+                workdir=workdir,
+                threads=threads,
+                **kwargs
+            )
+            dpath_slices = str(Path(workdir) / str(i))
+            return dpath_slices, transcode_to_slices(compressor, superframe_size, dpath_slices)
+
+        return EncodeScheduler(n_cores).map(transcode, list(range(len(fpaths_in))))
+
+    def _encode(self, fpath_in: str, compressor: SingleVideoCompression) -> dict:
+        """ Transcodes and indexes a video, then adds it to the manifest. If
+            another process sharing the cache is already encoding it, waits
+            for that instead
+        """
+        marker = self.persistence.in_progress(compressor.fpath_out)
+        if not marker.acquire(blocking=False):
             self._log_print(
-                "No video found in persistent storage - creating now",
+                f"Another process is encoding {compressor.fpath_out} - waiting for it",
                 logging.info
             )
-            # If we haven't encoded, do that now
-            fpath_out, _ = compressor.transcode_video()
+            marker.acquire()
+
+        try:
+            # It may have been encoded while we waited
+            self.persistence.refresh()
+            try:
+                return self.persistence.get_encode(
+                    fpath_source=fpath_in,
+                    fpath_encode=compressor.fpath_out,
+                )
+            except KeyError:
+                pass
+
+            if os.path.exists(compressor.fpath_out):
+                # Encodes are named for their contents and only appear once
+                # complete, so one already on disk (copied from another cache,
+                # say) is the one we'd make
+                self._log_print(
+                    f"Found {compressor.fpath_out} on disk - adding it to persistent storage",
+                    logging.info
+                )
+                fpath_out = compressor.fpath_out
+            else:
+                self._log_print(
+                    "No video found in persistent storage - creating now",
+                    logging.info
+                )
+                # If we haven't encoded, do that now
+                fpath_out, _ = compressor.transcode_video()
+
+            # Index the encode's packets while it's still in the page cache
+            fpath_index = PacketIndex.build(fpath_out).save()
+
+            parameters = dict(compressor.encoder_config_dict)
+            if compressor.scale is not None:
+                parameters['scale'] = compressor.scale
 
             # Add encoding to manifest and get entry back
             encode = self.persistence.add_encode(
                 fpath_source=fpath_in,
                 fpath_encode=fpath_out,
-                parameters=compressor.encoder_config_dict,
-                command=compressor.transcode_command
+                parameters=parameters,
+                command=compressor.transcode_command,
+                index=fpath_index,
             )
             self._log_print(
                 f"Successfully added & transcoded video to {fpath_out}",
                 logging.info
             )
+        finally:
+            marker.release()
 
-        # Return filepath for later use
-        return encode['fpath']
+        return encode
+
+    def index(self, fpath_source: str, fpath_encode: str) -> str:
+        """ Gets the packet index of an encode, building and recording it if
+            it doesn't exist yet
+            Parameters:
+                - fpath_source: source path, used only for indexing into persistence object
+                - fpath_encode: encode path
+            Returns:
+                - string filepath to packet index, see dataproc.PacketIndex
+        """
+        encode = self.persistence.get_encode(fpath_source, fpath_encode)
+        fpath_index = encode.get('index')
+        if fpath_index is None or not Path(fpath_index).exists():
+            self._log_print(f"Indexing packets of {fpath_encode}", logging.info)
+            fpath_index = PacketIndex.build(fpath_encode).save()
+            self.persistence.add_index(fpath_source, fpath_encode, fpath_index)
+
+        return fpath_index
 
     def remove_encode(self, fpath_source: str, fpath_encode: str) -> None:
         self.persistence.remove_encode(fpath_source, fpath_encode)
@@ -125,64 +316,196 @@ class CompressureSystem(object):
         fpath_encode: str,
         superframe_size: int = 6,
         n_workers: int = 0,
+        indices: Optional[Iterable[int]] = None,
     ) -> str:
-        """ Slices encoded video into short chunks, writing all to a location
-            defined by the persistence class.
-            NOTE that this method will create `ceil(n_frames(original) / superframe_size)`
+        """ Slices encoded video into short chunks, writing them to a location
+            defined by the persistence class. Completed slices are tracked in
+            persistence, so only missing ones are extracted and an interrupted
+            run picks up where it stopped.
+            NOTE that slicing everything creates `n_frames - superframe_size + 1`
             video files, each `superframe_size` frames long.
             Parameters:
                 - fpath_source: source path, used only for indexing into persistence object
                 - fpath_encode: encode path, the input file for slicing
                 - superframe_size: number of frames per slice.
+                - n_workers: number of processes to use, where the slicer can use them
+                - indices: slice indices to extract. Defaults to all of them,
+                  see slice_timeline for extracting only what a timeline visits
             Returns:
                 string directory path to slices
         """
-        try:
-            slices = self.persistence.get_slices(fpath_source, fpath_encode, superframe_size)
-        except KeyError:
-            workdir = self.persistence.init_slices_dir(fpath_encode, superframe_size)
-
-            slicer = VideoSlicer(
-                fpath_in=fpath_encode,
-                superframe_size=superframe_size,
-                workdir=workdir
-            )
+        slicer = self._init_slicer(fpath_source, fpath_encode, superframe_size)
+        if indices is None:
+            # One pass over the whole encode, skipping slices that are complete
             slicer.slice_video(n_workers=n_workers)
-            slices = self.persistence.add_slices(fpath_source, fpath_encode, superframe_size)
+        else:
+            slicer.slice_indices(indices, n_workers=n_workers)
 
+        self.cache.enforce()
+        return self.persistence.get_slices(fpath_source, fpath_encode, superframe_size)
+
+    def _init_slicer(self, fpath_source: str, fpath_encode: str, superframe_size: int) -> VideoSlicer:
+        workdir = self.persistence.init_slices_dir(fpath_encode, superframe_size)
+        packet_index = PacketIndex.load(self.index(fpath_source, fpath_encode))
+        slicer = VideoSlicer(
+            fpath_in=fpath_encode,
+            superframe_size=superframe_size,
+            workdir=workdir,
+            packet_index=packet_index,
+            completion=self.persistence.get_slice_completion(
+                fpath_encode,
+                superframe_size,
+                packet_index.n_slices(superframe_size),
+            ),
+        )
+        # Recorded before slicing starts, so an interrupted run can resume
+        self.persistence.add_slices(fpath_source, fpath_encode, superframe_size)
+        self.persistence.touch(fpath_source, fpath_encode, superframe_size)
+        return slicer
+
+    def schedule_slices(
+        self,
+        video_list: Sequence[VirtualSlice],
+        fpaths_source: dict,
+        superframe_size: int,
+        n_workers: int = 0,
+    ) -> SliceScheduler:
+        """ Queues extraction of only the slices a composed timeline visits,
+            skipping any cached before, in order of first use
+            Parameters:
+                - video_list: virtual slices, e.g. states of a buffer from init_virtual_buffer
+                - fpaths_source: source path of each encode in video_list
+                - superframe_size: number of frames per slice
+                - n_workers: number of worker threads, at least one is used
+            Returns:
+                - started SliceScheduler, which yields slice filepaths in the
+                  order of video_list as they're ready
+        """
+        slicers = {
+            fpath_encode: self._init_slicer(fpaths_source[fpath_encode], fpath_encode, superframe_size)
+            for fpath_encode in set(virtual_slice.fpath for virtual_slice in video_list)
+        }
+        return SliceScheduler(video_list, slicers, n_workers=n_workers).start()
+
+    def slice_timeline(
+        self,
+        video_list: Sequence[VirtualSlice],
+        fpaths_source: dict,
+        superframe_size: int,
+        n_workers: int = 0,
+    ) -> list:
+        """ Extracts only the slices a composed timeline visits (see
+            schedule_slices) and swaps them in for the virtual slices
+            Returns:
+                - slice filepaths, in the order of video_list
+        """
+        slices = list(self.schedule_slices(video_list, fpaths_source, superframe_size, n_workers=n_workers))
+        self.cache.enforce()
         return slices
 
+    def export_timeline(
+        self,
+        video_list: Sequence[VirtualSlice],
+        fpaths_source: dict,
+        superframe_size: int,
+        fpath_out: str,
+        n_workers: int = 0,
+    ) -> str:
+        """ Extracts the slices a composed timeline visits and writes the
+            output at the same time: each slice is muxed as soon as it and all
+            slices before it are ready, so wall time approaches the longer of
+            slicing and composing rather than their sum
+        """
+        scheduler = self.schedule_slices(video_list, fpaths_source, superframe_size, n_workers=n_workers)
+        fpath_out = concat_avi_videos(scheduler, fpath_out)
+        self.cache.enforce()
+        return fpath_out
+
     def init_buffer(self,
                     dpath_slices_forward: str,
                     dpath_slices_backward: str,
                     superframe_size: int,
+                    fpath_index_forward: Optional[str] = None,
+                    fpath_index_backward: Optional[str] = None,
                     ) -> "VideoSliceBufferReversible":
-        """ Initializes video buffer for forward/reverse traversal
+        """ Initializes video buffer for forward/reverse traversal. If packet
+            indices are given, slice positions come from them rather than from
+            listing the slice directories
         """
         buffer = VideoSliceBufferReversible(
             dpath_slices_forward,
             dpath_slices_backward,
-            superframe_size
+            superframe_size,
+            packet_index_forward=None if fpath_index_forward is None else PacketIndex.load(fpath_index_forward),
+            packet_index_backward=None if fpath_index_backward is None else PacketIndex.load(fpath_index_backward),
+        )
+        return buffer
+
+    def init_virtual_buffer(self,
+                            fpath_source_forward: str,
+                            fpath_encode_forward: str,
+                            fpath_source_backward: str,
+                            fpath_encode_backward: str,
+                            superframe_size: int,
+                            ) -> "VideoSliceBufferReversible":
+        """ Initializes video buffer for forward/reverse traversal over frame
+            ranges of the encodes themselves, so nothing needs to be sliced
+        """
+        buffer = VideoSliceBufferReversible(
+            None,
+            None,
+            superframe_size,
+            packet_index_forward=PacketIndex.load(self.index(fpath_source_forward, fpath_encode_forward)),
+            packet_index_backward=PacketIndex.load(self.index(fpath_source_backward, fpath_encode_backward)),
+            fpath_encode_forward=fpath_encode_forward,
+            fpath_encode_backward=fpath_encode_backward,
         )
         return buffer
 
+    def export(self, video_list: Sequence[Union[str, VirtualSlice]], fpath_out: str) -> str:
+        """ Writes the composed slices to fpath_out. Virtual slices are copied
+            straight out of their encodes, slice files are concatenated. If
+            fpath_out is stdout (-), a named pipe, or a udp:// or tcp:// URL, the
+            output is streamed as it's composed instead (see
+            dataproc.stream_packets), so playback can start right away
+        """
+        if len(video_list) > 0 and isinstance(video_list[0], VirtualSlice):
+            return compose_virtual_slices(video_list, fpath_out=fpath_out)
+        return concat_videos(video_list, fpath_out=fpath_out)
+
 
 # TODO work on this
 class VideoSliceBufferReversible(object):
-    def __init__(self, dpath_slices_forward: str, dpath_slices_backward: str, superframe_size: int):
+    def __init__(self, dpath_slices_forward: Optional[str], dpath_slices_backward: Optional[str],
+                 superframe_size: int,
+                 packet_index_forward: Optional[PacketIndex] = None,
+                 packet_index_backward: Optional[PacketIndex] = None,
+                 fpath_encode_forward: Optional[str] = None,
+                 fpath_encode_backward: Optional[str] = None):
+        """ Buffer of slices for forward/reverse traversal. Slices are files in
+            the slice directories, or, if the encodes are given, virtual slices:
+            frame ranges of the encodes resolved through their packet indices.
+
+            Slices are held in arrays and positions are plain integers, so a
+            step is O(1) and a whole timeline resolves in one vectorized call
+            (see resolve)
+        """
+        if fpath_encode_forward is not None:
+            slices_forward = self._virtual_slices(fpath_encode_forward, superframe_size, packet_index_forward)
+        else:
+            slices_forward = self._list_slices(dpath_slices_forward, superframe_size, packet_index_forward)
 
-        # TODO buffer needs parent directories for
-        slices_forward = nicely_sorted([
-            str(Path(dpath_slices_forward) / fname)
-            for fname in os.listdir(dpath_slices_forward)
-        ])
-        slices_backward = nicely_sorted([
-            str(Path(dpath_slices_backward) / fname)
-            for fname in os.listdir(dpath_slices_backward)
-        ])
+        if fpath_encode_backward is not None:
+            slices_backward = self._virtual_slices(fpath_encode_backward, superframe_size, packet_index_backward)
+        else:
+            slices_backward = self._list_slices(dpath_slices_backward, superframe_size, packet_index_backward)
+
+        self.packet_index_forward = packet_index_forward
+        self.packet_index_backward = packet_index_backward
+        self.superframe_size = superframe_size
 
-        self.buffer_forward = deque(slices_forward)
-        self.buffer_backward = deque(slices_backward[::-1])
+        self.slices_forward = self._object_array(slices_forward)
+        self.slices_backward = self._object_array(slices_backward)
 
         self.forward = True
         self.index = 0
@@ -190,9 +513,48 @@ class VideoSliceBufferReversible(object):
         self._velocity_numerator = superframe_size
         self._velocity_denominator = superframe_size
 
+    @staticmethod
+    def _object_array(slices: list) -> np.ndarray:
+        # Filled element by element so numpy doesn't try to unpack the slices
+        array = np.empty(len(slices), dtype=object)
+        array[:] = slices
+        return array
+
+    @staticmethod
+    def _virtual_slices(fpath_encode: str, superframe_size: int, packet_index: PacketIndex) -> list:
+        return [
+            VirtualSlice(fpath_encode, i, i + superframe_size)
+            for i in range(packet_index.n_slices(superframe_size))
+        ]
+
+    @staticmethod
+    def _list_slices(dpath_slices: str, superframe_size: int,
+                     packet_index: Optional[PacketIndex] = None) -> list:
+        if packet_index is not None:
+            return [
+                str(Path(dpath_slices) / f"slice_{i}.avi")
+                for i in range(packet_index.n_slices(superframe_size))
+            ]
+
+        # Skip the completion bitmap and slices that are still being written
+        return nicely_sorted([
+            str(Path(dpath_slices) / fname)
+            for fname in os.listdir(dpath_slices)
+            if SliceCompletion.pattern_slice.match(fname)
+        ])
+
+    def _forward_position(self, index):
+        return index % len(self.slices_forward)
+
+    def _backward_position(self, index):
+        # The backward slices are traversed from the end
+        return len(self.slices_backward) - 1 - index % len(self.slices_backward)
+
     @property
     def state(self):
-        return self.buffer_forward[0] if self.forward else self.buffer_backward[0]
+        if self.forward:
+            return self.slices_forward[self._forward_position(self.index)]
+        return self.slices_backward[self._backward_position(self.index)]
 
     @property
     def velocity(self):
@@ -219,22 +581,71 @@ class VideoSliceBufferReversible(object):
         else:
             n_moves = int(self.superframe_size * self.velocity)
 
-        self.buffer_forward.rotate(-n_moves)
-        self.buffer_backward.rotate(-n_moves)
-
         # Subtle differences designed to maintain temporal stability in case of
         # zero-velocity within monotonic steps
-        # if self.forward:
-        #     self.state = self.buffer_forward[0] if self.velocity >= 0 else self.buffer_backward[0]
-        # else:
-        #     self.state = self.buffer_forward[0] if self.velocity > 0 else self.buffer_backward[0]
-
         self.index += n_moves
         if self.forward:
-            state = self.buffer_forward[0] if self.velocity >= 0 else self.buffer_backward[0]
+            forward = self.velocity >= 0
         else:
-            state = self.buffer_forward[0] if self.velocity > 0 else self.buffer_backward[0]
-        return state
+            forward = self.velocity > 0
+
+        if forward:
+            return self.slices_forward[self._forward_position(self.index)]
+        return self.slices_backward[self._backward_position(self.index)]
+
+    def resolve_positions(self, timeline) -> tuple:
+        """ Vectorized equivalent of calling step(to=location) for every
+            location in timeline, leaving the buffer where those steps would.
+            A step's direction is that of its velocity, or, at zero velocity,
+            that of the last step that moved
+            Returns:
+                - forward: bool array, whether each step lands on a forward slice
+                - positions: int array, position in slices_forward or
+                  slices_backward respectively
+        """
+        timeline = np.asarray(timeline, dtype=np.int64)
+        if len(timeline) == 0:
+            return np.zeros(0, dtype=bool), np.zeros(0, dtype=np.int64)
+
+        velocities = np.sign(np.diff(timeline, prepend=self.index))
+
+        # Direction carried in from earlier steps
+        if self.velocity != 0:
+            forward_initial = self.velocity > 0
+        else:
+            forward_initial = self.forward
+
+        # Forward-fill the sign of the last nonzero velocity: the running count
+        # of moves indexes into the directions of those moves
+        moved = velocities != 0
+        directions = np.concatenate([[forward_initial], velocities[moved] > 0])
+        forward = directions[np.cumsum(moved)]
+
+        positions = self._forward_position(timeline)
+        if len(self.slices_backward) == len(self.slices_forward):
+            positions[~forward] = len(self.slices_backward) - 1 - positions[~forward]
+        else:
+            positions[~forward] = self._backward_position(timeline[~forward])
+
+        self.forward = bool(forward[-2]) if len(timeline) > 1 else bool(forward_initial)
+        self.index = int(timeline[-1])
+        self._velocity_numerator = int(velocities[-1]) * self._velocity_denominator
+        return forward, positions
+
+    def resolve_array(self, timeline) -> np.ndarray:
+        """ Like resolve, but returns the slices as an object array
+        """
+        forward, positions = self.resolve_positions(timeline)
+        states = np.empty(len(positions), dtype=object)
+        states[forward] = self.slices_forward[positions[forward]]
+        states[~forward] = self.slices_backward[positions[~forward]]
+        return states
+
+    def resolve(self, timeline) -> list:
+        """ Maps a whole timeline (see generate_timeline_function) to the
+            slices that stepping through it would return, in one vectorized call
+        """
+        return self.resolve_array(timeline).tolist()
 
     def accelerate(self, degree=1):
         """ Changes velocity
@@ -243,7 +654,161 @@ class VideoSliceBufferReversible(object):
         return self.step()
 
     def __len__(self):
-        return len(self.buffer_forward)
+        return len(self.slices_forward)
+
+
+def generate_buffer_indices(n_steps: int, n_buffers: int, markov_p: float,
+                            rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """ Which buffer is active at each step. After every step, the next buffer
+        takes over with probability 1 - markov_p
+        Parameters:
+            - n_steps: number of steps
+            - n_buffers: number of buffers to cycle through
+            - markov_p: probability of staying on the current buffer
+            - rng: source of randomness, e.g. np.random.default_rng(seed) for
+              reproducible output. Unseeded if not given
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    switches = rng.random(n_steps) > markov_p
+    # Switches take effect from the step after they're drawn
+    return (np.cumsum(switches) - switches) % n_buffers
+
+
+def compose_timelines(
+    buffers: Sequence[VideoSliceBufferReversible],
+    timelines: Sequence[np.ndarray],
+    buffer_indices: np.ndarray,
+    step_all: bool = False,
+) -> list:
+    """ Resolves the slice played at each step, taken from whichever buffer is
+        active. Steps are grouped by buffer once, then each buffer resolves its
+        steps in one vectorized call
+        Parameters:
+            - buffers: buffers to draw slices from
+            - timelines: locations for each buffer, at least as long as buffer_indices
+            - buffer_indices: index of the active buffer at each step
+            - step_all: if true, every buffer steps through its whole timeline;
+              otherwise a buffer only steps while it's active
+    """
+    buffer_indices = np.asarray(buffer_indices, dtype=np.int64)
+    n_steps = len(buffer_indices)
+
+    # Steps of each buffer, in order: one stable sort rather than a mask per buffer
+    order = np.argsort(buffer_indices, kind="stable")
+    bounds = np.cumsum(np.bincount(buffer_indices, minlength=len(buffers)))[:-1]
+
+    video_list = np.empty(n_steps, dtype=object)
+    for buffer, timeline, steps in zip(buffers, timelines, np.split(order, bounds)):
+        timeline = np.asarray(timeline)[:n_steps]
+        if step_all:
+            # Every buffer moves at every step, but only the active steps are kept
+            forward, positions = buffer.resolve_positions(timeline)
+            forward, positions = forward[steps], positions[steps]
+            video_list[steps[forward]] = buffer.slices_forward[positions[forward]]
+            video_list[steps[~forward]] = buffer.slices_backward[positions[~forward]]
+        elif len(steps) > 0:
+            video_list[steps] = buffer.resolve_array(timeline[steps])
+
+    return video_list.tolist()
+
+
+class TimelineRecipe(object):
+    """ A composed timeline, written down as which source each slice comes
+        from and which of its frames, rather than as files. Encodes of the
+        same sources have the same frames whatever their size or settings, so
+        a timeline composed from drafts replays slice for slice, buffer
+        switches included, against the full encodes
+    """
+    version = 1
+
+    def __init__(self, fpaths_source: Sequence[str], n_forward: int, superframe_size: int,
+                 steps: np.ndarray):
+        """ Parameters:
+                - fpaths_source: forward sources, then backward sources
+                - n_forward: number of forward sources
+                - superframe_size: number of frames per slice
+                - steps: (source index, first frame, end frame) of each slice
+        """
+        self.fpaths_source = [str(fpath) for fpath in fpaths_source]
+        self.n_forward = n_forward
+        self.superframe_size = superframe_size
+        self.steps = np.asarray(steps, dtype=np.int64).reshape(-1, 3)
+
+    @classmethod
+    def from_video_list(cls, video_list: Sequence[Union[str, VirtualSlice]], fpaths_source: Sequence[str],
+                        locations: Sequence[str], n_forward: int, superframe_size: int) -> "TimelineRecipe":
+        """ Parameters:
+                - video_list: composed timeline of virtual slices or slice files
+                - fpaths_source: forward sources, then backward sources
+                - locations: encode (for virtual slices) or slice directory
+                  (for slice files) of each source
+                - n_forward: number of forward sources
+                - superframe_size: number of frames per slice
+        """
+        sources = {str(Path(location)): i for i, location in enumerate(locations)}
+        steps = []
+        for state in video_list:
+            if isinstance(state, VirtualSlice):
+                steps.append((sources[str(Path(state.fpath))], state.start, state.stop))
+            else:
+                fpath = Path(state)
+                start = int(SliceCompletion.pattern_slice.match(fpath.name).group(1))
+                steps.append((sources[str(fpath.parent)], start, start + superframe_size))
+
+        # Absolute, so the recipe can be replayed from anywhere
+        fpaths_source = [os.path.abspath(Path(fpath).expanduser()) for fpath in fpaths_source]
+        return cls(fpaths_source, n_forward, superframe_size, steps)
+
+    @classmethod
+    def load(cls, fpath: str) -> "TimelineRecipe":
+        with open(Path(fpath).expanduser(), 'r') as fid:
+            payload = json.load(fid)
+        if payload.get('version') != cls.version:
+            raise ValueError(f"{fpath} is a version {payload.get('version')} recipe, expected {cls.version}")
+        return cls(payload['sources'], payload['n_forward'], payload['superframe_size'], payload['steps'])
+
+    def save(self, fpath: str) -> str:
+        fpath = str(Path(fpath).expanduser())
+        with open(fpath, 'w') as fid:
+            json.dump({
+                'version': self.version,
+                'sources': self.fpaths_source,
+                'n_forward': self.n_forward,
+                'superframe_size': self.superframe_size,
+                'steps': self.steps.tolist(),
+            }, fid)
+        return fpath
+
+    def video_list(self, locations: Sequence[str], n_frames: Optional[Sequence[int]] = None) -> list:
+        """ Replays the timeline against encodes or slice directories
+            Parameters:
+                - locations: encode or slice directory of each source, in the
+                  order of fpaths_source. Slice directories give slice files,
+                  encodes give virtual slices
+                - n_frames: number of frames of each source's encode, to check
+                  every slice is there
+        """
+        if len(locations) != len(self.fpaths_source):
+            raise ValueError(f"recipe has {len(self.fpaths_source)} sources, got {len(locations)}")
+
+        if n_frames is not None:
+            stops = np.zeros(len(locations), dtype=np.int64)
+            np.maximum.at(stops, self.steps[:, 0], self.steps[:, 2])
+            short = np.flatnonzero(stops > np.asarray(n_frames))
+            if len(short) > 0:
+                raise ValueError(
+                    f"{self.fpaths_source[short[0]]} has {n_frames[short[0]]} frames, "
+                    f"the recipe needs {stops[short[0]]}"
+                )
+
+        sliced = [os.path.isdir(location) for location in locations]
+        video_list = []
+        for i, start, stop in self.steps.tolist():
+            if sliced[i]:
+                video_list.append(str(Path(locations[i]) / f"slice_{start}.avi"))
+            else:
+                video_list.append(VirtualSlice(locations[i], start, stop))
+        return video_list
 
 
 def generate_timeline_function(
@@ -342,13 +907,13 @@ def parse_args(ignore_requirements=False):
     )
     parser.add_argument(
         '-f', "--fpath_in_forward",
-        required=not ignore_requirements,
+        default=None,
         nargs="+",
         help="forward source video from which to sample"
     )
     parser.add_argument(
         '-b', "--fpath_in_backward",
-        required=not ignore_requirements,
+        default=None,
         nargs="+",
         help="backward source video from which to sample"
     )
@@ -364,6 +929,12 @@ def parse_args(ignore_requirements=False):
         type=float,
         help="probability of staying on current video"
     )
+    parser.add_argument(
+        "--seed",
+        default=None,
+        type=int,
+        help="seed for switching between videos. The same seed and inputs give the same output"
+    )
     parser.add_argument(
         "--n_superframes",
         default=400,
@@ -407,7 +978,15 @@ def parse_args(ignore_requirements=False):
     parser.add_argument(
         "--fpath_manifest",
         default=CompressurePersistence.defaults.fpath_manifest,
-        help="location of manifest file, which contains all transcode and slice metadata",
+        help="""location of manifest database, which contains all transcode and slice metadata.
+            A JSON manifest at the same location (or given here) is imported the first time""",
+    )
+    parser.add_argument(
+        "--cache_budget",
+        default=CacheDefaults.budget,
+        type=parse_size,
+        help="""most space encodes and slices may take up in the cache, e.g. 20G. Least
+            recently used slices, then encodes, are evicted past it. Unlimited by default""",
     )
     parser.add_argument(
         "--dpath_workdir",
@@ -420,19 +999,106 @@ def parse_args(ignore_requirements=False):
         type=int,
         help="number of workers to dispatch for parallelizable operations"
     )
+    parser.add_argument(
+        "--n_cores",
+        default=None,
+        type=int,
+        help="cores shared by encodes running at once, all of them by default"
+    )
+    parser.add_argument(
+        "--stage_timeout",
+        default=None,
+        type=float,
+        help="seconds each stage (encoding, exporting) may take before its ffmpeg "
+             "processes are killed and it fails, no limit by default"
+    )
+    parser.add_argument(
+        "--segmented",
+        action="store_true",
+        help="encode each source as segments of whole GOPs in parallel, then stitch them "
+             "together. Worth it for long sources with a small --gop_size"
+    )
+    parser.add_argument(
+        "--virtual",
+        action="store_true",
+        help="compose straight from frame ranges of the encodes instead of writing slice files"
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="slice straight from the encoder's output without writing or caching the encodes, "
+             "for one-off renders"
+    )
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="render from downscaled, quickly encoded proxies of the sources, to try out "
+             "settings. Use with --save_recipe to render the same timeline in full later"
+    )
+    parser.add_argument(
+        "--draft_scale",
+        default=VideoCompressionDefaults.draft_scale,
+        type=float,
+        help="factor drafts are downscaled by"
+    )
+    parser.add_argument(
+        "--draft_preset",
+        default=VideoCompressionDefaults.draft_preset,
+        help="libx264 preset of drafts"
+    )
+    parser.add_argument(
+        "--save_recipe",
+        default=None,
+        metavar="FPATH",
+        help="write the composed timeline to FPATH, to render again with --replay"
+    )
+    parser.add_argument(
+        "--replay",
+        default=None,
+        metavar="FPATH",
+        help="render the timeline saved with --save_recipe instead of composing a new one, "
+             "with the recipe's superframe size. Sources come from the recipe unless given"
+    )
+    parser.add_argument(
+        "--stream",
+        default=None,
+        metavar="DESTINATION",
+        help="""stream the output as AVI while it's composed, instead of writing --fpath_out.
+            DESTINATION is - for stdout, a named pipe, udp://host:port or tcp://host:port,
+            e.g. `--stream - | ffplay -`. UDP is sent as MPEG-TS, which survives lost packets"""
+    )
     args = parser.parse_args()
     if not ignore_requirements:
+        if args.replay is None and (args.fpath_in_forward is None or args.fpath_in_backward is None):
+            parser.error("--fpath_in_forward and --fpath_in_backward are required, unless replaying a recipe")
         assert args.scaled or args.rectified
     return args
 
 
 def main():
     args = parse_args()
+    if args.stream in StreamDefaults.stdout_aliases:
+        # stdout carries the video, so everything else is printed to stderr
+        sys.stdout = sys.stderr
+    fpath_out = args.fpath_out if args.stream is None else args.stream
+
     controller = CompressureSystem(
         fpath_manifest=args.fpath_manifest,
-        workdir=args.dpath_workdir
+        workdir=args.dpath_workdir,
+        cache_budget=args.cache_budget,
+        draft_scale=args.draft_scale,
+        draft_preset=args.draft_preset,
     )
     encoder_config = construct_encoder_config(args.encoder, args.encoder_config)
+
+    recipe = None
+    if args.replay is not None:
+        recipe = TimelineRecipe.load(args.replay)
+        args.superframe_size = recipe.superframe_size
+        if args.fpath_in_forward is None:
+            args.fpath_in_forward = recipe.fpaths_source[:recipe.n_forward]
+        if args.fpath_in_backward is None:
+            args.fpath_in_backward = recipe.fpaths_source[recipe.n_forward:]
     if args.pre_reverse_loop:
         raise NotImplementedError("reverse-looping needs work. don't use it")
         print("reverse-looping input")
@@ -442,108 +1108,154 @@ def main():
         fpath_in_forward = args.fpath_in_forward
         fpath_in_backward = args.fpath_in_backward
 
-    fpaths_encode_forward = [None for _ in fpath_in_forward]
-    dpaths_slices_forward = [None for _ in fpath_in_forward]
-    fpaths_encode_backward = [None for _ in fpath_in_backward]
-    dpaths_slices_backward = [None for _ in fpath_in_backward]
-
     fpaths_all = [fp for fp in fpath_in_forward]
     fpaths_all.extend(fpath_in_backward)
+    # Every source is probed up front, concurrently
+    metadata = probe_many(fpaths_all)
     # min_fps = get_min_fps(fpaths_all)
     min_pix_fmt = PixelFormatter().get_common_pix_fmt([
-        VideoMetadata(fpath).pix_fmt
-        for fpath in fpaths_all
+        md.pix_fmt
+        for md in metadata.values()
     ])
 
-    # For each path provided in forward
-    for i, fpath in enumerate(fpath_in_forward):
-        # TODO find min fps and min pix_fmt first, convert both in compress step
-        fpaths_encode_forward[i] = controller.compress(
-            fpath,
-            gop_size=args.gop_size,
-            encoder=args.encoder,
-            encoder_config=encoder_config,
-            pix_fmt=min_pix_fmt,
-        )
-        dpaths_slices_forward[i] = controller.slice(
-            fpath_source=fpath,
-            fpath_encode=fpaths_encode_forward[i],
-            superframe_size=args.superframe_size,
-            n_workers=args.n_workers,
-        )
-
-    if fpath_in_backward:
-        for i, fpath in enumerate(fpath_in_backward):
-            fpaths_encode_backward[i] = controller.compress(
-                fpath,
-                gop_size=args.gop_size,
-                encoder=args.encoder,
-                encoder_config=encoder_config,
-                pix_fmt=min_pix_fmt,
-            )
-            dpaths_slices_backward[i] = controller.slice(
-                fpath_source=fpath,
-                fpath_encode=fpaths_encode_backward[i],
-                superframe_size=args.superframe_size,
-                n_workers=args.n_workers,
-            )
-
-    dpaths_slices = zip(dpaths_slices_forward, dpaths_slices_backward)
-    buffers = []
-    for i, (dpath_slices_forward, dpath_slices_backward) in enumerate(dpaths_slices):
-
-        buffers.append(controller.init_buffer(
-            dpath_slices_forward,
-            dpath_slices_backward,
-            args.superframe_size
-        ))
-
-    # TODO pick up here
-    initial_state = deepcopy(buffers[0].state)
-    timelines = [generate_timeline_function(
-        args.superframe_size,
-        len(buffer),
-        frequency=args.frequency,
-        n_superframes=args.n_superframes - 1,
-        scaled=args.scaled,
-        rectified=args.rectified
-    ) for buffer in buffers]
-
-    if timelines[0][0] == initial_state:
-        video_list = []
-    else:
-        video_list = [initial_state]
-
-    # Which buffer is active?
-    buffer_index = 0
-
-    step_all = False
-
-    # These should be equal but we take min just in case
-    n_locations = min([len(t) for t in timelines])
-    for timeline_index in range(n_locations):
-
-        if step_all:
-            buffer_states = [
-                buffer.step(to=timeline[timeline_index])
-                for buffer, timeline in zip(buffers, timelines)
-            ]
-            video_list.append(buffer_states[buffer_index])
+    dpath_fused = None
+    if args.fused:
+        # Sliced straight from ffmpeg's output, into a directory that's removed
+        # once the output is written
+        dpath_fused = tempfile.mkdtemp(prefix=".fused-", dir=controller.persistence.workdir)
+    try:
+        with stage("encode", timeout=args.stage_timeout):
+            if args.fused:
+                sliced = controller.compress_to_slices(
+                    fpaths_all,
+                    args.superframe_size,
+                    dpath_fused,
+                    n_cores=args.n_cores,
+                    gop_size=args.gop_size,
+                    encoder=args.encoder,
+                    encoder_config=encoder_config,
+                    pix_fmt=min_pix_fmt,
+                    draft=args.draft,
+                )
+                locations = [dpath_slices for dpath_slices, _ in sliced]
+                n_frames = [len(packet_index) for _, packet_index in sliced]
+                buffers = [
+                    VideoSliceBufferReversible(
+                        dpath_slices_forward,
+                        dpath_slices_backward,
+                        args.superframe_size,
+                        packet_index_forward=packet_index_forward,
+                        packet_index_backward=packet_index_backward,
+                    )
+                    for (dpath_slices_forward, packet_index_forward), (dpath_slices_backward, packet_index_backward)
+                    in zip(sliced[:len(fpath_in_forward)], sliced[len(fpath_in_forward):])
+                ]
+            else:
+                # Forward and backward sources are encoded at once, sharing the cores
+                fpaths_encode = controller.compress_many(
+                    fpaths_all,
+                    n_cores=args.n_cores,
+                    gop_size=args.gop_size,
+                    encoder=args.encoder,
+                    encoder_config=encoder_config,
+                    pix_fmt=min_pix_fmt,
+                    segmented=args.segmented,
+                    draft=args.draft,
+                )
+                locations = fpaths_encode
+                n_frames = [
+                    len(PacketIndex.load(controller.index(fpath_source, fpath_encode)))
+                    for fpath_source, fpath_encode in zip(fpaths_all, fpaths_encode)
+                ]
+                fpaths_encode_forward = fpaths_encode[:len(fpath_in_forward)]
+                fpaths_encode_backward = fpaths_encode[len(fpath_in_forward):]
+
+                # The timeline is composed over virtual slices first. Unless --virtual is
+                # given, only the slices it actually visits are extracted, while the output
+                # is being written
+                fpaths_source = dict(zip(fpaths_encode_forward, fpath_in_forward))
+                fpaths_source.update(zip(fpaths_encode_backward, fpath_in_backward))
+
+                buffers = []
+                encodes = zip(fpath_in_forward, fpaths_encode_forward, fpath_in_backward, fpaths_encode_backward)
+                for fpath_source_forward, fpath_encode_forward, fpath_source_backward, fpath_encode_backward in encodes:
+                    buffers.append(controller.init_virtual_buffer(
+                        fpath_source_forward,
+                        fpath_encode_forward,
+                        fpath_source_backward,
+                        fpath_encode_backward,
+                        args.superframe_size,
+                    ))
+
+        if recipe is not None:
+            # The same slices, in the same order, from these encodes
+            video_list = recipe.video_list(locations, n_frames=n_frames)
         else:
-            video_list.append(buffers[buffer_index].step(to=timelines[buffer_index][timeline_index]))
+            # TODO pick up here
+            initial_state = deepcopy(buffers[0].state)
+            timelines = [generate_timeline_function(
+                args.superframe_size,
+                len(buffer),
+                frequency=args.frequency,
+                n_superframes=args.n_superframes - 1,
+                scaled=args.scaled,
+                rectified=args.rectified
+            ) for buffer in buffers]
+
+            if timelines[0][0] == initial_state:
+                video_list = []
+            else:
+                video_list = [initial_state]
 
-        if np.random.rand() > args.markov_p:
-            buffer_index = (buffer_index + 1) % len(timelines)
+            step_all = False
 
-    print(f"Concatenating {len(video_list)} videos")
-    concat_videos(video_list, fpath_out=args.fpath_out)
-    print(args.fpath_out)
+            # These should be equal but we take min just in case
+            n_locations = min([len(t) for t in timelines])
+            buffer_indices = generate_buffer_indices(
+                n_locations,
+                len(buffers),
+                args.markov_p,
+                rng=np.random.default_rng(args.seed),
+            )
+            video_list.extend(compose_timelines(buffers, timelines, buffer_indices, step_all=step_all))
+
+        if args.save_recipe is not None:
+            TimelineRecipe.from_video_list(
+                video_list,
+                fpaths_all,
+                locations,
+                len(fpath_in_forward),
+                args.superframe_size,
+            ).save(args.save_recipe)
+
+        duration = len(video_list) * args.superframe_size / buffers[0].packet_index_forward.fps
+        print(f"Concatenating {len(video_list)} videos ({duration:.2f}s)")
+        with stage("export", timeout=args.stage_timeout):
+            if args.fused or args.virtual:
+                controller.export(video_list, fpath_out=fpath_out)
+            else:
+                controller.export_timeline(
+                    video_list,
+                    fpaths_source,
+                    args.superframe_size,
+                    fpath_out,
+                    n_workers=args.n_workers,
+                )
+    except KeyboardInterrupt:
+        # Threads and workers may still be running ffmpeg, which is stopped
+        # before anything is cleaned up
+        cancel_all("interrupted")
+        raise
+    finally:
+        if dpath_fused is not None:
+            shutil.rmtree(dpath_fused, ignore_errors=True)
+    print(fpath_out)
 
 
 def get_min_fps(
     fpaths_in: Sequence[str],
 ) -> str:
-    metadata = [VideoMetadata(str(Path(fpath).expanduser())) for fpath in fpaths_in]
+    metadata = list(probe_many(fpaths_in).values())
     min_arg = np.argmin([md.framerate for md in metadata])
     return metadata[min_arg].framerate_fractional
 
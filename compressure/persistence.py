@@ -1,10 +1,20 @@
+from contextlib import contextmanager
+import fcntl
 import os
 from pathlib import Path
 import json
 import logging
-from typing import Optional, Union
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional, Union
+
+import numpy as np
 
 from compressure.exceptions import PersistenceOverwriteError, ExistingSourceError
+from compressure.file_interface import content_hash
 
 logging.basicConfig(filename='.persistence.log', level=logging.DEBUG)
 
@@ -12,8 +22,17 @@ logging.basicConfig(filename='.persistence.log', level=logging.DEBUG)
 class VideoPersistenceDefaults(object):
     # Default location is ./.cache
     workdir = Path("~/.cache/compressure/").expanduser()
-    fpath_manifest = workdir / "manifest.json"
+    fpath_manifest = workdir / "manifest.db"
+    # Older manifests, imported into the database the first time it's opened
+    fpath_manifest_json = workdir / "manifest.json"
     version = "1.0"
+    # sqlite keeps the manifest in a database, json in a single file that's
+    # rewritten on every change
+    manifest_backend = "sqlite"
+    manifest_backend_options = ("sqlite", "json")
+    # Seconds to wait for another process to finish writing to the manifest
+    # database before giving up
+    lock_timeout = 60.0
 
 
 class VideoCompressionPersistenceDefaults(object):
@@ -28,6 +47,194 @@ class VideoSlicerPersistenceDefaults(object):
     workdir = VideoPersistenceDefaults.workdir / "slices"
     fpath_manifest = workdir / "manifest.json"
     version = "0.0"
+    # Completion bitmap, kept in each slice directory
+    fname_completion = ".completed.npy"
+    # Seconds between saves of the bitmap while slicing
+    completion_save_interval = 2.0
+
+
+def size_on_disk(*fpaths: Optional[str]) -> int:
+    """ Total size in bytes of files and directories (recursively). Missing
+        ones count for nothing
+    """
+    size = 0
+    for fpath in fpaths:
+        if fpath is None:
+            continue
+        try:
+            if not os.path.isdir(fpath):
+                size += os.path.getsize(fpath)
+                continue
+            for entry in os.scandir(fpath):
+                if entry.is_dir(follow_symlinks=False):
+                    size += size_on_disk(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            pass
+    return size
+
+
+class FileLock(object):
+    """ Exclusive lock shared between processes, held on a lock file. The OS
+        drops the lock when its process dies, so a crashed run never leaves
+        it held. Reentrant for the object holding it, but not thread-safe on
+        its own
+    """
+    def __init__(self, fpath: str):
+        self.fpath = str(fpath)
+        self._fd = None
+        self._depth = 0
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """ Takes the lock, waiting for whoever holds it unless not blocking.
+            Returns whether the lock was taken
+        """
+        if self._fd is not None:
+            self._depth += 1
+            return True
+
+        while True:
+            fd = os.open(self.fpath, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+
+            # Whoever held it last may have removed the lock file on release,
+            # in which case we've locked a file nobody else can see
+            try:
+                current = os.fstat(fd).st_ino == os.stat(self.fpath).st_ino
+            except FileNotFoundError:
+                current = False
+
+            if current:
+                self._fd = fd
+                self._depth = 1
+                return True
+            os.close(fd)
+
+    def release(self, remove: bool = False):
+        """ Releases the lock, optionally removing the lock file first
+        """
+        self._depth -= 1
+        if self._depth > 0:
+            return
+
+        if remove:
+            os.remove(self.fpath)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class InProgressMarker(FileLock):
+    """ Marks a file as being made by the process holding it, so other
+        processes wait for it rather than making it again. The marker sits
+        next to the file and is removed once the file is made, or dropped if
+        the process making it dies
+    """
+    def __init__(self, fpath: str):
+        fpath = Path(fpath)
+        super().__init__(str(fpath.with_name(f".{fpath.name}.inprogress")))
+
+    def release(self):
+        super().release(remove=self._depth == 1)
+
+
+class SliceCompletion(object):
+    """ Bitmap of which slices of an (encode, superframe_size) pair have been
+        completely written. Slices are only marked once they're in place, and
+        the bitmap is saved atomically every few seconds and when slicing
+        ends, so an interrupted run resumes from where it was last saved
+    """
+    pattern_slice = re.compile(r"^slice_(\d+)\.avi$")
+
+    def __init__(self, dpath_slices: str, n_slices: int,
+                 save_interval: float = VideoSlicerPersistenceDefaults.completion_save_interval):
+        self.fpath = str(Path(dpath_slices) / VideoSlicerPersistenceDefaults.fname_completion)
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(self.fpath + ".lock")
+        self._time_saved = time.monotonic()
+        self._dirty = False
+
+        if os.path.exists(self.fpath):
+            self.completed = np.load(self.fpath)
+        else:
+            self.completed = self._from_existing(dpath_slices, n_slices)
+
+        if len(self.completed) != n_slices:
+            completed = np.zeros(n_slices, dtype=bool)
+            n = min(n_slices, len(self.completed))
+            completed[:n] = self.completed[:n]
+            self.completed = completed
+
+    @classmethod
+    def _from_existing(cls, dpath_slices: str, n_slices: int) -> np.ndarray:
+        """ Slice sets written before completion tracking count the slices
+            already on disk as complete
+        """
+        completed = np.zeros(n_slices, dtype=bool)
+        for fname in os.listdir(dpath_slices):
+            match = cls.pattern_slice.match(fname)
+            if match is not None and int(match.group(1)) < n_slices:
+                completed[int(match.group(1))] = True
+        return completed
+
+    def missing(self, indices: Optional[Iterable[int]] = None) -> np.ndarray:
+        """ Sorted, unique indices (all of them by default) of slices that
+            haven't been completed
+        """
+        if indices is None:
+            return np.flatnonzero(~self.completed)
+        indices = np.unique(np.fromiter(indices, dtype=np.int64))
+        return indices[~self.completed[indices]]
+
+    def mark(self, i: int):
+        with self._lock:
+            self.completed[i] = True
+            self._dirty = True
+            if time.monotonic() - self._time_saved >= self.save_interval:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            if self._dirty or not os.path.exists(self.fpath):
+                self._save()
+
+    def _save(self):
+        """ Saves the bitmap, merged with what other processes slicing the
+            same scheme have saved since it was loaded
+        """
+        with self._file_lock:
+            if os.path.exists(self.fpath):
+                completed = np.load(self.fpath)
+                n = min(len(completed), len(self.completed))
+                self.completed[:n] |= completed[:n]
+
+            fpath_tmp = self.fpath + ".tmp"
+            with open(fpath_tmp, 'wb') as fid:
+                np.save(fid, self.completed)
+            os.replace(fpath_tmp, self.fpath)
+
+        self._time_saved = time.monotonic()
+        self._dirty = False
+
+    def __len__(self):
+        return int(self.completed.sum())
 
 
 class VideoPersistence(object):
@@ -177,9 +384,13 @@ class CompressurePersistence(object):
     def __init__(self, fpath_manifest=VideoPersistenceDefaults.fpath_manifest,
                  workdir=VideoPersistenceDefaults.workdir,
                  autosave=True, expect_existing_manifest=False, overwrite=False,
-                 verbosity=0):
+                 verbosity=0, manifest_backend=VideoPersistenceDefaults.manifest_backend):
         self.verbosity = verbosity
-        self.manifest = CompressureManifest(
+        if manifest_backend not in self.defaults.manifest_backend_options:
+            raise ValueError(f"manifest_backend must be one of {self.defaults.manifest_backend_options}")
+
+        manifest_class = CompressureManifestSQLite if manifest_backend == "sqlite" else CompressureManifest
+        self.manifest = manifest_class(
             fpath=fpath_manifest,
             autosave=autosave,
             verbosity=verbosity
@@ -203,11 +414,21 @@ class CompressurePersistence(object):
     def save(self):
         self.manifest.save()
 
+    def refresh(self):
+        """ Picks up changes other processes have made to the manifest
+        """
+        self.manifest.refresh()
+
+    def in_progress(self, fpath: str) -> InProgressMarker:
+        """ Marker for a file being made, see InProgressMarker
+        """
+        return InProgressMarker(fpath)
+
     def __len__(self):
         return len(self.manifest)
 
     def __getitem__(self, fpath_source):
-        return self.manifest[fpath_source]
+        return self.manifest[self.source_key(fpath_source)]
 
     def __repr__(self):
         s = self.__class__.__name__
@@ -216,23 +437,108 @@ class CompressurePersistence(object):
         s += f" at {self.manifest.fpath}"
         return s
 
-    def get_encode(self, fpath_source: str, fpath_encode: str) -> dict:
-        return self.manifest.get_encode(fpath_source, fpath_encode)
+    def source_key(self, fpath_source: str) -> str:
+        """ Name a source is kept under in the manifest. Source files are known
+            by their contents (see file_interface.content_hash), so a renamed
+            or moved copy finds the entry of the original, and two different
+            files with the same name each get their own. Anything that isn't a
+            file, like a name from the manifest itself, is taken as the name
+        """
+        name = Path(fpath_source).name
+        if not os.path.isfile(fpath_source):
+            return name
+
+        source_hash = content_hash(fpath_source)
+        found = self.manifest.find_source(source_hash)
+        if found is not None:
+            return found
+
+        try:
+            existing = self.manifest.get_source(name)
+        except KeyError:
+            return name
+
+        # Sources added before they were hashed keep their name
+        if existing.get('hash') is None:
+            return name
+        return f"{Path(name).stem}-{source_hash[:8]}{Path(name).suffix}"
+
+    def _source_name(self, fpath_source: Optional[str], source_name: Optional[str]) -> str:
+        """ Manifest name of a source given by its path (see source_key), or
+            by its manifest name, which is taken as is. A manifest name is
+            never looked up as a path, since a file by that name in the
+            current directory may well be a different source
+        """
+        return self.source_key(fpath_source) if source_name is None else source_name
+
+    def get_encode(self, fpath_source: Optional[str], fpath_encode: str,
+                   source_name: Optional[str] = None) -> dict:
+        return self.manifest.get_encode(self._source_name(fpath_source, source_name), fpath_encode)
 
-    def remove_encode(self, fpath_source: str, fpath_encode: str) -> None:
-        os.remove(fpath_encode)
+    def add_encode(self, fpath_source: str, fpath_encode: str, parameters: dict,
+                   command: Optional[str] = None, index: Optional[str] = None) -> dict:
+        """ Adds an encode of a source file, adding the source, with its
+            content hash, if it's new
+        """
+        source = self.source_key(fpath_source)
+        source_hash = content_hash(fpath_source) if os.path.isfile(fpath_source) else None
+        try:
+            existing = self.manifest.get_source(source)
+        except KeyError:
+            self.manifest.add_source(fpath_source, name=source, content_hash=source_hash)
+        else:
+            if existing.get('hash') is None and source_hash is not None:
+                self.manifest.record_source_hash(source, source_hash)
+
+        return self.manifest.add_encode(source, fpath_encode, parameters, command=command, index=index)
+
+    def remove_encode(self, fpath_source: Optional[str], fpath_encode: str,
+                      source_name: Optional[str] = None) -> None:
+        """ Removes an encode, its packet index and its slice sets, from disk
+            and from the manifest
+            Parameters:
+                - fpath_source: path of the source
+                - fpath_encode: encode to remove
+                - source_name: manifest name of the source, used instead of
+                  fpath_source
+        """
+        fpath_source = self._source_name(fpath_source, source_name)
+        encode = self.manifest.get_encode(fpath_source, fpath_encode)
+        for superframe_size in list(encode['slices']['superframe_size'].keys()):
+            self.remove_slices(None, fpath_encode, superframe_size, source_name=fpath_source)
+
+        fpath_index = encode.get('index')
+        # Another process may have removed it already
+        if os.path.exists(encode['fpath']):
+            os.remove(encode['fpath'])
+        if fpath_index is not None and os.path.exists(fpath_index):
+            os.remove(fpath_index)
         self.manifest.remove_encode(fpath_source, fpath_encode)
 
+    def add_index(self, fpath_source: str, fpath_encode: str, fpath_index: str) -> dict:
+        """ Records the packet index of an encode
+        """
+        encode = self.manifest.add_index(self.source_key(fpath_source), fpath_encode, fpath_index)
+        if self.autosave:
+            self.save()
+        return encode
+
     def init_slices_dir(self, fpath_encode: str, superframe_size: int) -> str:
         slices_dir = self.manifest.get_slices_dir(fpath_encode, superframe_size)
         os.makedirs(slices_dir, exist_ok=True)
         return slices_dir
 
+    def get_slice_completion(self, fpath_encode: str, superframe_size: int, n_slices: int) -> SliceCompletion:
+        """ Gets the completion bitmap of a slice scheme on an encode
+        """
+        return SliceCompletion(self.init_slices_dir(fpath_encode, superframe_size), n_slices)
+
     def add_slices(self, fpath_source: str, fpath_encode: str, superframe_size: int):
         """ Add slices to manifest, capturing filepath in (to avoid
             reversing videos redundantly), human-readable name (to avoid
             transcoding videos redundantly)
         """
+        fpath_source = self.source_key(fpath_source)
         try:
             slices = self.manifest.get_slices(fpath_source, fpath_encode, superframe_size)
         except KeyError:
@@ -243,8 +549,44 @@ class CompressurePersistence(object):
 
         return slices
 
-    def get_slices(self, fpath_source: str, fpath_encode: str, superframe_size: int) -> dict:
-        return self.manifest.get_slices(fpath_source, fpath_encode, superframe_size)
+    def get_slices(self, fpath_source: Optional[str], fpath_encode: str, superframe_size: int,
+                   source_name: Optional[str] = None) -> dict:
+        return self.manifest.get_slices(self._source_name(fpath_source, source_name), fpath_encode, superframe_size)
+
+    def remove_slices(self, fpath_source: Optional[str], fpath_encode: str, superframe_size: int,
+                      source_name: Optional[str] = None) -> None:
+        """ Removes a slice set from disk and from the manifest
+            Parameters:
+                - fpath_source: path of the source
+                - fpath_encode: encode the slices are of
+                - superframe_size: superframe size of the slice set
+                - source_name: manifest name of the source, used instead of
+                  fpath_source
+        """
+        fpath_source = self._source_name(fpath_source, source_name)
+        dpath_slices = self.manifest.get_slices(fpath_source, fpath_encode, superframe_size)
+        shutil.rmtree(dpath_slices, ignore_errors=True)
+        # The encode's directory goes with its last slice set
+        try:
+            os.rmdir(Path(dpath_slices).parent)
+        except OSError:
+            pass
+        self.manifest.remove_slices(fpath_source, fpath_encode, superframe_size)
+
+    def touch(self, fpath_source: str, fpath_encode: str, superframe_size: Optional[int] = None) -> None:
+        """ Records that an encode, or one of its slice sets, was just used,
+            along with its size on disk. See cache.CacheManager
+        """
+        fpath_source = self.source_key(fpath_source)
+        if superframe_size is None:
+            encode = self.manifest.get_encode(fpath_source, fpath_encode)
+            size = size_on_disk(encode['fpath'], encode.get('index'))
+        else:
+            size = size_on_disk(self.manifest.get_slices(fpath_source, fpath_encode, superframe_size))
+
+        self.manifest.record_usage(
+            fpath_source, fpath_encode, superframe_size, size=size, last_access=time.time()
+        )
 
     def get_reversed(self, compression_obj):
         cached_compression = self.get_compression(compression_obj)
@@ -287,14 +629,20 @@ class CompressureManifest(object):
 
     def __init__(self, fpath: Optional[str] = None,
                  autosave: bool = True, verbosity: int = 1):
-        fpath = fpath if fpath is not None else self.defaults.fpath_manifest
+        fpath = Path(fpath if fpath is not None else self.defaults.fpath_manifest_json).expanduser()
 
-        self.fpath = Path(fpath).expanduser()
+        # The default location belongs to the database backend
+        self.fpath = fpath.with_suffix(".json") if fpath.suffix == ".db" else fpath
         self.autosave = autosave
         self.verbosity = verbosity
 
         self._sources, self._encodes, self._slices = None, None, None
 
+        # Changes are made under both, the first for threads in this process
+        # and the second for other processes
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(str(self.fpath) + ".lock")
+
         self._try_read()
 
     def _log_print(self, msg, log_op):
@@ -343,6 +691,7 @@ class CompressureManifest(object):
             )
 
         self.data = payload
+        self._dirty = False
 
     @property
     def _empty_payload(self):
@@ -355,10 +704,59 @@ class CompressureManifest(object):
         return payload
 
     def save(self):
-        """ Saves the manifest as a JSON file
+        """ Saves the manifest as a JSON file, if it's changed since it was
+            last saved. With autosave on, every change has been saved already.
+            With it off, this overwrites changes other processes have saved in
+            the meantime
+        """
+        with self._lock, self._file_lock:
+            # A new manifest is only written if no other process has since
+            if self._dirty or not self.fpath.exists():
+                self._write()
+
+    def _write(self):
+        """ Writes to a temporary file first, so a crash part way through
+            leaves the manifest as it was
         """
-        with open(str(self.fpath), 'w') as fid:
+        fpath_tmp = f"{self.fpath}.{os.getpid()}.tmp"
+        with open(fpath_tmp, 'w') as fid:
             json.dump(self.data, fid)
+        os.replace(fpath_tmp, str(self.fpath))
+        self._dirty = False
+
+    def refresh(self):
+        """ Reloads the manifest, picking up changes other processes have
+            saved. Unsaved changes are lost
+        """
+        with self._lock:
+            try:
+                with open(str(self.fpath), 'r') as fid:
+                    self.data = json.load(fid)
+            except FileNotFoundError:
+                return
+
+            self._dirty = False
+            self._sources, self._encodes, self._slices = None, None, None
+
+    @contextmanager
+    def _change(self):
+        """ Makes the changes within as a read-modify-write of the file when
+            autosaving, holding the lock so no other process's changes are
+            lost in between
+        """
+        with self._lock:
+            if not self.autosave:
+                yield
+                self._dirty = True
+                return
+
+            # Changes made within other changes are already up to date
+            outermost = not self._file_lock.locked
+            with self._file_lock:
+                if outermost:
+                    self.refresh()
+                yield
+                self._write()
 
     def get_source(self, fpath: str) -> dict:
         """ Gets the source entry for specified filepath, the root of all other
@@ -416,72 +814,98 @@ class CompressureManifest(object):
         dpath_parent = dpath_slices / Path(fpath_encode).stem / f'superframe-size={superframe_size}'
         return dpath_parent
 
-    def add_source(self, fpath: str) -> dict:
-        """ Adds a source file to the manifest with empty fields
+    def add_source(self, fpath: str, name: Optional[str] = None,
+                   content_hash: Optional[str] = None) -> dict:
+        """ Adds a source file to the manifest with empty fields, under its
+            file name unless given another
         """
-        fname = Path(fpath).name
-        if self.data['sources'].get(fname) is not None:
-            raise ExistingSourceError(self, fpath)
-
-        self.data['sources'][fname] = {
-            'fpath': fpath,
-            'encodes': {},
-            'reversals': {},
-            'reverse_loops': {},
-        }
-
-        if self.autosave:
-            self.save()
+        fname = Path(fpath).name if name is None else name
+        with self._change():
+            if self.data['sources'].get(fname) is not None:
+                raise ExistingSourceError(self, fpath)
+
+            self.data['sources'][fname] = {
+                'fpath': str(fpath),
+                'hash': content_hash,
+                'encodes': {},
+                'reversals': {},
+                'reverse_loops': {},
+            }
 
         # Reset lazy evaluation
         self._sources = None
 
-        return self.get_source(fpath)
+        return self.get_source(fname)
+
+    def find_source(self, content_hash: str) -> Optional[str]:
+        """ Name of the source with this content hash (see
+            file_interface.content_hash), if there is one
+        """
+        for source_name, source in self.data['sources'].items():
+            if source.get('hash') == content_hash:
+                return source_name
+        return None
+
+    def record_source_hash(self, fpath_source: str, content_hash: str) -> None:
+        """ Records the content hash of a source added before sources were
+            hashed
+        """
+        with self._change():
+            self.get_source(fpath_source)['hash'] = content_hash
 
     def add_encode(self, fpath_source: str, fpath_encode: str, parameters: dict,
-                   command: Optional[str] = None) -> dict:
+                   command: Optional[str] = None, index: Optional[str] = None) -> dict:
         """ Adds a specific encode to a source entry, with empty slices field
         """
-        try:
-            source = self.get_source(fpath_source)
-        except KeyError:
-            source = self.add_source(fpath_source)
+        with self._change():
+            try:
+                source = self.get_source(fpath_source)
+            except KeyError:
+                source = self.add_source(fpath_source)
 
-        encode_name = Path(fpath_encode).name
-        source['encodes'][encode_name] = {
-            'fpath': fpath_encode,
-            'parameters': parameters,
-            'command': command,
-            'slices': {'superframe_size': {}},
-        }
-        if self.autosave:
-            self.save()
+            encode_name = Path(fpath_encode).name
+            source['encodes'][encode_name] = {
+                'fpath': fpath_encode,
+                'parameters': parameters,
+                'command': command,
+                'index': index,
+                'slices': {'superframe_size': {}},
+            }
 
         # Reset lazy evaluation
         self._encodes = None
 
         return self.get_encode(fpath_source, fpath_encode)
 
+    def add_index(self, fpath_source: str, fpath_encode: str, fpath_index: str) -> dict:
+        """ Records the packet index file (see dataproc.PacketIndex) of an encode
+        """
+        with self._change():
+            encode = self.get_encode(fpath_source, fpath_encode)
+            encode['index'] = fpath_index
+
+        return encode
+
     def add_slices(self, fpath_source: str, fpath_encode: str, superframe_size: int) -> dict:
         """ Adds a slice scheme to an encode entry
         """
-        try:
-            encode = self.get_encode(fpath_source, fpath_encode)
-        except KeyError:
-            source_name = Path(fpath_source).name
-            encode_name = Path(fpath_encode).name
-            msg = f"Didn't find encode {encode_name} for source {source_name} in manifest"
-            raise KeyError(msg)
+        with self._change():
+            try:
+                encode = self.get_encode(fpath_source, fpath_encode)
+            except KeyError:
+                source_name = Path(fpath_source).name
+                encode_name = Path(fpath_encode).name
+                msg = f"Didn't find encode {encode_name} for source {source_name} in manifest"
+                raise KeyError(msg)
 
-        encode = self.get_encode(fpath_source, fpath_encode)
-        if len(encode['slices'].get('superframe_size', {})) > 0:
-            encode['slices']['superframe_size'].update({
-                superframe_size: str(self.get_slices_dir(fpath_encode, superframe_size))
-            })
-        else:
-            encode['slices']['superframe_size'] = {
-                superframe_size: str(self.get_slices_dir(fpath_encode, superframe_size))
-            }
+            if len(encode['slices'].get('superframe_size', {})) > 0:
+                encode['slices']['superframe_size'].update({
+                    superframe_size: str(self.get_slices_dir(fpath_encode, superframe_size))
+                })
+            else:
+                encode['slices']['superframe_size'] = {
+                    superframe_size: str(self.get_slices_dir(fpath_encode, superframe_size))
+                }
 
         # Reset lazy evaluation
         self._slices = None
@@ -542,9 +966,8 @@ class CompressureManifest(object):
 
     def remove_source(self, fpath_source: str) -> dict:
         source_name = Path(fpath_source).name
-        del self.data['sources'][source_name]
-        if self.autosave:
-            self.save()
+        with self._change():
+            del self.data['sources'][source_name]
 
         self._sources = None
         _ = self.sources
@@ -554,15 +977,82 @@ class CompressureManifest(object):
     def remove_encode(self, fpath_source: str, fpath_encode: str) -> dict:
         source_name = Path(fpath_source).name
         encode_name = Path(fpath_encode).name
-        del self.data['sources'][source_name]['encodes'][encode_name]
-        if self.autosave:
-            self.save()
+        with self._change():
+            del self.data['sources'][source_name]['encodes'][encode_name]
 
         self._encodes = None
         _ = self.encodes
 
         return self.data['sources'][source_name]
 
+    def remove_slices(self, fpath_source: str, fpath_encode: str, superframe_size: int) -> dict:
+        with self._change():
+            encode = self.get_encode(fpath_source, fpath_encode)
+            # Keys are strings once they've been through JSON
+            for key in (superframe_size, str(superframe_size)):
+                encode['slices']['superframe_size'].pop(key, None)
+            encode['slices'].get('usage', {}).pop(str(superframe_size), None)
+
+        self._slices = None
+
+        return encode
+
+    def record_usage(self, fpath_source: str, fpath_encode: str,
+                     superframe_size: Optional[int] = None,
+                     size: Optional[int] = None,
+                     last_access: Optional[float] = None) -> None:
+        """ Records the size and time of last use of an encode, or of one of
+            its slice sets if superframe_size is given. Fields left as None are
+            left as they were
+        """
+        with self._change():
+            encode = self.get_encode(fpath_source, fpath_encode)
+            if superframe_size is None:
+                entry = encode
+            else:
+                # Raises if there's no such slice set
+                self.get_slices(fpath_source, fpath_encode, superframe_size)
+                entry = encode['slices'].setdefault('usage', {}).setdefault(str(superframe_size), {})
+
+            if size is not None:
+                entry['size'] = size
+            if last_access is not None:
+                entry['last_access'] = last_access
+
+    def usage(self) -> list:
+        """ Size and time of last use of every encode and slice set, each as
+            a dict with source, encode, superframe_size (None for encodes),
+            fpath (directory, for slice sets), size and last_access. Sizes and
+            times never recorded are None
+        """
+        return self._usage_of(self.data)
+
+    @staticmethod
+    def _usage_of(data: dict) -> list:
+        entries = []
+        for source_name, source in data['sources'].items():
+            for encode_name, encode in source['encodes'].items():
+                entries.append({
+                    'source': source_name,
+                    'encode': encode_name,
+                    'superframe_size': None,
+                    'fpath': encode['fpath'],
+                    'size': encode.get('size'),
+                    'last_access': encode.get('last_access'),
+                })
+                usage = encode['slices'].get('usage', {})
+                for superframe_size, dpath in encode['slices']['superframe_size'].items():
+                    entry_usage = usage.get(str(superframe_size), {})
+                    entries.append({
+                        'source': source_name,
+                        'encode': encode_name,
+                        'superframe_size': int(superframe_size),
+                        'fpath': dpath,
+                        'size': entry_usage.get('size'),
+                        'last_access': entry_usage.get('last_access'),
+                    })
+        return entries
+
     def _index_into_data(self, source_name: str,
                          encode_name: Optional[str] = None,
                          superframe_size: Optional[int] = None
@@ -583,3 +1073,539 @@ class CompressureManifest(object):
             retval = slices
 
         return retval
+
+
+class CompressureManifestSQLite(CompressureManifest):
+    """ Manifest kept in an SQLite database (in WAL mode) instead of a JSON
+        file. Sources, encodes and slice sets each have their own table and
+        are looked up by indexed name, and each change is written in a single
+        transaction, so it only touches its own rows and a crash part way
+        through leaves the manifest as it was. A JSON manifest found next to
+        the database is imported the first time the database is opened.
+        Entries are handed back in the same layout as the JSON manifest's
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS sources (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            fpath TEXT NOT NULL,
+            reversals TEXT NOT NULL DEFAULT '{}',
+            reverse_loops TEXT NOT NULL DEFAULT '{}',
+            content_hash TEXT
+        );
+        CREATE TABLE IF NOT EXISTS encodes (
+            id INTEGER PRIMARY KEY,
+            source_id INTEGER NOT NULL REFERENCES sources (id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            fpath TEXT NOT NULL,
+            parameters TEXT NOT NULL,
+            command TEXT,
+            fpath_index TEXT,
+            size INTEGER,
+            last_access REAL,
+            UNIQUE (source_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS slice_sets (
+            id INTEGER PRIMARY KEY,
+            encode_id INTEGER NOT NULL REFERENCES encodes (id) ON DELETE CASCADE,
+            superframe_size INTEGER NOT NULL,
+            dpath TEXT NOT NULL,
+            size INTEGER,
+            last_access REAL,
+            UNIQUE (encode_id, superframe_size)
+        );
+    """
+    # Columns added since the first version of the schema
+    columns_added = {
+        'sources': ("content_hash TEXT",),
+        'encodes': ("size INTEGER", "last_access REAL"),
+        'slice_sets': ("size INTEGER", "last_access REAL"),
+    }
+
+    def __init__(self, fpath: Optional[str] = None,
+                 autosave: bool = True, verbosity: int = 1):
+        """ Parameters:
+                - fpath: database location. Given a JSON manifest, the
+                  database goes next to it
+                - autosave: kept for the JSON manifest's interface. Every
+                  change is committed as it's made either way, so no other
+                  process is kept from writing to the manifest for longer
+                  than a change takes
+                - verbosity: print log messages too
+        """
+        fpath = Path(fpath if fpath is not None else self.defaults.fpath_manifest).expanduser()
+
+        self.fpath = fpath.with_suffix(".db") if fpath.suffix == ".json" else fpath
+        self.fpath_json = self.fpath.with_suffix(".json")
+        self.autosave = autosave
+        self.verbosity = verbosity
+
+        # The connection is shared with slicing threads
+        self._lock = threading.RLock()
+        # Transactions open within the current one (see _transaction)
+        self._depth = 0
+        os.makedirs(self.fpath.parent, exist_ok=True)
+        exists = self.fpath.exists()
+        self._conn = sqlite3.connect(
+            str(self.fpath), timeout=self.defaults.lock_timeout, check_same_thread=False
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(self.schema)
+        self._migrate()
+
+        if exists:
+            n_sources = len(self)
+            msg = f"Found manifest at {self.fpath} with {n_sources} source"
+            msg += "s" if n_sources > 1 else ""
+            self._log_print(msg, logging.info)
+        else:
+            self._log_print(
+                f"No manifest database found at {self.fpath}, initializing new manifest",
+                logging.info
+            )
+
+        self._try_import()
+
+    def _migrate(self):
+        """ Adds columns missing from databases made by older versions
+        """
+        with self._transaction() as conn:
+            for table, columns in self.columns_added.items():
+                existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+                for column in columns:
+                    if column.split()[0] not in existing:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+            conn.execute("CREATE INDEX IF NOT EXISTS sources_content_hash ON sources (content_hash)")
+
+    @contextmanager
+    def _transaction(self):
+        """ Makes the changes within as one transaction, committed as soon as
+            it ends and rolled back if anything goes wrong. The database is
+            locked for writing from the start, so changes from other processes
+            are made one after the other, each on top of the last, rather than
+            failing when they meet. A transaction within another is a
+            savepoint of it: undone on its own if it fails, but only committed
+            along with the outermost one
+        """
+        with self._lock:
+            savepoint = f"nested_{self._depth}"
+            if self._depth == 0:
+                self._conn.execute("BEGIN IMMEDIATE")
+            else:
+                self._conn.execute(f"SAVEPOINT {savepoint}")
+
+            self._depth += 1
+            try:
+                yield self._conn
+            except BaseException:
+                if self._depth == 1:
+                    self._conn.rollback()
+                else:
+                    self._conn.execute(f"ROLLBACK TO {savepoint}")
+                    self._conn.execute(f"RELEASE {savepoint}")
+                raise
+            finally:
+                self._depth -= 1
+
+            if self._depth == 0:
+                self._conn.commit()
+            else:
+                self._conn.execute(f"RELEASE {savepoint}")
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _try_import(self):
+        """ Imports the JSON manifest this database replaces, only once
+        """
+        if len(self._query("SELECT value FROM meta WHERE key = 'imported'")) > 0:
+            return
+
+        try:
+            with open(str(self.fpath_json), 'r') as fid:
+                payload = json.load(fid)
+        except FileNotFoundError:
+            payload = self._empty_payload
+        except json.JSONDecodeError as e:
+            self._log_print(
+                f"Caught {e} importing {self.fpath_json} - this usually means the manifest is malformed. Try deleting the offending entry.",  # noqa
+                logging.error
+            )
+            raise e
+
+        with self._transaction() as conn:
+            # Another process may have imported it while we were reading it
+            imported = conn.execute("SELECT value FROM meta WHERE key = 'imported'").fetchone() is None
+            if imported:
+                self._import(conn, payload)
+
+        if imported and len(payload['sources']) > 0:
+            self._log_print(
+                f"Imported {len(payload['sources'])} sources from {self.fpath_json} into {self.fpath}",
+                logging.info
+            )
+
+    def _import(self, conn: sqlite3.Connection, payload: dict):
+        for source_name, source in payload['sources'].items():
+            conn.execute(
+                "INSERT OR IGNORE INTO sources (name, fpath, reversals, reverse_loops, content_hash) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (source_name, source['fpath'],
+                 json.dumps(source.get('reversals', {})), json.dumps(source.get('reverse_loops', {})),
+                 source.get('hash'))
+            )
+            for encode_name, encode in source['encodes'].items():
+                self._insert_encode(
+                    conn, source_name, encode_name, encode['fpath'], encode['parameters'],
+                    encode.get('command'), encode.get('index')
+                )
+                for superframe_size, dpath in encode['slices'].get('superframe_size', {}).items():
+                    self._insert_slices(conn, source_name, encode_name, int(superframe_size), dpath)
+
+        for entry in self._usage_of(payload):
+            self._record_usage(
+                conn, entry['source'], entry['encode'], entry['superframe_size'],
+                entry['size'], entry['last_access']
+            )
+
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('imported', ?)",
+            (str(self.fpath_json) if len(payload['sources']) > 0 else "",)
+        )
+
+    def save(self):
+        """ Nothing's left to commit, every change is committed as it's made
+        """
+        with self._lock:
+            self._conn.commit()
+
+    def refresh(self):
+        """ Nothing to do, every lookup reads what's been committed
+        """
+        return
+
+    def close(self):
+        self.save()
+        self._conn.close()
+
+    @property
+    def data(self) -> dict:
+        """ The whole manifest, in the JSON manifest's layout
+        """
+        return {
+            'version': self.version,
+            'sources': self._source_entries(),
+        }
+
+    def _source_entries(self, source_name: Optional[str] = None) -> dict:
+        """ Builds entries for one source (all of them by default), keyed by
+            name
+        """
+        where, params = ("WHERE s.name = ?", (source_name,)) if source_name is not None else ("", ())
+        with self._lock:
+            sources = self._conn.execute(
+                f"SELECT s.* FROM sources AS s {where} ORDER BY s.id", params
+            ).fetchall()
+            encodes = self._conn.execute(
+                "SELECT s.name AS source_name, e.* FROM encodes AS e "
+                f"JOIN sources AS s ON e.source_id = s.id {where} ORDER BY e.id", params
+            ).fetchall()
+            slice_sets = self._conn.execute(
+                "SELECT s.name AS source_name, e.name AS encode_name, ss.superframe_size, ss.dpath "
+                "FROM slice_sets AS ss JOIN encodes AS e ON ss.encode_id = e.id "
+                f"JOIN sources AS s ON e.source_id = s.id {where} ORDER BY ss.id", params
+            ).fetchall()
+
+        entries = {
+            row['name']: {
+                'fpath': row['fpath'],
+                'hash': row['content_hash'],
+                'encodes': {},
+                'reversals': json.loads(row['reversals']),
+                'reverse_loops': json.loads(row['reverse_loops']),
+            }
+            for row in sources
+        }
+        for row in encodes:
+            entries[row['source_name']]['encodes'][row['name']] = self._encode_entry(row)
+        for row in slice_sets:
+            encode = entries[row['source_name']]['encodes'][row['encode_name']]
+            encode['slices']['superframe_size'][row['superframe_size']] = row['dpath']
+
+        return entries
+
+    @staticmethod
+    def _encode_entry(row: sqlite3.Row, slice_sets: Iterable[sqlite3.Row] = ()) -> dict:
+        return {
+            'fpath': row['fpath'],
+            'parameters': json.loads(row['parameters']),
+            'command': row['command'],
+            'index': row['fpath_index'],
+            'size': row['size'],
+            'last_access': row['last_access'],
+            'slices': {'superframe_size': {
+                slice_set['superframe_size']: slice_set['dpath']
+                for slice_set in slice_sets
+            }},
+        }
+
+    @staticmethod
+    def _insert_encode(conn: sqlite3.Connection, source_name: str, encode_name: str,
+                       fpath_encode: str, parameters: dict, command: Optional[str],
+                       index: Optional[str]):
+        """ Inserts an encode, replacing (and dropping the slice sets of) any
+            encode by that name
+        """
+        conn.execute(
+            "DELETE FROM encodes WHERE name = ? AND source_id = (SELECT id FROM sources WHERE name = ?)",
+            (encode_name, source_name)
+        )
+        conn.execute(
+            "INSERT INTO encodes (source_id, name, fpath, parameters, command, fpath_index) "
+            "SELECT id, ?, ?, ?, ?, ? FROM sources WHERE name = ?",
+            (encode_name, str(fpath_encode), json.dumps(parameters), command, index, source_name)
+        )
+
+    @staticmethod
+    def _insert_slices(conn: sqlite3.Connection, source_name: str, encode_name: str,
+                       superframe_size: int, dpath: str) -> int:
+        return conn.execute(
+            "INSERT OR REPLACE INTO slice_sets (encode_id, superframe_size, dpath) "
+            "SELECT e.id, ?, ? FROM encodes AS e JOIN sources AS s ON e.source_id = s.id "
+            "WHERE s.name = ? AND e.name = ?",
+            (superframe_size, str(dpath), source_name, encode_name)
+        ).rowcount
+
+    def get_source(self, fpath: str) -> dict:
+        source_name = Path(fpath).name
+        try:
+            source = self._source_entries(source_name)[source_name]
+        except KeyError:
+            msg = f"Didn't find source {source_name} in manifest"
+            raise KeyError(msg)
+        return source
+
+    def get_encode(self, fpath_source: str, fpath_encode: str) -> dict:
+        source_name = Path(fpath_source).name
+        encode_name = Path(fpath_encode).name
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT e.* FROM encodes AS e JOIN sources AS s ON e.source_id = s.id "
+                "WHERE s.name = ? AND e.name = ?",
+                (source_name, encode_name)
+            ).fetchone()
+            if row is None:
+                # Raises if the source is what's missing
+                self.get_source(fpath_source)
+                msg = f"Didn't find encode {encode_name} for source {source_name} in manifest"
+                raise KeyError(msg)
+
+            slice_sets = self._conn.execute(
+                "SELECT superframe_size, dpath FROM slice_sets WHERE encode_id = ? ORDER BY id", (row['id'],)
+            ).fetchall()
+
+        return self._encode_entry(row, slice_sets)
+
+    def get_slices(self, fpath_source: str, fpath_encode: str, superframe_size: int) -> str:
+        rows = self._query(
+            "SELECT ss.dpath FROM slice_sets AS ss JOIN encodes AS e ON ss.encode_id = e.id "
+            "JOIN sources AS s ON e.source_id = s.id "
+            "WHERE s.name = ? AND e.name = ? AND ss.superframe_size = ?",
+            (Path(fpath_source).name, Path(fpath_encode).name, int(superframe_size))
+        )
+        if len(rows) == 0:
+            # Raises if the encode is what's missing
+            self.get_encode(fpath_source, fpath_encode)
+            encode_name = Path(fpath_encode).name
+            msg = f"Didn't find slices with superframe-size {superframe_size} for encode {encode_name} in manifest"  # noqa
+            raise KeyError(msg)
+
+        return rows[0]['dpath']
+
+    def add_source(self, fpath: str, name: Optional[str] = None,
+                   content_hash: Optional[str] = None) -> dict:
+        """ Adds a source file to the manifest with empty fields, under its
+            file name unless given another
+        """
+        name = Path(fpath).name if name is None else name
+        with self._transaction() as conn:
+            try:
+                conn.execute(
+                    "INSERT INTO sources (name, fpath, content_hash) VALUES (?, ?, ?)",
+                    (name, str(fpath), content_hash)
+                )
+            except sqlite3.IntegrityError:
+                raise ExistingSourceError(self, fpath)
+
+        return self.get_source(name)
+
+    def find_source(self, content_hash: str) -> Optional[str]:
+        rows = self._query("SELECT name FROM sources WHERE content_hash = ? ORDER BY id LIMIT 1", (content_hash,))
+        return rows[0]['name'] if len(rows) > 0 else None
+
+    def record_source_hash(self, fpath_source: str, content_hash: str) -> None:
+        with self._transaction() as conn:
+            n_updated = conn.execute(
+                "UPDATE sources SET content_hash = ? WHERE name = ?", (content_hash, Path(fpath_source).name)
+            ).rowcount
+            if n_updated == 0:
+                self.get_source(fpath_source)
+
+    def add_encode(self, fpath_source: str, fpath_encode: str, parameters: dict,
+                   command: Optional[str] = None, index: Optional[str] = None) -> dict:
+        """ Adds a specific encode to a source entry (adding the source if it's
+            new), with empty slices field
+        """
+        source_name = Path(fpath_source).name
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO sources (name, fpath) VALUES (?, ?)", (source_name, str(fpath_source))
+            )
+            self._insert_encode(
+                conn, source_name, Path(fpath_encode).name, fpath_encode, parameters, command, index
+            )
+
+        return self.get_encode(fpath_source, fpath_encode)
+
+    def add_index(self, fpath_source: str, fpath_encode: str, fpath_index: str) -> dict:
+        """ Records the packet index file (see dataproc.PacketIndex) of an encode
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE encodes SET fpath_index = ? WHERE name = ? "
+                "AND source_id = (SELECT id FROM sources WHERE name = ?)",
+                (str(fpath_index), Path(fpath_encode).name, Path(fpath_source).name)
+            )
+
+        return self.get_encode(fpath_source, fpath_encode)
+
+    def add_slices(self, fpath_source: str, fpath_encode: str, superframe_size: int) -> str:
+        """ Adds a slice scheme to an encode entry
+        """
+        with self._transaction() as conn:
+            n_added = self._insert_slices(
+                conn, Path(fpath_source).name, Path(fpath_encode).name, int(superframe_size),
+                self.get_slices_dir(fpath_encode, superframe_size)
+            )
+            if n_added == 0:
+                # Raises the missing source or encode
+                self.get_encode(fpath_source, fpath_encode)
+
+        return self.get_slices(fpath_source, fpath_encode, superframe_size)
+
+    def remove_source(self, fpath_source: str) -> dict:
+        source_name = Path(fpath_source).name
+        with self._transaction() as conn:
+            if conn.execute("DELETE FROM sources WHERE name = ?", (source_name,)).rowcount == 0:
+                raise KeyError(source_name)
+
+        return self._source_entries()
+
+    def remove_encode(self, fpath_source: str, fpath_encode: str) -> dict:
+        encode_name = Path(fpath_encode).name
+        with self._transaction() as conn:
+            n_removed = conn.execute(
+                "DELETE FROM encodes WHERE name = ? AND source_id = (SELECT id FROM sources WHERE name = ?)",
+                (encode_name, Path(fpath_source).name)
+            ).rowcount
+            if n_removed == 0:
+                raise KeyError(encode_name)
+
+        return self.get_source(fpath_source)
+
+    def remove_slices(self, fpath_source: str, fpath_encode: str, superframe_size: int) -> dict:
+        with self._transaction() as conn:
+            conn.execute(
+                "DELETE FROM slice_sets WHERE superframe_size = ? AND encode_id = ("
+                "SELECT e.id FROM encodes AS e JOIN sources AS s ON e.source_id = s.id "
+                "WHERE s.name = ? AND e.name = ?)",
+                (int(superframe_size), Path(fpath_source).name, Path(fpath_encode).name)
+            )
+
+        return self.get_encode(fpath_source, fpath_encode)
+
+    def record_usage(self, fpath_source: str, fpath_encode: str,
+                     superframe_size: Optional[int] = None,
+                     size: Optional[int] = None,
+                     last_access: Optional[float] = None) -> None:
+        with self._transaction() as conn:
+            n_updated = self._record_usage(
+                conn, Path(fpath_source).name, Path(fpath_encode).name, superframe_size, size, last_access
+            )
+            if n_updated == 0:
+                # Raises the missing source, encode or slice set
+                if superframe_size is None:
+                    self.get_encode(fpath_source, fpath_encode)
+                else:
+                    self.get_slices(fpath_source, fpath_encode, superframe_size)
+
+    @staticmethod
+    def _record_usage(conn: sqlite3.Connection, source_name: str, encode_name: str,
+                      superframe_size: Optional[int], size: Optional[int],
+                      last_access: Optional[float]) -> int:
+        encode_id = (
+            "SELECT e.id FROM encodes AS e JOIN sources AS s ON e.source_id = s.id "
+            "WHERE s.name = ? AND e.name = ?"
+        )
+        # Fields left as None are left as they were
+        assignments = "size = COALESCE(?, size), last_access = COALESCE(?, last_access)"
+        if superframe_size is None:
+            sql = f"UPDATE encodes SET {assignments} WHERE id = ({encode_id})"
+            params = (source_name, encode_name)
+        else:
+            sql = f"UPDATE slice_sets SET {assignments} WHERE superframe_size = ? AND encode_id = ({encode_id})"
+            params = (int(superframe_size), source_name, encode_name)
+
+        return conn.execute(sql, (size, last_access) + params).rowcount
+
+    def usage(self) -> list:
+        rows = self._query(
+            "SELECT s.name AS source, e.name AS encode, NULL AS superframe_size, e.fpath, "
+            "e.size, e.last_access FROM encodes AS e JOIN sources AS s ON e.source_id = s.id "
+            "UNION ALL "
+            "SELECT s.name, e.name, ss.superframe_size, ss.dpath, ss.size, ss.last_access "
+            "FROM slice_sets AS ss JOIN encodes AS e ON ss.encode_id = e.id "
+            "JOIN sources AS s ON e.source_id = s.id"
+        )
+        return [dict(row) for row in rows]
+
+    def __len__(self) -> int:
+        return self._query("SELECT COUNT(*) FROM sources")[0][0]
+
+    @property
+    def sources(self) -> list:
+        """ Simplified representation of source files in manifest
+        """
+        return [row['name'] for row in self._query("SELECT name FROM sources ORDER BY id")]
+
+    @property
+    def encodes(self) -> dict:
+        """ Simplified representation of encodes in manifest
+        """
+        encodes = {source_name: [] for source_name in self.sources}
+        for row in self._query(
+            "SELECT s.name AS source_name, e.name FROM encodes AS e "
+            "JOIN sources AS s ON e.source_id = s.id ORDER BY e.id"
+        ):
+            encodes.setdefault(row['source_name'], []).append(row['name'])
+        return encodes
+
+    @property
+    def slices(self) -> dict:
+        """ Simplified representation of encode slices in manifest
+        """
+        return {
+            source_name: {
+                encode_name: encode['slices']['superframe_size']
+                for encode_name, encode in source['encodes'].items()
+            }
+            for source_name, source in self._source_entries().items()
+        }
@@ -0,0 +1,302 @@
+""" Managed ffmpeg and ffprobe processes. Each one runs in a process group of
+    its own and belongs to a cancellation token. It's killed, along with
+    everything it started, when it outlives its timeout, when its token (or
+    the stage the token belongs to) is cancelled or times out, or when
+    whoever started it fails. Whatever it was writing is removed then too, so
+    the cache never keeps a half-written file
+"""
+from contextlib import contextmanager
+import logging
+import os
+import signal
+import subprocess
+import threading
+from typing import Callable, Iterator, Optional, Sequence
+
+from compressure.exceptions import CancelledError, SubprocessTimeoutError
+
+
+class ManagedProcessDefaults(object):
+    # Seconds a process gets to exit after SIGTERM before it's sent SIGKILL
+    kill_grace = 2.0
+    # Seconds a probe (ffprobe, ffmpeg -pix_fmts) may take
+    probe_timeout = 60.0
+    # Seconds extracting a single slice may take. Slices are copied rather
+    # than encoded, so one that takes this long is stuck
+    slice_timeout = 120.0
+
+
+class CancellationToken(object):
+    """ Cancels every managed process started under it, or under tokens
+        derived from it, once cancel is called or its timeout runs out. Work
+        that doesn't run processes checks it with raise_if_cancelled
+    """
+    def __init__(self, name: str,
+                 timeout: Optional[float] = None,
+                 parent: Optional["CancellationToken"] = None):
+        """ Parameters:
+                - name: what's being run under it, for messages
+                - timeout: seconds until it cancels itself, None for never
+                - parent: token whose cancellation cancels this one too
+        """
+        self.name = name
+        self.timeout = timeout
+        self.parent = parent
+        self.reason = None
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self.cancel, args=(f"{name} timed out after {timeout}s",))
+            self._timer.daemon = True
+            self._timer.start()
+
+        if parent is not None:
+            parent.add_callback(self._cancel_from_parent)
+
+    def _cancel_from_parent(self):
+        self.cancel(self.parent.reason)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def cancel(self, reason: str = "cancelled"):
+        """ Cancels the token, once. Everything running under it is killed
+            right away, from the calling thread
+        """
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks = list(self._callbacks)
+            self._callbacks = []
+
+        logging.warning(f"Cancelling {self.name}: {reason}")
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        """ Has callback called once the token is cancelled, right away if it
+            already is
+        """
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self):
+        if self.reason is not None:
+            raise CancelledError(self.reason)
+
+    def close(self):
+        """ Stops the timeout and detaches from the parent token, once
+            whatever ran under the token is done
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.parent is not None:
+            self.parent.remove_callback(self._cancel_from_parent)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name}, timeout={self.timeout}, reason={self.reason})"
+
+
+# Everything runs under this token unless a stage says otherwise, so
+# cancel_all reaches every process
+_root = CancellationToken("compressure")
+# Each thread's stack of tokens, innermost last (see using and stage)
+_local = threading.local()
+
+
+def _tokens() -> list:
+    if not hasattr(_local, 'tokens'):
+        _local.tokens = [_root]
+    return _local.tokens
+
+
+def current_token() -> CancellationToken:
+    """ Token of the innermost stage of this thread
+    """
+    return _tokens()[-1]
+
+
+@contextmanager
+def using(token: CancellationToken) -> Iterator[CancellationToken]:
+    """ Runs what's inside under token in this thread, e.g. to carry a stage
+        over into worker threads
+    """
+    tokens = _tokens()
+    tokens.append(token)
+    try:
+        yield token
+    finally:
+        tokens.remove(token)
+
+
+@contextmanager
+def stage(name: str, timeout: Optional[float] = None) -> Iterator[CancellationToken]:
+    """ Runs a stage of work (encoding, exporting, ...) under a token of its
+        own, derived from the current one, so the whole stage can be cancelled
+        or given a timeout
+        Parameters:
+            - name: what the stage does, for messages
+            - timeout: seconds the whole stage may take, None for no limit
+    """
+    token = CancellationToken(name, timeout=timeout, parent=current_token())
+    try:
+        with using(token):
+            yield token
+    finally:
+        token.close()
+
+
+def cancel_all(reason: str = "cancelled"):
+    """ Cancels everything, for good, e.g. when the user quits
+    """
+    _root.cancel(reason)
+
+
+def _signal_group(pid: int, signum: int):
+    try:
+        os.killpg(pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class ManagedProcess(object):
+    """ A subprocess in a process group of its own, killed with its group
+        when it outlives its timeout or its token is cancelled. Used as a
+        context manager around the process' lifetime:
+
+            with ManagedProcess(command, timeout=60, stdout=subprocess.PIPE) as process:
+                stdout, _ = process.popen.communicate()
+
+        On the way out, a process that's still running is waited for, or
+        killed if the block failed. One that was killed for its timeout or a
+        cancellation is raised as SubprocessTimeoutError or CancelledError.
+        Its outputs are removed unless it succeeded
+    """
+    # Every managed process of this process, so they can all be killed at
+    # once (see kill_running)
+    _running = set()
+    _running_lock = threading.Lock()
+
+    def __init__(self, command: Sequence[str],
+                 timeout: Optional[float] = None,
+                 fpaths_output: Sequence[str] = (),
+                 token: Optional[CancellationToken] = None,
+                 **kwargs):
+        """ Parameters:
+                - command: command to run
+                - timeout: seconds it may run, None for no limit
+                - fpaths_output: files it writes, removed unless it succeeds
+                - token: token it runs under, the current one by default
+                - kwargs: passed to subprocess.Popen
+        """
+        self.command = list(command)
+        self.timeout = timeout
+        self.fpaths_output = list(fpaths_output)
+        self.token = token
+        self.kwargs = kwargs
+        self.popen = None
+        self.pid_owner = os.getpid()
+        self.killed_for = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __enter__(self):
+        self.token = current_token() if self.token is None else self.token
+        self.token.raise_if_cancelled()
+        self.popen = subprocess.Popen(self.command, start_new_session=True, **self.kwargs)
+        with self._running_lock:
+            self._running.add(self)
+
+        self.token.add_callback(self._on_cancel)
+        if self.timeout is not None:
+            self._timer = threading.Timer(self.timeout, self.kill, args=("timeout",))
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def _on_cancel(self):
+        self.kill(self.token.reason)
+
+    def kill(self, reason: Optional[str] = None):
+        """ Terminates the process' group, then kills it if the process hasn't
+            exited within kill_grace seconds
+            Parameters:
+                - reason: why, raised on the way out. None when the process is
+                  only being cleaned up after a failure
+        """
+        with self._lock:
+            if self.killed_for is None:
+                self.killed_for = reason
+        if self.popen.poll() is not None:
+            return
+
+        logging.warning(f"Killing `{' '.join(str(a) for a in self.command)}`: {reason}")
+        _signal_group(self.popen.pid, signal.SIGTERM)
+        try:
+            self.popen.wait(timeout=ManagedProcessDefaults.kill_grace)
+        except subprocess.TimeoutExpired:
+            _signal_group(self.popen.pid, signal.SIGKILL)
+            self.popen.wait()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.popen.wait()
+            else:
+                self.kill()
+        finally:
+            if self._timer is not None:
+                self._timer.cancel()
+            self.token.remove_callback(self._on_cancel)
+            with self._running_lock:
+                self._running.discard(self)
+            for stream in (self.popen.stdin, self.popen.stdout, self.popen.stderr):
+                if stream is not None:
+                    stream.close()
+
+        if exc_type is not None or self.killed_for is not None or self.popen.returncode != 0:
+            for fpath in self.fpaths_output:
+                if os.path.isfile(fpath):
+                    os.remove(fpath)
+
+        if self.killed_for == "timeout":
+            raise SubprocessTimeoutError(self.popen, self.timeout) from exc_value
+        if self.killed_for is not None:
+            raise CancelledError(self.killed_for) from exc_value
+        return False
+
+
+def kill_running():
+    """ Kills every managed process of this process right away, e.g. when
+        it's about to be terminated
+    """
+    with ManagedProcess._running_lock:
+        processes = list(ManagedProcess._running)
+    for process in processes:
+        # A forked child still lists its parent's processes
+        if process.pid_owner == os.getpid():
+            _signal_group(process.popen.pid, signal.SIGKILL)
+
+
+def forget_parent():
+    """ Drops the processes and tokens a forked child copied from its
+        parent, which are the parent's to kill or cancel. The child's work
+        runs under a root token of its own
+    """
+    global _root, _local
+    ManagedProcess._running_lock = threading.Lock()
+    ManagedProcess._running = set()
+    _root = CancellationToken("compressure")
+    _local = threading.local()
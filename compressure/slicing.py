@@ -1,19 +1,33 @@
 from argparse import ArgumentParser
 from collections import deque
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 import os
 from pathlib import Path
 from pprint import pformat
+from typing import Iterable, Iterator, List, Optional, Sequence
 
 import numpy as np
 from tqdm import tqdm
 
-from compressure.dataproc import VideoMetadata, try_subprocess, concat_videos
+from compressure.dataproc import (
+    AVIHeader,
+    AVIPacket,
+    AVIReader,
+    AVIWriter,
+    PacketIndex,
+    VideoMetadata,
+    VirtualSlice,
+    concat_videos,
+    try_subprocess,
+)
 from compressure.persistence import (
+    SliceCompletion,
     VideoCompressionPersistenceDefaults,
     VideoSlicerPersistenceDefaults,
 )
-from compressure.compression import VideoCompressionDefaults, VideoCompressionSystem
+from compressure.compression import SingleVideoCompression, VideoCompressionDefaults, VideoCompressionSystem
+from compressure.workers import WorkerPool
+from compressure.processes import current_token, ManagedProcessDefaults, using
 from compressure.exceptions import (
     EncoderSelectionError,
     MalformedConfigurationError,
@@ -23,62 +37,317 @@ from compressure.exceptions import (
 
 class VideoSlicerDefaults(object):
     workdir = VideoSlicerPersistenceDefaults.workdir
+    # "demux" reads the encode once and writes every slice in that one pass,
+    # "ffmpeg" runs one ffmpeg process per slice
+    engine = "demux"
+    engine_options = ("demux", "ffmpeg")
+
+
+def partial_fpath(fpath: str) -> str:
+    """ Where a file is written before being moved into place, so readers and
+        resumed runs never see it half-written. Named for the process writing
+        it, so processes sharing a cache never write over each other's
+    """
+    fpath = Path(fpath)
+    return str(fpath.with_name(f".{fpath.stem}.{os.getpid()}.partial{fpath.suffix}"))
+
+
+def extract_single_slice(
+    fpath_in: str,
+    fpath_out: str,
+    start_time: float,
+    slice_duration: float,
+):
+    """ Extracts one slice with ffmpeg, without re-encoding. The slice only
+        appears at fpath_out once it's complete
+    """
+    fpath_partial = partial_fpath(fpath_out)
+    command = [
+        "ffmpeg", "-y",
+        "-v", "error",
+        "-i", fpath_in,
+        "-c", "copy",
+        "-ss", f"{start_time:.6f}",
+        "-t", f"{slice_duration:.6f}",
+        "-copyinkf",
+        fpath_partial
+    ]
+    # A slice that's stuck is killed and its partial file removed, freeing
+    # the worker for the next one
+    process = try_subprocess(command, timeout=ManagedProcessDefaults.slice_timeout, fpaths_output=[fpath_partial])
+    os.replace(fpath_partial, fpath_out)
+    return process
+
+
+def write_slice(fpath_slice: str, packets: Iterable[AVIPacket], header: AVIHeader) -> str:
+    """ Writes a slice from its packets, only moving it into place once it's
+        fully written
+    """
+    fpath_partial = partial_fpath(fpath_slice)
+    try:
+        with AVIWriter(fpath_partial, header) as writer:
+            writer.write_all(packets)
+    except BaseException:
+        if os.path.exists(fpath_partial):
+            os.remove(fpath_partial)
+        raise
+    os.replace(fpath_partial, fpath_slice)
+    return fpath_slice
+
+
+def slice_stream(reader: AVIReader, superframe_size: int, workdir: str) -> PacketIndex:
+    """ Cuts a stream of packets into every slice as the packets arrive,
+        keeping only the last superframe_size of them in memory, like
+        VideoSlicer.slice_video_single_pass but for a stream that can only be
+        read once, such as a pipe from ffmpeg (see transcode_to_slices)
+        Returns:
+            - index of the stream's packets, for the number of slices and the
+              frame rate. Its offsets are positions in the stream, not in a file
+    """
+    os.makedirs(workdir, exist_ok=True)
+    entries = []
+    window = deque(maxlen=superframe_size)
+    for packet in tqdm(reader.packets(), desc=f"[slicing] superframe_size {superframe_size}"):
+        size = len(packet.data)
+        entries.append((0, reader.position - size - size % 2, size, packet.keyframe))
+        window.append(packet)
+        if len(window) == superframe_size:
+            i = len(entries) - superframe_size
+            write_slice(str(Path(workdir) / f"slice_{i}.avi"), window, reader.header)
+
+    rate, scale = reader.header.framerate_fractional
+    packets = np.array(entries, dtype=PacketIndex.dtype)
+    packets['pts_us'] = np.arange(len(packets), dtype=np.int64) * scale * 1_000_000 // rate
+    return PacketIndex(packets, (rate, scale))
+
+
+def transcode_to_slices(compressor: SingleVideoCompression, superframe_size: int, workdir: str) -> PacketIndex:
+    """ Transcodes a video straight into slices, without writing the encode:
+        ffmpeg's output is piped into slice_stream. For one-off renders, where
+        the encode wouldn't be used again
+        Returns:
+            - index of the encode's packets, see slice_stream
+    """
+    with compressor.transcode_stream() as reader:
+        return slice_stream(reader, superframe_size, workdir)
+
+
+def _extract_indexed_slice(i, fpath_in, fpath_out, start_time, slice_duration):
+    extract_single_slice(fpath_in, fpath_out, start_time, slice_duration)
+    return i
 
 
 class VideoSlicer(object):
     def __init__(self, fpath_in, superframe_size=6,
                  workdir=VideoSlicerDefaults.workdir,
+                 packet_index: Optional[PacketIndex] = None,
+                 completion: Optional[SliceCompletion] = None,
                  ):
+        """ Parameters:
+                - fpath_in: encode to slice
+                - superframe_size: number of frames per slice
+                - workdir: where slices are written
+                - packet_index: index of the encode. If given, frame timing is
+                  read from it instead of probing the encode
+                - completion: completion bitmap of this slice scheme. If given,
+                  finished slices are recorded there and never redone;
+                  otherwise slices on disk count as finished
+        """
         self.fpath_in = fpath_in
+        self.packet_index = packet_index
         self.video_metadata = VideoMetadata(self.fpath_in)
         self.superframe_size = superframe_size
-        self.slice_duration = self.superframe_size / self.video_metadata.fps
+        self.slice_duration = self.superframe_size / self.fps
         self.workdir = str(Path(workdir))
         os.makedirs(self.workdir, exist_ok=True)
 
         self._init_start_times()
-        self.slices = [str(Path(self.workdir) / f"slice_{i}.avi") for i in range(len(self.start_times))]
+        self.slices = [self.slice_fpath(i) for i in range(len(self.start_times))]
+        self.completion = completion
+        self._header = None
 
-    def _init_start_times(self):
-        self.start_times = np.arange(
-            0,
-            self.video_metadata.duration - self.superframe_size / self.video_metadata.fps,
-            1 / self.video_metadata.fps
-        )
+    @property
+    def header(self) -> AVIHeader:
+        if self._header is None:
+            with AVIReader(self.fpath_in) as reader:
+                self._header = reader.header
+        return self._header
+
+    @property
+    def native(self) -> bool:
+        """ Whether slices can be copied straight out of the encode through its
+            packet index, rather than extracted by ffmpeg
+        """
+        return self.packet_index is not None and Path(self.fpath_in).suffix.lower() == ".avi"
 
-    def slice_video(self, n_workers=0):
-        if n_workers > 0:
-            args_list = [
-                (
-                    self.fpath_in,
-                    self.slices[i],
-                    start_time,
-                    self.slice_duration
-                )
-                for i, start_time in enumerate(self.start_times)
-            ]
-            with Pool(n_workers) as p:
-                p.starmap(
-                    self.extract_single_slice,
-                    tqdm(
-                        args_list,
-                        total=len(args_list),
-                        desc=f"[slicing] superframe_size: {self.superframe_size}"
-                    )
-                )
+    @property
+    def fps(self):
+        if self.packet_index is not None:
+            return self.packet_index.fps
+        return self.video_metadata.fps
+
+    def slice_fpath(self, i: int) -> str:
+        return str(Path(self.workdir) / f"slice_{i}.avi")
+
+    def missing_slices(self, indices: Optional[Iterable[int]] = None) -> List[int]:
+        """ Sorted, unique slice indices (all of them by default) that haven't
+            been written yet
+        """
+        if self.completion is not None:
+            return [int(i) for i in self.completion.missing(indices)]
+
+        indices = range(len(self.slices)) if indices is None else indices
+        existing = set(os.listdir(self.workdir))
+        return sorted({int(i) for i in indices if f"slice_{int(i)}.avi" not in existing})
 
+    def _init_start_times(self):
+        if self.packet_index is not None:
+            n_slices = self.packet_index.n_slices(self.superframe_size)
+            self.start_times = self.packet_index.pts_us[:n_slices] / 1e6
         else:
-            for i, start_time in tqdm(
-                enumerate(self.start_times),
-                total=len(self.start_times),
-                desc=f"[slicing] superframe_size {self.superframe_size}"
-            ):
-                self.extract_single_slice(
-                    str(self.fpath_in),
-                    self.slices[i],
-                    start_time,
-                    self.slice_duration
-                )
+            n_slices = max(self._count_frames() - self.superframe_size + 1, 0)
+            self.start_times = np.arange(n_slices) / self.video_metadata.fps
+
+    def _count_frames(self) -> int:
+        """ Number of frames in the encode, counted from its packets where it
+            can be, since a duration rarely comes out at a whole number of
+            frames
+        """
+        if Path(self.fpath_in).suffix.lower() == ".avi":
+            with AVIReader(self.fpath_in) as reader:
+                return sum(1 for _ in reader.packet_entries())
+        return int(round(self.video_metadata.duration * self.video_metadata.fps))
+
+    def _mark_complete(self, i: int):
+        if self.completion is not None:
+            self.completion.mark(i)
+
+    def _save_completion(self):
+        if self.completion is not None:
+            self.completion.save()
+
+    def _write_slice(self, i: int, packets: Iterable[AVIPacket], header: AVIHeader) -> str:
+        """ Writes slice i from its packets, moving it into place and marking
+            it complete only once it's fully written
+        """
+        fpath_slice = write_slice(self.slice_fpath(i), packets, header)
+        self._mark_complete(i)
+        return fpath_slice
+
+    def slice_video(self, n_workers=0, engine: Optional[str] = None):
+        """ Writes all slices that haven't been written yet to the working
+            directory
+            Parameters:
+                - n_workers: number of processes to use, ffmpeg engine only
+                - engine: one of VideoSlicerDefaults.engine_options. The demux
+                  engine only reads AVI, so other containers fall back to ffmpeg
+        """
+        engine = VideoSlicerDefaults.engine if engine is None else engine
+        if engine not in VideoSlicerDefaults.engine_options:
+            raise ValueError(f"engine must be one of {VideoSlicerDefaults.engine_options}, not {engine}")
+
+        if engine == "demux" and Path(self.fpath_in).suffix.lower() == ".avi":
+            self.slice_video_single_pass()
+        else:
+            self._slice_indices_ffmpeg(self.missing_slices(), n_workers=n_workers)
+
+    def slice_video_single_pass(self):
+        """ Reads the encode's packets once, keeping the last superframe_size
+            of them in memory, and writes each overlapping window as a slice
+            as soon as it's complete. Slice i holds packets [i, i + superframe_size).
+            Slices that are already complete are skipped
+        """
+        missing = set(self.missing_slices())
+        n_listed = len(self.slices)
+        slices = []
+        window = deque(maxlen=self.superframe_size)
+        try:
+            with AVIReader(self.fpath_in) as reader:
+                for packet in tqdm(
+                    reader.packets(),
+                    total=reader.header.main['total_frames'] or None,
+                    desc=f"[slicing] superframe_size {self.superframe_size}"
+                ):
+                    window.append(packet)
+                    if len(window) < self.superframe_size:
+                        continue
+
+                    i = len(slices)
+                    # Windows past those counted up front (see
+                    # _init_start_times) haven't been written either
+                    if i in missing or (i >= n_listed and self.completion is None):
+                        self._write_slice(i, window, reader.header)
+                    slices.append(self.slice_fpath(i))
+        finally:
+            self._save_completion()
+
+        self.slices = slices
+
+    def slice_indices(self, indices: Iterable[int], n_workers=0) -> List[str]:
+        """ Writes only the given slices, skipping any that are already
+            complete, so a timeline extracts just the superframes it visits and
+            later calls only add what's missing. With a packet index, each slice
+            is one contiguous read from the encode; otherwise ffmpeg extracts it
+            Parameters:
+                - indices: slice indices, in any order and possibly repeated
+                - n_workers: number of processes to use, ffmpeg only
+            Returns:
+                - paths of the slices that were written
+        """
+        missing = self.missing_slices(indices)
+        if len(missing) == 0:
+            return []
+
+        if not self.native:
+            return self._slice_indices_ffmpeg(missing, n_workers=n_workers)
+
+        desc = f"[slicing] superframe_size {self.superframe_size}, {len(missing)} of {len(self.slices)}"
+        try:
+            with open(self.fpath_in, 'rb') as fid:
+                for i in tqdm(missing, desc=desc):
+                    self.extract_slice(i, fid)
+        finally:
+            self._save_completion()
+
+        return [self.slice_fpath(i) for i in missing]
+
+    def _slice_indices_ffmpeg(self, missing: List[int], n_workers=0) -> List[str]:
+        """ Extracts slices with ffmpeg on a WorkerPool, marking each complete
+            as soon as it's written. Slices that fail even after retrying are
+            raised in a WorkerPoolError once all the others are done
+        """
+        tasks = (
+            (i, self.fpath_in, self.slice_fpath(i), self.start_times[i], self.slice_duration)
+            for i in missing
+        )
+        pool = WorkerPool(
+            n_workers=n_workers,
+            desc=f"[slicing] superframe_size {self.superframe_size}, {len(missing)} of {len(self.slices)}",
+        )
+        try:
+            for i in pool.imap(_extract_indexed_slice, tasks, n_tasks=len(missing)):
+                self._mark_complete(i)
+        finally:
+            self._save_completion()
+
+        return [self.slice_fpath(i) for i in missing]
+
+    def extract_slice(self, i: int, fid=None) -> str:
+        """ Writes slice i and marks it complete. Natively, fid is an already
+            open handle on the encode; one is opened if not given
+            Returns:
+                - path of the slice
+        """
+        fpath_slice = self.slice_fpath(i)
+        if not self.native:
+            extract_single_slice(self.fpath_in, fpath_slice, self.start_times[i], self.slice_duration)
+            self._mark_complete(i)
+        elif fid is None:
+            with open(self.fpath_in, 'rb') as fid:
+                self.extract_slice(i, fid)
+        else:
+            self._write_slice(i, self.packet_index.read_packets(fid, i, i + self.superframe_size), self.header)
+        return fpath_slice
 
     def extract_single_slice(
         self,
@@ -87,18 +356,7 @@ class VideoSlicer(object):
         start_time: float,
         slice_duration: float,
     ):
-        command = [
-            "ffmpeg", "-y",
-            "-v", "error",
-            "-i", fpath_in,
-            "-c", "copy",
-            "-ss", f"{start_time:.3f}",
-            "-t", f"{slice_duration:.3f}",
-            "-copyinkf",
-            fpath_out
-        ]
-        process = try_subprocess(command)
-        return process
+        return extract_single_slice(fpath_in, fpath_out, start_time, slice_duration)
 
     @property
     def human_readable_string(self):
@@ -107,6 +365,94 @@ class VideoSlicer(object):
         return s
 
 
+class SliceScheduler(object):
+    """ Pipelines slicing with composing: the slices a timeline visits are
+        extracted on a pool of worker threads, queued in order of first use so
+        the earliest needed are ready first, and handed out in timeline order
+        as soon as each one is written. Feeding iter(scheduler) to
+        dataproc.concat_avi_videos muxes the output while slicing runs
+    """
+    def __init__(self, video_list: Sequence[VirtualSlice], slicers: dict, n_workers: int = 1):
+        """ Parameters:
+                - video_list: timeline of virtual slices
+                - slicers: VideoSlicer of each encode in video_list, keyed by encode path
+                - n_workers: number of worker threads, at least one
+        """
+        self.video_list = video_list
+        self.slicers = slicers
+        self.n_workers = max(n_workers, 1)
+        self._futures = {}
+        self._executor = None
+        self._token = None
+
+    def start(self):
+        """ Queues every missing slice. Slices that are already cached aren't
+            queued and are handed out right away
+        """
+        indices = {}
+        for virtual_slice in self.video_list:
+            indices.setdefault(virtual_slice.fpath, set()).add(virtual_slice.start)
+        missing = {
+            fpath: set(self.slicers[fpath].missing_slices(indices_encode))
+            for fpath, indices_encode in indices.items()
+        }
+
+        # Slices are extracted under the caller's stage, so cancelling it
+        # stops them too
+        self._token = current_token()
+        self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        for virtual_slice in self.video_list:
+            key = (virtual_slice.fpath, virtual_slice.start)
+            if key in self._futures or virtual_slice.start not in missing[virtual_slice.fpath]:
+                continue
+
+            slicer = self.slicers[virtual_slice.fpath]
+            if slicer.native:
+                # Read once here rather than racing to read it in every worker
+                slicer.header
+            self._futures[key] = self._executor.submit(self._extract_slice, slicer, virtual_slice.start)
+
+        return self
+
+    def _extract_slice(self, slicer: VideoSlicer, start: int) -> str:
+        with using(self._token):
+            return slicer.extract_slice(start)
+
+    def __len__(self):
+        return len(self._futures)
+
+    def __iter__(self) -> Iterator[str]:
+        if self._executor is None:
+            self.start()
+
+        try:
+            for virtual_slice in tqdm(
+                self.video_list,
+                desc=f"[slicing] {len(self._futures)} slices, {self.n_workers} workers"
+            ):
+                future = self._futures.get((virtual_slice.fpath, virtual_slice.start))
+                if future is not None:
+                    future.result()
+                yield self.slicers[virtual_slice.fpath].slice_fpath(virtual_slice.start)
+        finally:
+            self.close()
+
+    def close(self):
+        """ Cancels slices that haven't started, waits for the rest and saves
+            what's been completed
+        """
+        if self._executor is None:
+            return
+
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+        for slicer in self.slicers.values():
+            slicer._save_completion()
+
+
 class VideoCompressureValve(object):
     def __init__(self, fpath_in, superframe_size=6,
                  workdir=VideoCompressionPersistenceDefaults.workdir):
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 from copy import deepcopy
 import logging
 from pathlib import Path
@@ -6,12 +7,13 @@ from typing import (
     List,
 )
 
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, pyqtSignal
 from PyQt6.QtGui import (
     QIcon,
 )
 from PyQt6.QtWidgets import (
     QApplication,
+    QCheckBox,
     QComboBox,
     QFileDialog,
     QFrame,
@@ -31,20 +33,29 @@ from PyQt6.QtWidgets import (
 import pyqtgraph
 
 from compressure.compression import (
+    EncodeScheduler,
     VideoCompressionDefaults,
 )
 
 from compressure.config import APP_NAME, LOG_FPATH, LOG_LEVEL
 
 from compressure.dataproc import (
-    concat_videos,
-    VideoMetadata,
+    add_progress_listener,
+    probe_many,
+    remove_progress_listener,
 )
 
 from compressure.exceptions import (
+    CancelledError,
     EncoderSelectionError,
 )
 
+from compressure.processes import (
+    cancel_all,
+    stage,
+    using,
+)
+
 from compressure.main import (
     CompressureSystem,
     parse_args,
@@ -57,11 +68,18 @@ logging.basicConfig(filename=LOG_FPATH, level=LOG_LEVEL)
 
 class MainWindow(QMainWindow):
     encoder_options = VideoCompressionDefaults.encoder_config_options.keys()
+    # ffmpeg progress reports come from whichever thread runs ffmpeg, so they
+    # reach the status bar through a signal
+    ffmpeg_progress = pyqtSignal(dict)
 
     def __init__(self):
         super().__init__()
         self._init_layout()
 
+        self._ffmpeg_jobs = {}
+        self.ffmpeg_progress.connect(self.show_ffmpeg_progress)
+        add_progress_listener(self.ffmpeg_progress.emit)
+
     def _init_layout(self):
         self.setWindowTitle(APP_NAME)
 
@@ -72,10 +90,12 @@ class MainWindow(QMainWindow):
         self.controller = CompressureSystem(
             fpath_manifest=args.fpath_manifest,
             workdir=args.dpath_workdir,
+            cache_budget=args.cache_budget,
         )
 
         self.exporter = ExporterMenu(
-            controller=self.controller
+            controller=self.controller,
+            n_workers=args.n_workers,
         )
         self.slicer = SlicerMenu(
             n_workers=args.n_workers,
@@ -100,6 +120,11 @@ class MainWindow(QMainWindow):
         self.slicer.fpath_encode_b = self.importer.fpath_encode_b
         self.exporter.dpath_slices_f = self.slicer.dpath_slices_f
         self.exporter.dpath_slices_b = self.slicer.dpath_slices_b
+        self.exporter.fpath_source_f = self.importer.fpath_source_f
+        self.exporter.fpath_encode_f = self.importer.fpath_encode_f
+        self.exporter.fpath_source_b = self.importer.fpath_source_b
+        self.exporter.fpath_encode_b = self.importer.fpath_encode_b
+        self.exporter.virtual = self.slicer.virtual
         self.exporter.subsection_compose.dpath_slices_f = self.slicer.dpath_slices_f
         self.exporter.subsection_compose.dpath_slices_b = self.slicer.dpath_slices_b
         self.exporter.superframe_size = self.slicer.slider_superframe_size.value
@@ -129,6 +154,26 @@ class MainWindow(QMainWindow):
     def _add_subsection(self, subsection):
         self.layout.addWidget(subsection.group_box)
 
+    def closeEvent(self, event):
+        remove_progress_listener(self.ffmpeg_progress.emit)
+        # Nothing should keep writing into the cache once the window's gone
+        cancel_all("window closed")
+        super().closeEvent(event)
+
+    def show_ffmpeg_progress(self, report: dict):
+        """ Shows how far every running ffmpeg job has got in the status bar
+        """
+        if report['done']:
+            self._ffmpeg_jobs.pop(report['pid'], None)
+        else:
+            frames = report['frame'] if report['n_frames'] is None else f"{report['frame']}/{report['n_frames']}"
+            msg = f"{report['desc']}: frame {frames}, {report['fps']} fps, {report['speed']}x"
+            if report['eta'] is not None:
+                msg += f", {report['eta']:.0f}s left"
+            self._ffmpeg_jobs[report['pid']] = msg
+
+        self.statusBar().showMessage(" | ".join(self._ffmpeg_jobs.values()))
+
     def on_change_importer(self):
         self.slicer.disable()
         self.exporter.disable()
@@ -182,6 +227,7 @@ class ImporterMenu(GenericSection):
         self.on_import = on_import
         self.on_change = on_change
         self.encoder_options = encoder_options
+        self._import_token = None
         self._init_layout()
         self._finalize_layout()
 
@@ -216,9 +262,14 @@ class ImporterMenu(GenericSection):
         self.button_import.clicked.connect(self.import_source)
         self.button_import.setEnabled(False)
 
+        self.button_cancel = QPushButton("Cancel")
+        self.button_cancel.clicked.connect(self.cancel_import)
+        self.button_cancel.setEnabled(False)
+
         self._add_subsection(self.source_subsection)
         self._add_subsection(self.encoder_subsection)
         self.layout.addWidget(self.button_import)
+        self.layout.addWidget(self.button_cancel)
 
     def import_source(self):
         qp = self.encoder_subsection.encoder_config_options['qp'].value()
@@ -237,24 +288,56 @@ class ImporterMenu(GenericSection):
         elif encoder == 'h264_videotoolbox':
             encoder_config['bitrate'] = bitrate
 
-        self.source_subsection._fpath_encode_f = self.controller.compress(
-            self.source_subsection._fpath_source_f,
-            gop_size=VideoCompressionDefaults.gop_size,
-            encoder=self.encoder_subsection.encoder_select.currentText(),
-            encoder_config=encoder_config,
-            pix_fmt=VideoMetadata(self.source_subsection._fpath_source_f).pix_fmt,
-        )
-
-        self.source_subsection._fpath_encode_b = self.controller.compress(
-            self.source_subsection._fpath_source_b,
-            gop_size=VideoCompressionDefaults.gop_size,
-            encoder=self.encoder_subsection.encoder_select.currentText(),
-            encoder_config=encoder_config,
-            pix_fmt=VideoMetadata(self.source_subsection._fpath_source_b).pix_fmt,
-        )
+        # Both sources are probed together, then encoded at once
+        fpath_source_f = str(Path(self.source_subsection._fpath_source_f).expanduser())
+        fpath_source_b = str(Path(self.source_subsection._fpath_source_b).expanduser())
+        metadata = probe_many([fpath_source_f, fpath_source_b])
+
+        def compress(fpath_source, threads):
+            return self.controller.compress(
+                fpath_source,
+                gop_size=VideoCompressionDefaults.gop_size,
+                encoder=encoder,
+                encoder_config=encoder_config,
+                pix_fmt=metadata[fpath_source].pix_fmt,
+                threads=threads,
+            )
+
+        # Encoded in the background, so the window keeps showing their
+        # progress and can cancel them
+        fpaths_source = list(metadata)
+        self.enable_import(False)
+        self.button_cancel.setEnabled(True)
+        try:
+            with stage("import") as token, ThreadPoolExecutor(1) as executor:
+                self._import_token = token
+
+                def compress_all():
+                    with using(token):
+                        return EncodeScheduler().map(compress, fpaths_source)
+
+                future = executor.submit(compress_all)
+                while len(wait([future], timeout=0.05).done) == 0:
+                    QApplication.processEvents()
+                fpaths_encode = dict(zip(fpaths_source, future.result()))
+        except CancelledError as e:
+            logging.info(f"Import cancelled: {e.reason}")
+            return
+        finally:
+            self._import_token = None
+            self.button_cancel.setEnabled(False)
+            self.enable_import(True)
+        self.source_subsection._fpath_encode_f = fpaths_encode[fpath_source_f]
+        self.source_subsection._fpath_encode_b = fpaths_encode[fpath_source_b]
 
         self.on_import()
 
+    def cancel_import(self):
+        """ Stops the encodes of the import that's running, if any
+        """
+        if self._import_token is not None:
+            self._import_token.cancel("cancelled by user")
+
     def enable_import(self, is_enabled=True):
         self.button_import.setEnabled(is_enabled)
 
@@ -442,19 +525,15 @@ class SlicerMenu(GenericSection):
         # TODO how can I pass filename?
         logging.info("slice")
 
+    def virtual(self):
+        return self.checkbox_virtual.isChecked()
+
     def slice_source(self):
-        self._dpath_slices_f = self.controller.slice(
-            fpath_source=self.fpath_source_f(),
-            fpath_encode=self.fpath_encode_f(),
-            superframe_size=self.slider_superframe_size.value(),
-            n_workers=self.n_workers,
-        )
-        self._dpath_slices_b = self.controller.slice(
-            fpath_source=self.fpath_source_b(),
-            fpath_encode=self.fpath_encode_b(),
-            superframe_size=self.slider_superframe_size.value(),
-            n_workers=self.n_workers,
-        )
+        # Slices are resolved at export time: virtual slices straight from the
+        # encodes, otherwise only the slices the timeline visits are extracted
+        # while the output is written (see CompressureSystem.export_timeline)
+        self._dpath_slices_f = None
+        self._dpath_slices_b = None
         self.on_slice()
 
     def _init_layout(self):
@@ -478,7 +557,11 @@ class SlicerMenu(GenericSection):
         sublayout.addWidget(self.label_superframe_size)
         sublayout.addWidget(self.slider_superframe_size)
 
+        self.checkbox_virtual = QCheckBox("Virtual Slices")
+        self.checkbox_virtual.stateChanged.connect(self.on_change)
+
         self.layout.addLayout(sublayout)
+        self.layout.addWidget(self.checkbox_virtual)
         self.layout.addWidget(self.button)
 
     def update_label_slider(self, value):
@@ -493,10 +576,12 @@ class SlicerMenu(GenericSection):
 
 
 class ExporterMenu(GenericSection):
-    def __init__(self, controller):
+    def __init__(self, controller, n_workers=0):
         super().__init__("Exporter", horizontal=False)
 
         self.controller = controller
+        self.n_workers = n_workers
+        self._export_token = None
 
         self._init_layout()
         self._finalize_layout()
@@ -527,10 +612,15 @@ class ExporterMenu(GenericSection):
         self.button.clicked.connect(self.compose_slices)
         self.enable(False)
 
+        self.button_cancel = QPushButton("Cancel")
+        self.button_cancel.clicked.connect(self.cancel_export)
+        self.button_cancel.setEnabled(False)
+
         self._add_subsection(self.subsection_compose)
         self._add_subsection(self.subsection_destination)
 
         self.layout.addWidget(self.button)
+        self.layout.addWidget(self.button_cancel)
 
     def enable(self, is_enabled=True):
         self.subsection_destination.ready_to_export = is_enabled
@@ -554,18 +644,66 @@ class ExporterMenu(GenericSection):
         else:
             video_list = []
 
-        for i, current_slice in enumerate(self.timeline()):
-            video_list.append(self.buffer().step(to=current_slice))
+        video_list.extend(self.buffer().resolve(self.timeline()))
+
+        # Everything's read from the widgets here, before going into the
+        # background
+        fpath_out = self.fpath_out()
+        virtual = self.virtual()
+        fpaths_source = {
+            self.fpath_encode_f(): self.fpath_source_f(),
+            self.fpath_encode_b(): self.fpath_source_b(),
+        }
+        superframe_size = self.superframe_size()
 
+        # Exported in the background like imports, so the window keeps
+        # showing its progress and can cancel it
         print(f"Concatenating {len(video_list)} videos")
-        concat_videos(video_list, fpath_out=self.fpath_out())
-        print(self.fpath_out())
+        self.button.setEnabled(False)
+        self.button_cancel.setEnabled(True)
+        try:
+            with stage("export") as token, ThreadPoolExecutor(1) as executor:
+                self._export_token = token
+
+                def export():
+                    with using(token):
+                        if virtual:
+                            self.controller.export(video_list, fpath_out=fpath_out)
+                        else:
+                            self.controller.export_timeline(
+                                video_list,
+                                fpaths_source,
+                                superframe_size,
+                                fpath_out,
+                                n_workers=self.n_workers,
+                            )
+
+                future = executor.submit(export)
+                while len(wait([future], timeout=0.05).done) == 0:
+                    QApplication.processEvents()
+                future.result()
+        except CancelledError as e:
+            logging.info(f"Export cancelled: {e.reason}")
+            return
+        finally:
+            self._export_token = None
+            self.button_cancel.setEnabled(False)
+            self.enable()
+        print(fpath_out)
+
+    def cancel_export(self):
+        """ Stops the export that's running, if any
+        """
+        if self._export_token is not None:
+            self._export_token.cancel("cancelled by user")
 
     def update_timeline(self):
-        self._buffer = self.controller.init_buffer(
-            self.dpath_slices_f(),
-            self.dpath_slices_b(),
-            self.superframe_size()
+        self._buffer = self.controller.init_virtual_buffer(
+            self.fpath_source_f(),
+            self.fpath_encode_f(),
+            self.fpath_source_b(),
+            self.fpath_encode_b(),
+            self.superframe_size(),
         )
 
         if self.timeline_function == "sinusoid":
@@ -873,7 +1011,8 @@ class ManifestSection(GenericSection):
         item_source.setFlags(self.item_flags)
         self.table.setItem(row, 0, item_source)
 
-        encode = self.controller.persistence.get_encode(fname_source, fname_encode)
+        # Names from the manifest, not paths
+        encode = self.controller.persistence.get_encode(None, fname_encode, source_name=fname_source)
 
         for encoder in self.encoder_options:
             if re.search(encoder, encode['command']):
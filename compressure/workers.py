@@ -0,0 +1,241 @@
+from itertools import count, islice
+import logging
+from multiprocessing import Pool
+import signal
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+from tqdm import tqdm
+
+from compressure.exceptions import WorkerPoolError
+from compressure.processes import current_token, forget_parent, kill_running
+
+
+class WorkerPoolDefaults(object):
+    # Most tasks sent to a worker at once. Batches shrink as the queue drains,
+    # so the last ones finish together instead of one worker holding a long
+    # batch while the rest sit idle
+    batch_size = 16
+    # How many batches each worker should get out of what's left to do
+    batches_per_worker = 4
+    # Batches sent to workers but not yet finished, per worker. Tasks are
+    # only pulled from their iterable to fill this, so a long (or endless)
+    # iterable isn't read ahead of the workers
+    batches_in_flight_per_worker = 2
+    # Seconds a batch may take before it's sent to another worker as well,
+    # for when a worker is stuck or much slower than the rest. Whichever copy
+    # finishes first counts, so tasks must be safe to run twice. None never
+    # sends batches again
+    batch_timeout = 300.0
+    # Times a failed task is tried again, one task per batch, before it's
+    # reported as failed
+    max_retries = 1
+    # Seconds between checks for cancellation while waiting on workers
+    poll_interval = 0.5
+
+
+def _init_worker():
+    # Processes and tokens copied from the parent aren't the worker's to kill
+    forget_parent()
+    # Terminating the pool only reaches the workers, so they take their
+    # ffmpeg processes down with them
+    signal.signal(signal.SIGTERM, _terminate_worker)
+
+
+def _terminate_worker(signum, frame):
+    kill_running()
+    raise SystemExit(1)
+
+
+def _run_batch(payload):
+    """ Runs function on each task of a batch in a worker. Failures are
+        returned rather than raised, so one failing task doesn't take its
+        batch, or the whole pool, down with it
+    """
+    function, batch = payload
+    results = []
+    for task in batch:
+        try:
+            results.append((task, True, function(*task)))
+        except Exception as e:
+            results.append((task, False, f"{e.__class__.__name__}: {e}"))
+    return results
+
+
+class WorkerPool(object):
+    """ Distributes many small tasks over worker processes. Tasks are pulled
+        lazily from an iterable, only as workers free up, sent to workers in
+        batches and their results are handed back in order of completion, so
+        progress and throughput reflect finished work rather than submitted
+        work. A batch that outlives batch_timeout is sent to a second worker,
+        and whichever copy finishes first counts. Failed tasks are
+        retried once everything else has been dispatched; any that still fail
+        are raised together in a WorkerPoolError at the end, after every other
+        task has been completed and handed back. Cancelling the current stage
+        (see processes.stage) terminates the workers, and their ffmpeg
+        processes with them
+    """
+    def __init__(self, n_workers: int = 0,
+                 batch_size: int = WorkerPoolDefaults.batch_size,
+                 max_retries: int = WorkerPoolDefaults.max_retries,
+                 batch_timeout: Optional[float] = WorkerPoolDefaults.batch_timeout,
+                 desc: Optional[str] = None):
+        """ Parameters:
+                - n_workers: number of processes. 0 runs tasks in this process
+                - batch_size: most tasks per batch
+                - max_retries: times a failed task is tried again
+                - batch_timeout: seconds before a batch is sent to another
+                  worker as well, None for never
+                - desc: progress bar label
+        """
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.batch_timeout = batch_timeout
+        self.desc = desc
+        self.stats = None
+
+    def _batches(self, tasks: Iterable[tuple], n_tasks: Optional[int], batch_size: int) -> Iterator[list]:
+        tasks = iter(tasks)
+        remaining = n_tasks
+        while True:
+            if remaining is None:
+                size = batch_size
+            else:
+                size = remaining // (max(self.n_workers, 1) * WorkerPoolDefaults.batches_per_worker)
+                size = max(1, min(batch_size, size))
+
+            batch = list(islice(tasks, size))
+            if len(batch) == 0:
+                return
+
+            if remaining is not None:
+                remaining -= len(batch)
+            yield batch
+
+    def _results(self, pool: Optional[Pool], payloads: Iterator[tuple], token, abandoned: list) -> Iterator[list]:
+        """ Results of each batch as they complete, checking token while
+            waiting on them. Payloads are only pulled to keep
+            batches_in_flight_per_worker batches going per worker
+            Parameters:
+                - abandoned: gets the copies of batches that were sent again
+                  and lost, which may still be running
+        """
+        if pool is None:
+            yield from map(_run_batch, payloads)
+            return
+
+        max_in_flight = WorkerPoolDefaults.batches_in_flight_per_worker * self.n_workers
+        # Set by workers' results as they come in, so waiting wakes up for
+        # whichever batch finishes first
+        completed = threading.Event()
+
+        def dispatch(payload):
+            return pool.apply_async(
+                _run_batch, (payload,),
+                callback=lambda _: completed.set(),
+                error_callback=lambda _: completed.set(),
+            )
+
+        # Each batch in flight, by order of dispatch: its payload, the time it
+        # was first sent and every copy of it that was sent
+        in_flight = {}
+        keys = count()
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                payload = next(payloads, None)
+                if payload is None:
+                    exhausted = True
+                else:
+                    in_flight[next(keys)] = (payload, time.monotonic(), [dispatch(payload)])
+            if len(in_flight) == 0:
+                return
+
+            # Cleared before looking, so a batch finishing in between still
+            # wakes the next wait
+            completed.clear()
+            done = [key for key, (_, _, copies) in in_flight.items() if any(r.ready() for r in copies)]
+            for key in done:
+                _, _, copies = in_flight.pop(key)
+                winner = next(r for r in copies if r.ready())
+                abandoned.extend(r for r in copies if r is not winner)
+                yield winner.get()
+            if len(done) > 0:
+                continue
+
+            token.raise_if_cancelled()
+            now = time.monotonic()
+            for payload, time_sent, copies in in_flight.values():
+                if self.batch_timeout is not None and len(copies) == 1 and now - time_sent > self.batch_timeout:
+                    logging.warning(
+                        f"Batch of {len(payload[1])} tasks of {payload[0].__name__} still running after "
+                        f"{self.batch_timeout}s, sending it to another worker"
+                    )
+                    copies.append(dispatch(payload))
+            completed.wait(WorkerPoolDefaults.poll_interval)
+
+    def imap(self, function: Callable, tasks: Iterable[tuple], n_tasks: Optional[int] = None) -> Iterator:
+        """ Runs function(*task) for every task, yielding results as they
+            complete
+            Parameters:
+                - function: module-level function, so workers can unpickle it
+                - tasks: argument tuples, consumed lazily
+                - n_tasks: number of tasks, if known. Used for progress and to
+                  shrink batches towards the end
+        """
+        time_start = time.perf_counter()
+        n_completed = 0
+        failures = []
+        progress = tqdm(total=n_tasks, desc=self.desc, unit="task")
+        finished = False
+        abandoned = []
+        token = current_token()
+        pool = Pool(self.n_workers, initializer=_init_worker) if self.n_workers > 0 else None
+        try:
+            batches = self._batches(tasks, n_tasks, self.batch_size)
+            for attempt in range(self.max_retries + 1):
+                failures = []
+                payloads = ((function, batch) for batch in batches)
+                for results in self._results(pool, payloads, token, abandoned):
+                    token.raise_if_cancelled()
+                    for task, succeeded, result in results:
+                        if succeeded:
+                            n_completed += 1
+                            progress.update(1)
+                            yield result
+                        else:
+                            failures.append((task, result))
+                    if len(failures) > 0:
+                        progress.set_postfix(failed=len(failures))
+
+                if len(failures) == 0 or attempt == self.max_retries:
+                    break
+
+                logging.warning(f"Retrying {len(failures)} failed tasks of {function.__name__}")
+                batches = self._batches((task for task, _ in failures), len(failures), 1)
+            finished = True
+        finally:
+            progress.close()
+            if pool is not None:
+                # Workers are only terminated, with their ffmpeg processes,
+                # when the run is cut short, or to stop batches that lost to
+                # their copies
+                if finished and all(r.ready() for r in abandoned):
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+
+        elapsed = max(time.perf_counter() - time_start, 1e-9)
+        self.stats = {
+            'completed': n_completed,
+            'failed': len(failures),
+            'seconds': elapsed,
+            'tasks_per_second': n_completed / elapsed,
+        }
+        logging.info(f"{function.__name__} on {self.n_workers} workers: {self.stats}")
+
+        if len(failures) > 0:
+            raise WorkerPoolError(function, failures)